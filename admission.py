@@ -0,0 +1,121 @@
+import math
+import threading
+import time
+
+from cache import TTLCache
+
+# Классы маршрутов, для которых лимиты одновременных запросов задаются отдельно
+READ = 'read'
+WRITE = 'write'
+
+
+class TokenBucket:
+    """
+    Ведро токенов для ограничения частоты запросов одного клиента.
+    Пополняется со скоростью rate токенов в секунду, вмещает не более burst токенов.
+    """
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        """
+        Забирает один токен. Возвращает None, если запрос разрешён,
+        иначе — через сколько секунд появится следующий токен.
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return None
+        return (1 - self.tokens) / self.rate
+
+
+class AdmissionController:
+    """
+    Контроль допуска запросов к серверу.
+
+    - Ограничивает число одновременно обрабатываемых запросов отдельно для чтения и записи:
+      запрос сверх лимита не ждёт в очереди, а сразу получает отказ (503).
+    - Ограничивает частоту запросов каждого клиента ведром токенов (429).
+    - Ведёт счётчики обрабатываемых, принятых и отклонённых запросов.
+    """
+
+    def __init__(self, read_limit=64, write_limit=16, rate=50.0, burst=100, retry_after=1,
+                 max_clients=10000, clock=time.monotonic):
+        """
+        read_limit, write_limit — лимиты одновременных запросов на чтение и на запись.
+        rate, burst — скорость пополнения (запросов в секунду) и ёмкость ведра токенов клиента.
+        retry_after — значение заголовка Retry-After (в секундах) при отказе из-за перегрузки.
+        max_clients — сколько вёдер клиентов хранить; давно неактивные клиенты вытесняются.
+        """
+        self.limits = {READ: read_limit, WRITE: write_limit}
+        self.rate = rate
+        self.burst = burst
+        self.retry_after = retry_after
+        self._clock = clock
+        # Ведро, к которому не обращались дольше, чем нужно на полное пополнение, можно забыть
+        self._buckets = TTLCache(maxsize=max_clients, ttl=burst / rate)
+        self._lock = threading.Lock()
+        self.in_flight = {READ: 0, WRITE: 0}
+        self.admitted = {READ: 0, WRITE: 0}
+        self.rejected = {READ: 0, WRITE: 0}
+        self.rate_limited = 0
+
+    @property
+    def total_limit(self):
+        """Сколько запросов всех классов может обрабатываться одновременно"""
+        return sum(self.limits.values())
+
+    def check_rate(self, client):
+        """
+        Проверяет лимит частоты для клиента (обычно его IP-адрес).
+        Возвращает None, если запрос разрешён, иначе — значение Retry-After в секундах.
+        """
+        now = self._clock()
+        with self._lock:
+            bucket = self._buckets.get(client)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst, now)
+            wait = bucket.take(now)
+            self._buckets.set(client, bucket)
+            if wait is None:
+                return None
+            self.rate_limited += 1
+        return max(1, math.ceil(wait))
+
+    def acquire(self, route_class):
+        """
+        Пытается занять слот для запроса класса route_class (READ или WRITE) без ожидания.
+        Возвращает True, если запрос допущен; тогда после обработки нужно вызвать release.
+        """
+        with self._lock:
+            if self.in_flight[route_class] >= self.limits[route_class]:
+                self.rejected[route_class] += 1
+                return False
+            self.in_flight[route_class] += 1
+            self.admitted[route_class] += 1
+            return True
+
+    def release(self, route_class):
+        """Освобождает слот, занятый acquire"""
+        with self._lock:
+            self.in_flight[route_class] -= 1
+
+    def stats(self):
+        """Возвращает текущие значения счётчиков в виде словаря"""
+        with self._lock:
+            stats = {
+                route_class: {
+                    "limit": self.limits[route_class],
+                    "in_flight": self.in_flight[route_class],
+                    "admitted": self.admitted[route_class],
+                    "rejected": self.rejected[route_class]
+                }
+                for route_class in (READ, WRITE)
+            }
+            stats["rate_limited"] = self.rate_limited
+            return stats
@@ -0,0 +1,276 @@
+import asyncio
+import logging
+from http import HTTPStatus
+
+from admission import AdmissionController
+from resilience import CircuitBreaker, SnapshotStore, Spool
+from routes import Router, encode_body, error
+from server_config import make_tracker, parse_args
+from sketches import DEFAULT_QUANTILES
+
+logger = logging.getLogger('Async HTTP Server')
+
+# Сколько секунд держать открытым простаивающее keep-alive соединение
+KEEP_ALIVE_TIMEOUT = 75
+# Ограничения на запрос: число заголовков и размер тела (в байтах)
+MAX_HEADERS = 100
+MAX_BODY_SIZE = 1024 * 1024
+
+
+class AsyncExpenseTracker:
+    """
+    Асинхронный фасад над ExpenseTracker для asyncio-сервера.
+
+    Блокирующие вызовы pymongo выполняются в ограниченном пуле потоков автомата-размыкателя breaker
+    (см. resilience.CircuitBreaker): цикл событий не блокируется, число одновременных запросов
+    к MongoDB не превышает max_workers, а каждый вызов ограничен сроком.
+
+    Одинаковые аналитические запросы (категория с максимальной тратой, максимальная трата, процентили),
+    пришедшие, пока такой же запрос ещё выполняется, не отправляются в базу повторно:
+    все ожидающие получают результат первого. Фасад рассчитан на один цикл событий.
+
+    Реализует интерфейс доступа к трекеру для маршрутов (см. routes.SyncBackend): call, offload, replay_spool.
+    """
+
+    def __init__(self, tracker, breaker=None, max_workers=32):
+        self.tracker = tracker
+        self.breaker = breaker or CircuitBreaker(max_workers=max_workers)
+        self._in_flight = {}  # ключ запроса -> задача, выполняющая его
+
+    async def _call(self, fn, *args, **kwargs):
+        return await self.breaker.call_async(fn, *args, **kwargs)
+
+    async def _coalesced(self, key, fn, *args, **kwargs):
+        """Выполняет запрос или присоединяется к уже выполняющемуся запросу с тем же ключом"""
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._call(fn, *args, **kwargs))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # shield: если один из ожидающих отменён (клиент отключился), запрос продолжается для остальных
+        return await asyncio.shield(task)
+
+    async def call(self, method, *args, deadline=None, **kwargs):
+        """
+        Вызов метода фасада по имени (для маршрутов routes.Router).
+        С deadline метод трекера вызывается напрямую с этим сроком (см. CircuitBreaker.call), без объединения запросов.
+        """
+        if deadline is not None:
+            return await self.breaker.call_async(getattr(self.tracker, method), *args, deadline=deadline, **kwargs)
+        return await getattr(self, method)(*args, **kwargs)
+
+    async def offload(self, fn, *args):
+        """Блокирующая операция с файлами — в пуле потоков по умолчанию, вне цикла событий"""
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+    def replay_spool(self, spool):
+        """Если в очереди есть траты, записанные при недоступности базы, воспроизводит их в фоне"""
+        if spool.pending():
+            add_expense = lambda **e: self.breaker.call(self.tracker.add_expense, **e)  # noqa: E731
+            asyncio.get_running_loop().run_in_executor(None, spool.replay, add_expense)
+
+    async def add_expense(self, name, category, amount, date, idempotency_key=None, tenant=None, expense_id=None):
+        return await self._call(
+            self.tracker.add_expense, name, category, amount, date, idempotency_key, tenant=tenant, expense_id=expense_id
+        )
+
+    async def get_full_records(self, after=None, limit=None, month=None, category=None, fields=None, tenant=None):
+        return await self._call(self.tracker.get_full_records, after, limit, month, category, fields, tenant=tenant)
+
+    async def search_expenses(self, query, month=None, category=None, limit=50, tenant=None):
+        return await self._call(self.tracker.search_expenses, query, month, category, limit, tenant=tenant)
+
+    async def get_top_category(self, month, tenant=None):
+        return await self._coalesced(("top", tenant, month), self.tracker.get_top_category, month, tenant=tenant)
+
+    async def get_max_expense(self, month, category, tenant=None):
+        return await self._coalesced(
+            ("max", tenant, month, category), self.tracker.get_max_expense, month, category, tenant=tenant
+        )
+
+    async def get_percentiles(self, months=None, category=None, quantiles=DEFAULT_QUANTILES, tenant=None):
+        key = ("percentiles", tenant, tuple(months or ()), category, tuple(quantiles))
+        return await self._coalesced(key, self.tracker.get_percentiles, months, category, quantiles, tenant=tenant)
+
+
+# Фасад трекера создаётся при первом запросе (get_async_tracker), как tracker в http_server
+async_tracker = None
+
+# Разделы пользователей, файловое хранилище, параметры MongoDB, контроль допуска, многопользовательский режим
+# и деградированный режим — как в http_server
+partitions = None
+storage_path = None
+tracker_options = {}
+admission = AdmissionController()
+multi_tenant = False
+snapshots = SnapshotStore('analytics_snapshot.json')
+spool = Spool('expenses.spool')
+
+def get_async_tracker():
+    """
+    Возвращает общий AsyncExpenseTracker, создавая его при первом вызове.
+    Вызывается только из потока цикла событий, поэтому блокировка не нужна.
+    """
+    global async_tracker
+    if async_tracker is None:
+        tracker = make_tracker(partitions, storage_path, tracker_options)
+        # Пул автомата вмещает все запросы, пропущенные контролем допуска (как в http_server)
+        async_tracker = AsyncExpenseTracker(tracker, max_workers=admission.total_limit)
+    return async_tracker
+
+
+class BadRequest(Exception):
+    """Запрос не удалось разобрать; соединение закрывается после ответа"""
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+async def read_request(reader):
+    """
+    Читает из потока один HTTP-запрос.
+    Возвращает (метод, путь, версия, заголовки, тело) или None, если клиент закрыл соединение.
+    Имена заголовков приводятся к нижнему регистру.
+
+    Тело читается только по Content-Length. Запрос с Transfer-Encoding (501) или с несколькими разными
+    Content-Length (400) отклоняется, и соединение закрывается: иначе часть тела была бы прочитана
+    как следующий запрос (request smuggling за прокси, который понимает эти заголовки иначе).
+    """
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    try:
+        method, target, version = line.decode('latin-1').split()
+    except ValueError:
+        raise BadRequest(400, "Неверная строка запроса") from None
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        if len(headers) >= MAX_HEADERS:
+            raise BadRequest(431, "Слишком много заголовков")
+        name, _, value = line.decode('latin-1').partition(':')
+        name, value = name.strip().lower(), value.strip()
+        if name == 'content-length' and headers.get(name, value) != value:
+            raise BadRequest(400, "Неверный заголовок Content-Length")
+        headers[name] = value
+    if 'transfer-encoding' in headers:
+        raise BadRequest(501, "Transfer-Encoding не поддерживается, передайте Content-Length")
+    length = headers.get('content-length', '0')
+    if not (length.isascii() and length.isdigit()):
+        raise BadRequest(400, "Неверный заголовок Content-Length")
+    length = int(length)
+    if length > MAX_BODY_SIZE:
+        raise BadRequest(413, "Слишком большое тело запроса")
+    body = await reader.readexactly(length) if length > 0 else b''
+    return method, target, version, headers, body
+
+def encode_response(code, payload, headers, keep_alive):
+    """Собирает ответ HTTP/1.1. payload — объект для JSON или уже готовое тело (str)"""
+    body = encode_body(payload)
+    lines = [
+        f"HTTP/1.1 {code} {HTTPStatus(code).phrase}",
+        "Content-Type: application/json; charset=utf-8",
+        f"Content-Length: {len(body)}",
+        f"Connection: {'keep-alive' if keep_alive else 'close'}"
+    ]
+    lines += [f"{name}: {value}" for name, value in headers.items()]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1') + body
+
+def _keep_alive(version, headers):
+    """HTTP/1.1 держит соединение по умолчанию, HTTP/1.0 — только с Connection: keep-alive"""
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.1':
+        return connection != 'close'
+    return connection == 'keep-alive'
+
+async def handle_connection(reader, writer):
+    """
+    Обслуживает одно соединение: запросы читаются и обрабатываются по очереди, пока клиент
+    держит соединение открытым (keep-alive), но не дольше KEEP_ALIVE_TIMEOUT секунд простоя.
+    Простаивающее соединение не занимает поток — тысячи соединений обслуживает один процесс.
+    """
+    peer = writer.get_extra_info('peername')
+    client = peer[0] if peer else ''
+    try:
+        while True:
+            try:
+                request = await asyncio.wait_for(read_request(reader), KEEP_ALIVE_TIMEOUT)
+            except BadRequest as e:
+                writer.write(encode_response(*error(e.code, str(e)), keep_alive=False))
+                await writer.drain()
+                break
+            if request is None:
+                break
+            method, target, version, headers, body = request
+            code, payload, extra_headers = await dispatch(method, target, headers, body, client)
+            logger.info(f'{client} "{method} {target} {version}" {code}')
+            keep_alive = _keep_alive(version, headers)
+            writer.write(encode_response(code, payload, extra_headers, keep_alive))
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, ConnectionError):
+        # Простой дольше таймаута, обрыв соединения или слишком длинная строка запроса
+        pass
+    finally:
+        writer.close()
+
+async def dispatch(method, target, headers, body, client):
+    """Передаёт запрос маршрутам (routes.Router) — тем же, что у http_server; возвращает (код, тело, заголовки)"""
+    router = Router(get_async_tracker(), admission, snapshots, spool, logger, multi_tenant or bool(partitions))
+    return await router.dispatch(method, target, headers, body, client)
+
+async def serve(host='', port=8080, backlog=1024):
+    """Принимает соединения до отмены задачи"""
+    server = await asyncio.start_server(handle_connection, host, port, backlog=backlog)
+    logger.info(f"Асинхронный HTTP-сервер запущен на порту {port}")
+    async with server:
+        await server.serve_forever()
+
+def run(port=8080, warm_up=True):
+    """
+    Запуск асинхронного сервера: подготовка трекера (кэш аналитики, прогрев) — как в http_server.run,
+    затем цикл событий. Сокет открывается после прогрева.
+    """
+    try:
+        snapshots.restore()
+    except (OSError, ValueError):
+        logger.exception("Не удалось загрузить снимок аналитики")
+    snapshots.start()
+    facade = get_async_tracker()
+    tracker = facade.tracker
+    spool.start(lambda **expense: facade.breaker.call(tracker.add_expense, **expense))
+    try:
+        tracker.start_analytics_cache()
+    except Exception:
+        logger.exception("Не удалось запустить уведомления об изменениях, кэш аналитики отключён")
+    if warm_up:
+        try:
+            tracker.warm_up()
+            logger.info("Трекер прогрет.")
+        except Exception:
+            logger.exception("Не удалось прогреть трекер, сервер запускается без прогрева!")
+    try:
+        asyncio.run(serve(port=port))
+    finally:
+        spool.stop()
+        snapshots.stop()
+
+def main():
+    """
+    Запуск из командной строки с теми же параметрами, что и у http_server:
+    python async_server.py [--port 8080] [--partitions N | --storage-path PATH] [--multi-tenant] [--no-warm-up]
+    [--mongo-uri URI] [--reader-uri URI] [--read-preference MODE] ... (см. server_config.parse_args)
+    """
+    global partitions, multi_tenant, storage_path, tracker_options
+    args = parse_args("Асинхронный HTTP-сервер трекера расходов")
+    partitions, multi_tenant, storage_path = args.partitions, args.multi_tenant, args.storage_path
+    tracker_options = args.tracker_options
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    run(port=args.port, warm_up=not args.no_warm_up)
+
+if __name__ == '__main__':
+    main()
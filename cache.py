@@ -0,0 +1,61 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Потокобезопасный кэш ограниченного размера с временем жизни записей.
+
+    Записи старше ttl секунд считаются отсутствующими и удаляются при обращении.
+    При превышении maxsize вытесняется запись, к которой дольше всего не обращались (LRU).
+    """
+
+    def __init__(self, maxsize=10000, ttl=3600, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock  # источник времени, подменяется в тестах
+        self._data = OrderedDict()  # ключ -> (время истечения, значение)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Возвращает значение по ключу или default, если записи нет или она устарела"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires, value = item
+            if expires <= self._clock():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Сохраняет значение, вытесняя самые старые записи при переполнении"""
+        with self._lock:
+            self._data[key] = (self._clock() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Удаляет запись по ключу и возвращает её значение"""
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[1]
+
+    def items(self):
+        """Список пар (ключ, значение) неустаревших записей — от давних обращений к недавним"""
+        with self._lock:
+            now = self._clock()
+            return [(key, value) for key, (expires, value) in self._data.items() if expires > now]
+
+    def clear(self):
+        """Очищает кэш"""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
@@ -0,0 +1,161 @@
+import logging
+import threading
+
+import schema
+
+logger = logging.getLogger('Change Feed')
+
+# Документ коллекции версий со счётчиком изменений (режим опроса)
+SEQ_ID = "seq"
+
+
+class ChangeFeed:
+    """
+    Уведомления о новых тратах для всех процессов, работающих с одной коллекцией.
+
+    Подписчики (subscribe) получают (tenant, month, category) каждой добавленной траты,
+    в том числе добавленной другим процессом, — по этим ключам процесс вытесняет свой кэш аналитики.
+
+    Режимы:
+     - 'stream' — change stream MongoDB (collection.watch), нужен replica set; задержка — доли секунды;
+     - 'poll' — опрос коллекции версий versions_collection. Пишущий процесс вызывает publish:
+       увеличивает счётчик в документе версий и записывает номер изменения в документ ключа.
+       Опрос выбирает ключи с номером больше запомненного — задержка не больше двух poll_interval;
+     - 'auto' — change stream, если база его поддерживает, иначе опрос (например, в mongomock).
+    """
+
+    def __init__(self, collection, versions_collection, mode='auto', poll_interval=1.0):
+        if mode not in ('auto', 'stream', 'poll'):
+            raise ValueError(f"Неизвестный режим уведомлений: '{mode}'")
+        self.collection = collection
+        self.versions = versions_collection
+        self.mode = mode
+        self.poll_interval = poll_interval
+        self._subscribers = []
+        self._stop = threading.Event()
+        self._thread = None
+        # Номера изменений, прочитанные двумя последними опросами (см. poll)
+        self._floor = None
+        self._previous = None
+
+    def subscribe(self, callback):
+        """Добавляет подписчика callback(tenant, month, category)"""
+        self._subscribers.append(callback)
+
+    def _notify(self, tenant, month, category):
+        for callback in self._subscribers:
+            try:
+                callback(tenant, month, category)
+            except Exception:
+                logger.exception("Ошибка в подписчике уведомлений об изменениях")
+
+    def _open_stream(self, resume_token=None):
+        """Открывает change stream на вставку и замену документов трат"""
+        return self.collection.watch(
+            [{"$match": {"operationType": {"$in": ["insert", "replace"]}}}],
+            resume_after=resume_token,
+            max_await_time_ms=int(self.poll_interval * 1000)
+        )
+
+    def start(self):
+        """
+        Определяет режим (для 'auto') и запускает фоновый поток уведомлений.
+        Вызывать до того, как процесс начнёт кэшировать результаты.
+        """
+        from pymongo.errors import OperationFailure
+
+        stream = None
+        if self.mode in ('auto', 'stream'):
+            try:
+                stream = self._open_stream()
+                self.mode = 'stream'
+            # OperationFailure — сервер без replica set, TypeError — mongomock (метода watch нет)
+            except (NotImplementedError, TypeError, OperationFailure):
+                if self.mode == 'stream':
+                    raise
+                logger.info("Change streams недоступны, уведомления об изменениях через опрос")
+                self.mode = 'poll'
+        if self.mode == 'poll':
+            self.versions.create_index("seq")
+            self.poll()
+            target, args = self._poll_loop, ()
+        else:
+            target, args = self._watch, (stream,)
+        self._stop.clear()
+        self._thread = threading.Thread(target=target, args=args, name='change-feed', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Останавливает фоновый поток"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def publish(self, tenant, month, category):
+        """
+        Сообщает другим процессам о новой трате. Нужен только в режиме опроса:
+        в режиме change stream уведомление формирует сама база.
+        """
+        if self.mode != 'poll':
+            return
+        from pymongo import ReturnDocument
+
+        seq = self.versions.find_one_and_update(
+            {"_id": SEQ_ID}, {"$inc": {"seq": 1}}, upsert=True, return_document=ReturnDocument.AFTER
+        )["seq"]
+        key = f"{month}|{category}" if tenant is None else f"{len(tenant)}:{tenant}|{month}|{category}"
+        self.versions.update_one(
+            {"_id": key},
+            {"$max": {"seq": seq}, "$set": {"tenant": tenant, "month": month, "category": category}},
+            upsert=True
+        )
+
+    def poll(self):
+        """
+        Один проход опроса: уведомляет о ключах, изменённых после предпоследнего прохода.
+        Номер изменения выделяется до записи документа ключа, поэтому запись могла появиться
+        уже после прохода, прочитавшего больший номер; перекрытие в один проход это учитывает.
+        Повторное уведомление о ключе безвредно — вытеснение идемпотентно.
+        Возвращает число уведомлений.
+        """
+        counter = self.versions.find_one({"_id": SEQ_ID})
+        current = counter["seq"] if counter else 0
+        if self._previous is None:
+            # Первый проход: кэш ещё пуст, прошлые изменения не интересны
+            self._floor = self._previous = current
+            return 0
+        notified = 0
+        for doc in self.versions.find({"_id": {"$ne": SEQ_ID}, "seq": {"$gt": self._floor}}):
+            self._notify(doc.get("tenant"), doc["month"], doc["category"])
+            notified += 1
+        self._floor, self._previous = self._previous, current
+        return notified
+
+    def _poll_loop(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("Ошибка опроса коллекции версий")
+
+    def _watch(self, stream):
+        """Читает change stream; при обрыве переоткрывает его с последнего обработанного события"""
+        resume_token = None
+        while not self._stop.is_set():
+            try:
+                if stream is None:
+                    stream = self._open_stream(resume_token)
+                with stream:
+                    while not self._stop.is_set():
+                        change = stream.try_next()
+                        if change is None:
+                            continue
+                        resume_token = stream.resume_token
+                        document = schema.decode(change.get("fullDocument") or {})
+                        if "date" in document and "category" in document:
+                            self._notify(document.get("tenant"), document["date"].split(".")[1], document["category"])
+            except Exception:
+                logger.exception("Обрыв change stream, переподключение")
+                self._stop.wait(self.poll_interval)
+            stream = None
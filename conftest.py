@@ -0,0 +1,17 @@
+import pytest
+
+
+class FakeClock:
+    """Часы, которые двигаются только вручную: тесты сроков (ttl, пополнение ведра, размыкатель) не ждут"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    """Управляемые часы с нулевым временем; время сдвигается присваиванием clock.now"""
+    return FakeClock()
@@ -1,4 +1,75 @@
+import datetime
+import logging
 import re
+import threading
+import time
+
+import schema
+from cache import TTLCache
+from sketches import DEFAULT_QUANTILES, SketchStore
+
+logger = logging.getLogger('Expense Tracker')
+
+# Наибольшее число трат в ответе поиска (search_expenses)
+MAX_SEARCH_LIMIT = 500
+
+# Признак отсутствия записи в кэше аналитики (None — допустимый закэшированный результат)
+_MISSING = object()
+
+def _connection_counter():
+    """
+    Слушатель событий пула соединений pymongo, считающий открытые соединения.
+    Класс определяется при вызове: импорт модуля не загружает pymongo.
+    """
+    from pymongo import monitoring
+
+    class ConnectionCounter(monitoring.ConnectionPoolListener):
+        def __init__(self):
+            self.open_connections = 0
+            self._lock = threading.Lock()
+
+        def connection_created(self, event):
+            with self._lock:
+                self.open_connections += 1
+
+        def connection_closed(self, event):
+            with self._lock:
+                self.open_connections -= 1
+
+        def pool_created(self, event):
+            pass
+
+        def pool_ready(self, event):
+            pass
+
+        def pool_cleared(self, event):
+            pass
+
+        def pool_closed(self, event):
+            pass
+
+        def connection_ready(self, event):
+            pass
+
+        def connection_check_out_started(self, event):
+            pass
+
+        def connection_check_out_failed(self, event):
+            pass
+
+        def connection_checked_out(self, event):
+            pass
+
+        def connection_checked_in(self, event):
+            pass
+
+    return ConnectionCounter()
+
+def search_tokens(text):
+    """
+    Разбивает строку на слова в нижнем регистре (без повторов, в порядке появления).
+    """
+    return list(dict.fromkeys(re.findall(r"\w+", text.lower())))
 
 # logic
 # Класс, описывающий отдельную трату
@@ -23,6 +94,12 @@ class Expense:
         """
         return self.category.lower() == cat.lower()
 
+    def search_tokens(self):
+        """
+        Возвращает слова названия траты в нижнем регистре — по ним работает поиск по названию.
+        """
+        return search_tokens(self.name)
+
     def as_dict(self):
         """
         Возвращает словарь с полями объекта для сохранения в БД Mongo
@@ -31,56 +108,69 @@ class Expense:
             "name": self.name,
             "category": self.category,
             "amount": self.amount,
-            "date": self.date
+            "date": self.date,
+            "tokens": self.search_tokens()
         }
 
-class ExpenseTracker:
-    def __init__(self, db_client=None):
+class BaseExpenseTracker:
+    """
+    Общая часть трекеров трат, не зависящая от хранилища: валидация трат и ключи идемпотентности.
+
+    Хранилище реализуют подклассы: ExpenseTracker (MongoDB) и FileExpenseTracker (локальный файл, см. file_storage.py).
+    Подкласс сохраняет проверенную трату в _insert и реализует аналитические методы
+    (get_full_records, search_expenses, get_top_category, get_max_expense, get_percentiles),
+    а также подготовку к работе сервера — start_analytics_cache и warm_up.
+    """
+
+    # Поля траты, которые можно запросить в get_full_records (проекция)
+    RECORD_FIELDS = ("name", "category", "amount", "date")
+
+    def __init__(self, idempotency_cache_size=10000, idempotency_ttl=24 * 3600):
         """
-        Инициализация ExpenseTracker — интерфейса для работы с MongoDB.
-        Если передан соответствующий db_client (mongomock.MongoClient для тестов),
-        то он используется для подключения,
-        иначе — создаём реальное подключение к MongoDB.
+        idempotency_cache_size и idempotency_ttl (в секундах) задают размер и время жизни
+        кэша ключей идемпотентности (см. add_expense).
         """
-        if db_client is not None:
-            self.client = db_client
-        else:
-            # Подключение к настоящей MongoDB
-            from pymongo import MongoClient
-            self.client = MongoClient('mongodb://localhost:27017/') # здесь нужно подставить актуальный адрес Mongo
-        # Используем/создаём БД и коллекцию
-        self.db = self.client['expenses_db'] # self.db: используемая база данных "expenses_db"
-        self.collection = self.db['expenses'] # self.collection: коллекция "expenses", где хранятся документы трат
+        # Кэш ответов на уже обработанные ключи идемпотентности: ключ -> сообщение об успешной вставке
+        self.idempotency_cache = TTLCache(maxsize=idempotency_cache_size, ttl=idempotency_ttl)
 
-    def add_expense(self, name, category, amount, date):
-        """
-        Добавляет новую трату в базу данных (MongoDB).
-        Проверяет корректность данных и формат даты.
+    @staticmethod
+    def _success_message(expense):
+        """Формирует сообщение об успешном добавлении траты"""
+        return f"Трата '{expense.name}' добавлена в категорию '{expense.category}' на "+\
+        f"сумму {expense.amount} за {expense.date}."
 
-        Проверки:
-          - Все поля должны быть обязательно заполнены
-          - Сумма должна быть числом и больше 0
-          - Дата должна соответствовать формату "день.месяц"
-            с адекватным диапазоном значений дня и месяца
-        Если проверки не прошли — возвращает текст с ошибкой.
+    @staticmethod
+    def _scoped_key(tenant, idempotency_key):
+        """
+        Ключ идемпотентности с учётом владельца: одинаковые ключи разных пользователей не конфликтуют.
+        Длина идентификатора владельца в префиксе делает разбиение на части однозначным.
+        """
+        if tenant is None:
+            return idempotency_key
+        return f"{len(tenant)}:{tenant}:{idempotency_key}"
 
-        Если всё хорошо — добавляет в коллекцию документ и возвращает сообщение об успешной вставке.
+    @staticmethod
+    def validate_expense(name, category, amount, date):
+        """
+        Проверяет данные траты и приводит их к стандартному виду, не обращаясь к базе.
+        Возвращает (Expense, None), если всё корректно, иначе (None, текст ошибки).
+        Проверки описаны в add_expense.
         """
         # Проверка наличия всех обязательных данных
         if not (name and category and amount is not None and date):
-            return "Ошибка: не заполнены все необходимые поля."
+            return None, "Ошибка: не заполнены все необходимые поля."
 
         # Сумма должна быть положительным числом
         try:
             amount = float(amount)
             if amount <= 0:
-                return "Ошибка: сумма должна быть положительным числом."
+                return None, "Ошибка: сумма должна быть положительным числом."
         except ValueError:
-            return "Ошибка: сумма должна быть числом."
+            return None, "Ошибка: сумма должна быть числом."
 
         # Проверка формата даты
         if not re.fullmatch(r'^\d{1,2}\.\d{1,2}$', date):
-            return "Ошибка: неверный формат даты. Ожидался <день.месяц>"
+            return None, "Ошибка: неверный формат даты. Ожидался <день.месяц>"
     
         try:
             day, month = date.split(".")
@@ -89,44 +179,571 @@ class ExpenseTracker:
             # Проверка корректности дня и месяца с учётом месяцев:
             if not ((1 <= day <= 31 and month in [1, 3, 5, 7, 8, 10, 12]) or \
                     (1 <= day <= 31 and month in [4, 6, 9, 11]) or (1 <= day <= 29 and month == 2)):
-                return "Ошибка: некорректные значения дня или месяца."
+                return None, "Ошибка: некорректные значения дня или месяца."
             date = f"{day:02d}.{month:02d}"  # день и месяц с двумя цифрами
         except ValueError:
-            return "Ошибка: неверный формат даты. Ожидался <день.месяц>"
+            return None, "Ошибка: неверный формат даты. Ожидался <день.месяц>"
 
         # Форматирование данных для стандарта
         name = name.capitalize()
         category = category.capitalize()
 
-        expense = Expense(name, category, amount, date)
+        return Expense(name, category, amount, date), None
 
-        # Вставляем документ в MongoDB
-        self.collection.insert_one(expense.as_dict())
 
-        return f"Трата '{expense.name}' добавлена в категорию '{expense.category}' на "+\
-        f"сумму {expense.amount} за {expense.date}."
+    def add_expense(self, name, category, amount, date, idempotency_key=None, tenant=None, expense_id=None):
+        """
+        Добавляет новую трату в хранилище.
+        Проверяет корректность данных и формат даты.
+
+        Проверки:
+          - Все поля должны быть обязательно заполнены
+          - Сумма должна быть числом и больше 0
+          - Дата должна соответствовать формату "день.месяц"
+            с адекватным диапазоном значений дня и месяца
+        Если проверки не прошли — возвращает текст с ошибкой.
+
+        Если всё хорошо — сохраняет трату (_insert) и возвращает сообщение об успешной вставке.
 
-    def get_full_records(self):
+        Если передан idempotency_key, повторный вызов с тем же ключом не создаёт новую запись,
+        а возвращает то же сообщение, что и первый вызов. Сначала проверяется кэш в памяти,
+        затем хранилище (в MongoDB — уникальный индекс по ключу, на случай повтора через другой процесс).
+
+        tenant — владелец траты (см. описание подкласса); ключи идемпотентности действуют в пределах владельца.
+
+        expense_id — заранее назначенный идентификатор траты (строка ObjectId), например, для траты без ключа клиента,
+        которую сервер может повторить из очереди: повтор с тем же expense_id не создаёт вторую запись.
+        """
+        if idempotency_key:
+            idempotency_key = self._scoped_key(tenant, idempotency_key)
+            cached = self.idempotency_cache.get(idempotency_key)
+            if cached is not None:
+                return cached
+
+        expense, error = self.validate_expense(name, category, amount, date)
+        if error:
+            return error
+
+        msg = self._insert(expense, tenant, idempotency_key, expense_id)
+        if idempotency_key:
+            self.idempotency_cache.set(idempotency_key, msg)
+        return msg
+
+    def _insert(self, expense, tenant, idempotency_key, expense_id):
         """
-        Возвращает полный список всех затрат из коллекции.
-        Поиск документов без фильтра.
+        Сохраняет проверенную трату (Expense) и возвращает сообщение для клиента.
+        idempotency_key — ключ с учётом владельца или None, expense_id — см. add_expense. Реализуется подклассом.
+        """
+        raise NotImplementedError
+
+    def _check_fields(self, fields):
+        """Проверяет, что все запрошенные поля есть в RECORD_FIELDS, иначе выбрасывает ValueError"""
+        unknown = set(fields) - set(self.RECORD_FIELDS)
+        if unknown:
+            raise ValueError(f"Неизвестные поля: {', '.join(sorted(unknown))}")
+
+    @staticmethod
+    def _check_search_limit(limit):
+        """Проверяет, что limit поиска — целое число от 1 до MAX_SEARCH_LIMIT, иначе выбрасывает ValueError"""
+        if isinstance(limit, bool) or not isinstance(limit, int) or not 1 <= limit <= MAX_SEARCH_LIMIT:
+            raise ValueError(f"Параметр limit должен быть числом от 1 до {MAX_SEARCH_LIMIT}")
+
+    def _public_fields(self, document):
+        """Оставляет в документе траты (версии 1) только поля траты, без _id и служебных полей"""
+        return {field: document[field] for field in self.RECORD_FIELDS if field in document}
+
+
+class ExpenseTracker(BaseExpenseTracker):
+    def __init__(self, db_client=None, reader_client=None, mongo_uri='mongodb://localhost:27017/', reader_uri=None,
+                 max_pool_size=100, reader_max_pool_size=None, min_pool_size=4, reader_min_pool_size=None,
+                 timeout_ms=5000, reader_timeout_ms=None,
+                 read_preference='primary', max_staleness_seconds=None,
+                 schema_version=schema.SCHEMA_VERSION, legacy_reads=True,
+                 db_name='expenses_db', collection_name='expenses', sketches_collection_name='sketches',
+                 idempotency_cache_size=10000, idempotency_ttl=24 * 3600):
         """
-        return list(self.collection.find({}))
+        Инициализация ExpenseTracker — интерфейса для работы с MongoDB.
+        Если передан соответствующий db_client (mongomock.MongoClient для тестов),
+        то он используется для подключения,
+        иначе — создаём реальное подключение к MongoDB.
+
+        Запись и аналитика разделены: add_expense всегда идёт через клиента записи (db_client / mongo_uri),
+        а аналитические запросы (get_top_category, get_max_expense, get_full_records, поиск, процентили) —
+        через клиента чтения (reader_client / reader_uri). Если клиент чтения не задан,
+        используется клиент записи, но с настройками чтения ниже.
+
+        max_pool_size, reader_max_pool_size — размеры пулов соединений клиентов записи и чтения;
+        min_pool_size, reader_min_pool_size — сколько соединений пулы держат открытыми и без запросов
+        (pymongo открывает их в фоне; warm_up дожидается, пока они откроются);
+        timeout_ms, reader_timeout_ms — таймауты (мс) выбора сервера, подключения и операций;
+        read_preference — предпочтение чтения для аналитики. По умолчанию 'primary': аналитика сразу видит
+        только что добавленные траты. 'secondaryPreferred' и другие режимы отправляют тяжёлые агрегации
+        на реплики, чтобы они не конкурировали с записью, но результат может отставать от записи;
+        max_staleness_seconds — допустимое отставание реплики для чтения (не меньше 90 секунд, None — без ограничения).
+
+        schema_version — версия схемы, в которой записываются новые траты (см. schema.py):
+        2 — компактная схема (по умолчанию), 1 — исходная (на время постепенного обновления серверов).
+        legacy_reads — учитывать ли при чтении документы версии 1. После миграции коллекции
+        (migrate.py) можно отключить, тогда запросы строятся только по полям версии 2.
+        Трекер, который пишет в версии 1, обязан читать её (иначе не видит своих записей
+        и не создаёт уникальный индекс ключа идемпотентности), поэтому schema_version=1
+        с legacy_reads=False отклоняется (ValueError).
+
+        db_name, collection_name, sketches_collection_name — имена базы данных, коллекции трат
+        и коллекции скетчей (разные имена позволяют разнести пользователей по нескольким
+        коллекциям или базам, см. partitioning.py).
+
+        idempotency_cache_size и idempotency_ttl (в секундах) задают размер и время жизни
+        кэша ключей идемпотентности (см. add_expense).
+
+        Все методы принимают необязательный параметр tenant — идентификатор пользователя (арендатора).
+        Если он задан, трата сохраняется с этим владельцем, а аналитика считается только по его тратам
+        с помощью индексов, начинающихся с поля владельца. Если tenant не задан (None),
+        запросы выполняются по всем тратам, как в однопользовательском режиме.
+        """
+        if schema_version != schema.SCHEMA_VERSION and not legacy_reads:
+            raise ValueError(f"Трекер, который пишет в версии схемы {schema_version}, должен читать её: задайте legacy_reads=True")
+        super().__init__(idempotency_cache_size, idempotency_ttl)
+        self.schema_version = schema_version
+        self.legacy_reads = legacy_reads
+        self._indexes_ready = False
+        # Кэш результатов get_top_category/get_max_expense, включается enable_analytics_cache
+        self.analytics_cache = None
+        self.change_feed = None
+        self._cache_consistent_reads = False
+        # Ключ кэша -> метка вычисления, которое сейчас идёт по этому ключу (см. _cached)
+        self._computing = {}
+        self._computing_lock = threading.Lock()
+        # Созданные трекером клиенты: (клиент, счётчик открытых соединений, min_pool_size) — для warm_up
+        self._pools = []
+        if db_client is not None:
+            self.client = db_client
+        else:
+            # Подключение к настоящей MongoDB
+            self.client = self._make_client(mongo_uri, max_pool_size, timeout_ms, min_pool_size)
+        if reader_client is not None:
+            self.reader_client = reader_client
+        elif reader_uri:
+            self.reader_client = self._make_client(
+                reader_uri, reader_max_pool_size or max_pool_size, reader_timeout_ms or timeout_ms,
+                min_pool_size if reader_min_pool_size is None else reader_min_pool_size
+            )
+        else:
+            self.reader_client = self.client
+        # Используем/создаём БД и коллекцию
+        self.db = self.client[db_name] # self.db: используемая база данных (по умолчанию "expenses_db")
+        self.collection = self.db[collection_name] # self.collection: коллекция (по умолчанию "expenses"), где хранятся документы трат
+        # Коллекция трат для аналитических запросов — через клиента чтения и с его предпочтением чтения
+        self.read_db = self.reader_client[db_name]
+        self.read_collection = self._with_read_preference(self.read_db[collection_name], read_preference, max_staleness_seconds)
+        # Скетчи распределения сумм трат по (месяц, категория) для процентилей без сканирования трат
+        self.sketches = SketchStore(
+            self.db[sketches_collection_name],
+            read_collection=self._with_read_preference(self.read_db[sketches_collection_name], read_preference, max_staleness_seconds)
+        )
+
+    def _make_client(self, uri, pool_size, timeout_ms, min_pool_size=0):
+        """
+        Создаёт pymongo.MongoClient с заданными размерами пула и таймаутами.
+        Открытые соединения пула считает слушатель событий (см. warm_up).
+        """
+        from pymongo import MongoClient
+
+        counter = _connection_counter()
+        client = MongoClient(
+            uri,
+            maxPoolSize=pool_size,
+            minPoolSize=min_pool_size,
+            serverSelectionTimeoutMS=timeout_ms,
+            connectTimeoutMS=timeout_ms,
+            socketTimeoutMS=timeout_ms,
+            event_listeners=[counter]
+        )
+        self._pools.append((client, counter, min_pool_size))
+        return client
 
-    def get_top_category(self, month):
+    @staticmethod
+    def _with_read_preference(collection, read_preference, max_staleness_seconds):
+        """
+        Возвращает коллекцию с заданным предпочтением чтения ('primary', 'primaryPreferred',
+        'secondary', 'secondaryPreferred', 'nearest') и допустимым отставанием реплик.
+        """
+        from pymongo import read_preferences
+
+        modes = {
+            'primary': read_preferences.Primary,
+            'primaryPreferred': read_preferences.PrimaryPreferred,
+            'secondary': read_preferences.Secondary,
+            'secondaryPreferred': read_preferences.SecondaryPreferred,
+            'nearest': read_preferences.Nearest
+        }
+        if read_preference not in modes:
+            raise ValueError(f"Неизвестное предпочтение чтения: '{read_preference}'")
+        if read_preference == 'primary':
+            preference = read_preferences.Primary()
+        else:
+            preference = modes[read_preference](max_staleness=-1 if max_staleness_seconds is None else max_staleness_seconds)
+        return collection.with_options(read_preference=preference)
+
+    def _ensure_indexes(self):
+        """
+        Создаёт индексы коллекции при первой необходимости, а не в конструкторе,
+        чтобы создание ExpenseTracker не требовало доступной MongoDB.
+
+        Уникальный разреженный индекс по ключу идемпотентности гарантирует,
+        что повтор запроса с тем же ключом не создаст вторую запись даже из другого процесса.
+        Индекс по словам названия (multikey) обслуживает поиск search_expenses,
+        индекс (месяц, категория, сумма) — аналитику за месяц.
+        Такие же индексы с владельцем (u) на первом месте обслуживают запросы одного пользователя:
+        их стоимость зависит от числа его трат, а не от общего числа пользователей.
+        Индексы по полям версии 1 нужны, пока в коллекции есть такие документы.
+        """
+        if self._indexes_ready:
+            return
+        self.collection.create_index("k", unique=True, sparse=True)
+        self.collection.create_index("t")
+        self.collection.create_index([("m", 1), ("c", 1), ("a", -1)])
+        self.collection.create_index([("u", 1), ("m", 1), ("c", 1), ("a", -1)])
+        self.collection.create_index([("u", 1), ("t", 1)])
+        self.collection.create_index([("u", 1), ("_id", 1)])
+        if self.legacy_reads:
+            self.collection.create_index("idempotency_key", unique=True, sparse=True)
+            self.collection.create_index("tokens")
+        self._indexes_ready = True
+
+    def _encode(self, document):
+        """Преобразует документ траты (версия 1) в схему, в которой пишет этот трекер"""
+        if self.schema_version == schema.SCHEMA_VERSION:
+            return schema.encode(document)
+        return document
+
+    def _tenant_conditions(self, tenant):
+        """Список условий запроса, ограничивающих выборку тратами владельца tenant (пустой, если он не задан)"""
+        if tenant is None:
+            return []
+        return [schema.field_query("tenant", tenant, self.legacy_reads)]
+
+    def _insert(self, expense, tenant, idempotency_key, expense_id):
+        """
+        Вставляет документ траты в MongoDB и учитывает её в скетчах и кэше аналитики.
+        Если трата с ключом idempotency_key уже есть (вставку отклонил уникальный индекс
+        или ключ найден в документе другой версии схемы), возвращает сообщение по исходной записи.
+        expense_id становится _id документа: повторную вставку отклоняет уникальный индекс _id,
+        и ответ тоже строится по исходной записи.
+        """
+        from pymongo.errors import DuplicateKeyError
+
+        self._ensure_indexes()
+
+        document = expense.as_dict()
+        if tenant is not None:
+            document["tenant"] = tenant
+        if expense_id:
+            from bson import ObjectId
+
+            document["_id"] = ObjectId(expense_id)
+
+        if not idempotency_key:
+            # Вставляем документ в MongoDB
+            try:
+                self.collection.insert_one(self._encode(document))
+            except DuplicateKeyError:
+                original = self.collection.find_one({"_id": document["_id"]}) if expense_id else None
+                if original is None:
+                    raise
+                return self._original_message(original)
+            self._record_sketch(expense, tenant)
+            self._record_change(expense, tenant)
+            return self._success_message(expense)
+
+        document["idempotency_key"] = idempotency_key
+        key_query = schema.field_query("idempotency_key", idempotency_key, self.legacy_reads)
+        # Ключ мог быть сохранён в документе другой версии схемы — уникальный индекс этого не увидит
+        original = self.collection.find_one(key_query) if self.legacy_reads else None
+        if original is None:
+            try:
+                self.collection.insert_one(self._encode(document))
+                self._record_sketch(expense, tenant)
+                self._record_change(expense, tenant)
+                msg = self._success_message(expense)
+            except DuplicateKeyError:
+                original = self.collection.find_one(key_query)
+                if original is None and expense_id:
+                    # Вставку отклонил индекс _id: трата с этим expense_id сохранена с другим ключом
+                    original = self.collection.find_one({"_id": document["_id"]})
+                if original is None:
+                    # Исходная запись не найдена (например, удалена между вставкой и поиском)
+                    raise
+        if original is not None:
+            # Запись с этим ключом уже есть — возвращаем ответ по исходной записи
+            msg = self._original_message(original)
+        return msg
+
+    def _original_message(self, original):
+        """Сообщение об успешной вставке по уже сохранённому документу траты (любой версии схемы)"""
+        original = schema.decode(original)
+        return self._success_message(Expense(original["name"], original["category"], original["amount"], original["date"]))
+
+
+    def _record_sketch(self, expense, tenant=None):
+        """
+        Учитывает сумму новой траты в скетче её владельца, месяца и категории.
+        Вызывается после вставки траты: ошибка обновления скетча только записывается в лог,
+        иначе клиент получил бы ошибку для уже сохранённой траты и повторил бы запрос.
+        Пропущенную сумму вернёт пересчёт скетчей (rebuild_sketches).
+        """
+        try:
+            self.sketches.add(expense.get_month(), expense.category, expense.amount, tenant)
+        except Exception:
+            logger.exception("Не удалось обновить скетч для сохранённой траты")
+
+    def enable_analytics_cache(self, change_feed, maxsize=1024, ttl=300, consistent_reads=False):
+        """
+        Включает кэш результатов get_top_category и get_max_expense.
+
+        Кэш согласован между процессами через change_feed (change_feed.ChangeFeed):
+        при добавлении траты любым процессом вытесняются ровно ключи её месяца и категории
+        (для её владельца и для запросов по всем владельцам). ttl (в секундах) ограничивает
+        время жизни записи на случай пропущенного уведомления.
+
+        Кэшируемые запросы, как и остальная аналитика, идут через клиента чтения. Уведомление приходит
+        после записи на основной сервер, поэтому результат, посчитанный на отстающей реплике сразу после
+        вытеснения, может остаться в кэше устаревшим — не дольше ttl (отставание реплики ограничивает
+        max_staleness_seconds). Если нужна согласованность сразу после вытеснения, consistent_reads=True
+        отправляет кэшируемые запросы на основной сервер (клиент записи) — ценой нагрузки на него.
+        """
+        self.analytics_cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._cache_consistent_reads = consistent_reads
+        self.change_feed = change_feed
+        change_feed.subscribe(self.evict_analytics)
+
+    def start_analytics_cache(self, maxsize=1024, ttl=300, mode='auto', consistent_reads=False):
+        """
+        Запускает уведомления об изменениях своей коллекции (change_feed.ChangeFeed, коллекция версий
+        cache_versions в той же базе) и включает кэш аналитики (enable_analytics_cache с теми же параметрами).
+        Если уведомления запустить не удалось, исключение пробрасывается, а кэш остаётся выключенным:
+        без уведомлений результаты устаревают, как только трату добавит другой процесс.
+        Возвращает запущенный ChangeFeed.
+        """
+        from change_feed import ChangeFeed
+
+        change_feed = ChangeFeed(self.collection, self.db['cache_versions'], mode=mode)
+        change_feed.start()
+        self.enable_analytics_cache(change_feed, maxsize, ttl, consistent_reads)
+        logger.info(f"Кэш аналитики включён, уведомления об изменениях: {change_feed.mode}")
+        return change_feed
+
+    def evict_analytics(self, tenant, month, category):
+        """Вытесняет из кэша аналитики результаты, которые зависят от трат месяца month и категории category"""
+        if self.analytics_cache is None:
+            return
+        with self._computing_lock:
+            for owner in {tenant, None}:
+                for key in (("top", owner, month), ("max", owner, month, category)):
+                    # Идущее вычисление по этому ключу могло прочитать данные до изменения — его результат не сохранится
+                    self._computing.pop(key, None)
+                    self.analytics_cache.pop(key)
+
+    def warm_up(self, month=None, timeout=10.0):
+        """
+        Готовит трекер к запросам до того, как сервер начнёт их принимать.
+
+        Проверяет доступность MongoDB, дожидается (не дольше timeout секунд), пока пулы созданных трекером
+        клиентов откроют min_pool_size соединений, создаёт индексы и выполняет аналитические запросы
+        за месяц month (строка 'mm', по умолчанию — текущий): категорию с максимальной тратой,
+        максимальную трату каждой категории и процентили.
+        Если включён кэш аналитики, первые запросы пользователей получат результаты из него;
+        в любом случае MongoDB заранее поднимает в память нужные индексы и документы.
+        Ошибки подключения пробрасываются вызывающему; незаполненный к сроку пул — только предупреждение.
+        """
+        month = month or f"{datetime.date.today().month:02d}"
+        self.client.admin.command('ping')
+        if self.reader_client is not self.client:
+            self.reader_client.admin.command('ping')
+        deadline = time.monotonic() + timeout
+        for _, counter, min_pool_size in self._pools:
+            while counter.open_connections < min_pool_size:
+                if time.monotonic() >= deadline:
+                    logger.warning(f"Пул соединений не заполнился за {timeout} с: "
+                                   f"открыто {counter.open_connections} из {min_pool_size}")
+                    break
+                time.sleep(0.05)
+        self._ensure_indexes()
+
+        month_query = self._month_query(month)
+        categories = set(self.read_collection.distinct("c", month_query))
+        if self.legacy_reads:
+            categories |= set(self.read_collection.distinct("category", month_query))
+        self.get_top_category(month)
+        for category in categories:
+            self.get_max_expense(month, category)
+        self.get_percentiles([month])
+
+    def _record_change(self, expense, tenant=None):
+        """Вытесняет устаревшие результаты из своего кэша и сообщает о трате другим процессам"""
+        if self.change_feed is None:
+            return
+        self.evict_analytics(tenant, expense.get_month(), expense.category)
+        # Как и скетч, уведомление отправляется после вставки — его ошибка не должна провалить запрос
+        try:
+            self.change_feed.publish(tenant, expense.get_month(), expense.category)
+        except Exception:
+            logger.exception("Не удалось отправить уведомление о сохранённой трате")
+
+    def _cached(self, key, compute):
+        """
+        Возвращает результат compute() из кэша аналитики или вычисляет и запоминает его.
+        Результат не запоминается, если во время вычисления пришло уведомление об изменениях этого ключа
+        (evict_analytics снимает метку вычисления): он мог быть посчитан по данным до изменения.
+        Уведомления о других ключах на вычисление не влияют.
+        """
+        if self.analytics_cache is None:
+            return compute()
+        result = self.analytics_cache.get(key, _MISSING)
+        if result is not _MISSING:
+            return result
+        token = object()
+        with self._computing_lock:
+            self._computing[key] = token
+        try:
+            result = compute()
+        except Exception:
+            with self._computing_lock:
+                if self._computing.get(key) is token:
+                    del self._computing[key]
+            raise
+        with self._computing_lock:
+            if self._computing.get(key) is token:
+                del self._computing[key]
+                self.analytics_cache.set(key, result)
+        return result
+
+    def _analytics_collection(self):
+        """
+        Коллекция для кэшируемых аналитических запросов: через клиента чтения, а при включённом кэше
+        с consistent_reads — на основном сервере (см. enable_analytics_cache).
+        """
+        return self.collection if self._cache_consistent_reads else self.read_collection
+
+    @staticmethod
+    def _parse_cursor(after):
+        """Преобразует курсор страницы (строку из предыдущего ответа) в значение _id"""
+        from bson import ObjectId
+
+        if not ObjectId.is_valid(after):
+            raise ValueError(f"Некорректный курсор страницы: '{after}'")
+        return ObjectId(after)
+
+    def _record_projection(self, fields):
+        """
+        Проекция для get_full_records: _id и запрошенные поля траты
+        либо, если fields не задан, все поля кроме служебных и поля владельца
+        (оно совпадает с tenant запроса, а без tenant раскрыло бы, чьи это траты).
+        """
+        if not fields:
+            return {"tokens": 0, "idempotency_key": 0, "tenant": 0, "t": 0, "k": 0, "u": 0}
+        self._check_fields(fields)
+        return schema.projection(fields)
+
+    def get_full_records(self, after=None, limit=None, month=None, category=None, fields=None, tenant=None):
+        """
+        Возвращает список затрат из коллекции, по умолчанию — все.
+
+        Постраничная выдача по ключу (keyset pagination): записи упорядочены по _id,
+        after — курсор (строковое значение _id последней записи предыдущей страницы),
+        limit — размер страницы. В отличие от skip, следующая страница читается
+        диапазоном по индексу _id и не требует пропуска уже выданных записей.
+
+        month, category — фильтры по месяцу и категории,
+        fields — список полей траты из RECORD_FIELDS, которые нужно вернуть (_id возвращается всегда).
+        При некорректном курсоре или неизвестном поле выбрасывается ValueError.
+        Записи возвращаются в виде версии 1 схемы независимо от того, как они хранятся.
+        """
+        conditions = self._tenant_conditions(tenant)
+        if after:
+            conditions.append({"_id": {"$gt": self._parse_cursor(after)}})
+        if month:
+            conditions.append(self._month_query(month))
+        if category:
+            conditions.append(schema.field_query("category", category.capitalize(), self.legacy_reads))
+        query = {"$and": conditions} if conditions else {}
+        cursor = self.read_collection.find(query, self._record_projection(fields)).sort("_id", 1)
+        if limit:
+            cursor = cursor.limit(limit)
+        return [schema.decode(doc) for doc in cursor]
+
+    def _month_query(self, month):
+        """Условие запроса на документы трат за месяц month (с ведущим нулём или без)"""
+        return schema.month_query(month, self.legacy_reads)
+
+    def search_expenses(self, query, month=None, category=None, limit=50, tenant=None):
+        """
+        Ищет траты по названию: все слова запроса, кроме последнего, должны совпасть со словами
+        названия целиком, а последнее — как префикс (поиск "по мере ввода").
+        Регистр не учитывается. Дополнительно можно ограничить месяц и категорию.
+
+        Запрос обслуживается индексом по словам названия: для префикса используется
+        регулярное выражение с якорем ^, которое MongoDB выполняет как диапазон по индексу.
+        Возвращает список трат (без служебных полей), не более limit штук (от 1 до MAX_SEARCH_LIMIT).
+        """
+        self._check_search_limit(limit)
+        words = search_tokens(query)
+        if not words:
+            return []
+        self._ensure_indexes()
+        conditions = self._tenant_conditions(tenant)
+        conditions += [schema.field_query("tokens", word, self.legacy_reads) for word in words[:-1]]
+        conditions.append(schema.field_query("tokens", {"$regex": "^" + re.escape(words[-1])}, self.legacy_reads))
+        if month:
+            conditions.append(self._month_query(month))
+        if category:
+            conditions.append(schema.field_query("category", category.capitalize(), self.legacy_reads))
+        cursor = self.read_collection.find(
+            {"$and": conditions},
+            schema.projection(self.RECORD_FIELDS)
+        ).sort("_id", 1).limit(limit)
+        return [self._public_fields(schema.decode(doc)) for doc in cursor]
+
+    def backfill_search_tokens(self, batch_size=500):
+        """
+        Заполняет слова названия у трат, добавленных до появления поиска: поле tokens у документов версии 1
+        и поле t у документов версии 2 (если такие документы перевели в компактную схему без слов).
+        Обрабатывает документы пачками по batch_size; повторный запуск продолжает с оставшихся.
+        Возвращает число обновлённых документов.
+        """
+        from pymongo import UpdateOne
+
+        updated = 0
+        for query, name, field in (
+            ({"tokens": {"$exists": False}, "v": {"$exists": False}}, "name", "tokens"),
+            ({"t": {"$exists": False}, "v": schema.SCHEMA_VERSION}, "n", "t")
+        ):
+            while True:
+                batch = list(self.collection.find(query, {name: 1}).limit(batch_size))
+                if not batch:
+                    break
+                self.collection.bulk_write([
+                    UpdateOne({"_id": doc["_id"]}, {"$set": {field: search_tokens(doc.get(name, ""))}})
+                    for doc in batch
+                ])
+                updated += len(batch)
+        return updated
+
+    def get_top_category(self, month, tenant=None):
         """
         Находит категорию с максимальной суммарной тратой за указанный месяц.
 
         Формирование pipeline для MongoDB:
 
         1) $match:
-           Фильтруем документы по полю "date", чтобы месяц в дате совпадал с заданным.
-           Используется регулярное выражение для проверки формата "dd.mm",
-           где "mm" — переданный месяц (с ведущим нулём, например '07').
+           Фильтруем документы по месяцу: по полю "m" в компактной схеме
+           и регулярным выражением по полю "date" вида "dd.mm" в документах версии 1.
+           Если задан tenant — только траты этого владельца.
 
         2) $group:
-           Группируем документы по категории ("category").
-           Считаем сумму "amount" для каждой категории (поле "total").
+           Группируем документы по категории.
+           Считаем сумму трат в копейках для каждой категории (поле "total") —
+           в целых числах, без накопления ошибки округления.
 
         3) $sort:
            Сортируем категории по убыванию суммы "total" — чтобы самая большая была первой.
@@ -135,22 +752,16 @@ class ExpenseTracker:
            Ограничиваем результат одним элементом — самой "тяжёлой" категорией.
 
         После выполнения агрегирования возвращаем категорию или None, если нет данных.
+        Если включён кэш аналитики (enable_analytics_cache), результат берётся из него.
         """
-        # Делаем так, чтобы месяц был в формате 2 символов
-        month = month.zfill(2)
         pipeline = [
+            # Фильтр по владельцу и месяцу (с ведущим нулём или без)
+            { "$match": { "$and": self._tenant_conditions(tenant) + [self._month_query(month)] } },
             {
-                # В фильтре применяем регулярное выражение для подбора даты с нужным месяцем.
-                # ^\d{2}\. означает: два любых символа (число дня), точка, затем месяц
-                "$match": {
-                    "date": { "$regex": r"^\d{1,2}\." + month + r"$" }
-                }
-            },
-            {
-                # Группируем по категории, суммируя значения amount
+                # Группируем по категории, суммируя суммы трат в копейках
                 "$group": {
-                    "_id": "$category", # сгруппировать по категории
-                    "total": { "$sum": "$amount" } # суммируем поле amount в total
+                    "_id": schema.CATEGORY_EXPR if self.legacy_reads else "$c", # сгруппировать по категории
+                    "total": { "$sum": schema.AMOUNT_MINOR_EXPR if self.legacy_reads else "$a" } # суммируем в total
                 }
             },
             # Сортируем по total в порядке убывания
@@ -159,41 +770,95 @@ class ExpenseTracker:
             { "$limit": 1 }
         ]
 
-        # Выполнение агрегации в MongoDB
-        result = list(self.collection.aggregate(pipeline))
-        if not result: # если ничего не найдено — возвращаем None
-            return None
-        return result[0]['_id'] # Возвращаем название категории
+        def compute():
+            # Выполнение агрегации в MongoDB
+            result = list(self._analytics_collection().aggregate(pipeline))
+            if not result: # если ничего не найдено — возвращаем None
+                return None
+            return result[0]['_id'] # Возвращаем название категории
 
-    def get_max_expense(self, month, category):
+        return self._cached(("top", tenant, month.zfill(2)), compute)
+
+    def get_max_expense(self, month, category, tenant=None):
         """
         Находит максимальную по сумме трату в указанном месяце и категории.
 
-        Формируем запрос (query) с фильтрацией по категории и дате
-
-        Выполняем запрос find_one с сортировкой по убыванию поля "amount",
-        чтобы получить максимальную по сумме трату.
+        Формируем условие с фильтрацией по категории и месяцу и выполняем агрегацию
+        с сортировкой по убыванию суммы, чтобы получить максимальную по сумме трату.
+        Пока в коллекции могут быть документы версии 1, сумма приводится к копейкам
+        ($addFields), чтобы документы обеих версий сравнивались по одной шкале.
 
-        Если документ найден — возвращаем его (без поля _id).
+        Если документ найден — возвращаем его (без поля _id и служебных полей).
         Если нет — возвращаем None.
+        Если включён кэш аналитики (enable_analytics_cache), результат берётся из него.
         """
         # Приводим параметры к единому формату
-        month = month.zfill(2)
         category = category.capitalize()
-        # Выполняем запрос с условиями
-        query = {
-            "category": category,
-            "date": { "$regex": r"^\d{1,2}\." + month + r"$" }
-        }
-        # Ищем один документ, сортируя по amount в порядке убывания
-        expense = self.collection.find_one(
-            query,
-            sort=[("amount", -1)]
-        )
-        if not expense:
+        pipeline = [
+            { "$match": { "$and": self._tenant_conditions(tenant) + [
+                self._month_query(month),
+                schema.field_query("category", category, self.legacy_reads)
+            ] } }
+        ]
+        if self.legacy_reads:
+            pipeline.append({ "$addFields": { "a": schema.AMOUNT_MINOR_EXPR } })
+        # Сортируем по сумме в порядке убывания и берём один документ
+        pipeline += [{ "$sort": { "a": -1 } }, { "$limit": 1 }]
+
+        def compute():
+            result = list(self._analytics_collection().aggregate(pipeline))
+            if not result:
+                return None
+            # Возвращаем словарь с данными траты
+            return self._public_fields(schema.decode(result[0]))
+
+        return self._cached(("max", tenant, month.zfill(2), category), compute)
+
+    def get_percentiles(self, months=None, category=None, quantiles=DEFAULT_QUANTILES, tenant=None):
+        """
+        Возвращает приближённые процентили сумм трат по скетчам, без сканирования документов трат.
+
+        months — список месяцев (с ведущим нулём или без), None — все месяцы;
+        category — категория (без учёта регистра), None — все категории.
+        Скетчи выбранных пар (месяц, категория) сливаются в один.
+
+        Результат — словарь вида {"p50": ..., "p90": ..., "p99": ..., "count": ...}
+        или None, если трат не найдено.
+        """
+        if months:
+            months = [month.zfill(2) for month in months]
+        if category:
+            category = category.capitalize()
+        digest = self.sketches.merged(months, category, tenant)
+        if not digest.count:
             return None
-        # Удаляем поле _id для удобства
-        if '_id' in expense:
-            del expense['_id']
-        # Возвращаем словарь с данными траты
-        return expense
+        result = {f"p{round(q * 100)}": digest.quantile(q) for q in quantiles}
+        result["count"] = digest.count
+        return result
+
+    def rebuild_sketches(self):
+        """
+        Пересчитывает скетчи по всем тратам коллекции.
+        Нужен один раз для трат, добавленных до появления скетчей (или после сбоя обновления скетча).
+
+        Пересчитываются траты с _id не больше последнего на момент начала; траты с большим _id
+        досчитываются в новые скетчи после их замены (см. SketchStore.rebuild).
+
+        Ограничения: пересчёт рассчитан на время без записи трат (или с редкими записями). Если траты
+        пишутся одновременно, часть из них может не попасть в новые скетчи:
+         - _id, созданные другими процессами, не монотонны: трата с _id меньше последнего, вставленная
+           после того, как курсор прошёл её место, не попадёт ни в пересчёт, ни в досчёт;
+         - суммы, добавленные в старые скетчи между досчётом и заменой коллекции, пропадут вместе с ней.
+        Повторный пересчёт в спокойное время исправляет оба случая.
+        """
+        fields = schema.projection(["category", "amount", "date", "tenant"])
+        last = self.collection.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+        if last is None:
+            self.sketches.rebuild([])
+            return
+        documents = self.collection.find({"_id": {"$lte": last["_id"]}}, fields)
+
+        def added_since():
+            return [schema.decode(doc) for doc in self.collection.find({"_id": {"$gt": last["_id"]}}, fields)]
+
+        self.sketches.rebuild((schema.decode(doc) for doc in documents), added_since)
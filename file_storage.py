@@ -0,0 +1,451 @@
+import bisect
+import datetime
+import logging
+import mmap
+import os
+import struct
+import threading
+from array import array
+
+from expenses import BaseExpenseTracker, search_tokens
+from sketches import DEFAULT_QUANTILES, TDigest
+
+logger = logging.getLogger('File Storage')
+
+# Формат одной записи фиксированной ширины:
+# имя (64 байта utf-8), категория (32 байта utf-8), сумма (float64), день (uint8), месяц (uint8)
+RECORD = struct.Struct('<64s32sdBB')
+NAME_SIZE = 64
+CATEGORY_SIZE = 32
+
+# Заголовки файлов, чтобы не открыть по ошибке чужой файл
+SEGMENT_MAGIC = b'EXPSEG01'
+INDEX_MAGIC = b'EXPIDX02'
+
+# Тип элементов индекса месяца — номер записи, 4 байта в порядке байт машины
+# (индекс — локальный файл, его можно пересоздать по сегменту)
+INDEX_TYPECODE = 'I' if array('I').itemsize == 4 else 'L'
+
+# Сколько записей читается из mmap за раз при полном проходе по сегменту
+SCAN_CHUNK = 4096
+
+
+class FileStorage:
+    """
+    Локальное хранилище трат в виде append-only файла сегмента.
+
+    Каждая трата — запись фиксированной ширины, которая дописывается в конец файла сегмента.
+    Чтение идёт через mmap без копирования всего файла в память.
+    Рядом с сегментом для каждого месяца лежит файл индекса (path + '.MM.idx') —
+    массив номеров записей этого месяца. При старте массивы читаются целиком (array.fromfile),
+    а сегмент дочитывается только в хвосте, если индекс отстал (например, после сбоя).
+    """
+
+    def __init__(self, path, fsync=True):
+        """
+        path — путь к файлу сегмента, индексы месяцев хранятся в файлах path + '.MM.idx'.
+        fsync — сбрасывать ли сегмент на диск после каждой записи (сегмент — источник истины,
+        индекс можно восстановить, поэтому для него fsync не делается).
+        """
+        self.path = path
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._mmap = None
+        self._mapped_records = 0
+        # Число незавершённых переборов (scan): пока они есть, close не закрывает отображение
+        self._readers = 0
+        self._closed = False
+
+        self._segment = self._open(self.path, SEGMENT_MAGIC)
+
+        # Если последняя запись сегмента была записана не полностью — отбрасываем её
+        self.count = (os.fstat(self._segment.fileno()).st_size - len(SEGMENT_MAGIC)) // RECORD.size
+        self._segment.truncate(len(SEGMENT_MAGIC) + self.count * RECORD.size)
+        self._segment.seek(0, os.SEEK_END)
+
+        self._index_files = {}
+        self._load_index()
+
+    @staticmethod
+    def _open(path, magic):
+        """Открывает (или создаёт) файл и проверяет его заголовок"""
+        mode = 'r+b' if os.path.exists(path) else 'w+b'
+        f = open(path, mode)
+        header = f.read(len(magic))
+        if not header:
+            f.write(magic)
+            f.flush()
+        elif header != magic:
+            f.close()
+            raise ValueError(f"Файл '{path}' не является файлом хранилища трат")
+        return f
+
+    def _index_path(self, month):
+        return f"{self.path}.{month:02d}.idx"
+
+    def _index_file(self, month):
+        """Файл индекса месяца, открытый для дописывания (создаётся при первой трате месяца)"""
+        f = self._index_files.get(month)
+        if f is None:
+            f = self._index_files[month] = self._open(self._index_path(month), INDEX_MAGIC)
+            f.seek(0, os.SEEK_END)
+        return f
+
+    def _load_index(self):
+        """
+        Читает массивы номеров записей по месяцам из файлов индекса.
+        Номера, которым нет соответствия в сегменте (запись отброшена при старте), удаляются.
+        Записи сегмента после последней проиндексированной дочитываются и дописываются в индекс.
+        Если в индексе не хватает записей в середине (индекс повреждён или от другой версии),
+        он строится заново по всему сегменту.
+        """
+        self.months = {}
+        for month in range(1, 13):
+            if not os.path.exists(self._index_path(month)):
+                continue
+            f = self._index_file(month)
+            size = f.tell() - len(INDEX_MAGIC)
+            offsets = array(INDEX_TYPECODE)
+            f.seek(len(INDEX_MAGIC))
+            offsets.fromfile(f, size // offsets.itemsize)
+            del offsets[bisect.bisect_left(offsets, self.count):]
+            f.seek(len(INDEX_MAGIC) + len(offsets) * offsets.itemsize)
+            f.truncate()
+            self.months[month] = offsets
+
+        indexed = max((offsets[-1] + 1 for offsets in self.months.values() if offsets), default=0)
+        if sum(len(offsets) for offsets in self.months.values()) != indexed:
+            for f in self._index_files.values():
+                f.seek(len(INDEX_MAGIC))
+                f.truncate()
+            self.months = {}
+            indexed = 0
+
+        # Дочитываем хвост сегмента, который не попал в индекс
+        tail = {}
+        for number, record in self._scan_all(self._view(), indexed, self.count):
+            tail.setdefault(record[4], array(INDEX_TYPECODE)).append(number)
+        for month, numbers in tail.items():
+            self.months.setdefault(month, array(INDEX_TYPECODE)).extend(numbers)
+            numbers.tofile(self._index_file(month))
+        for f in self._index_files.values():
+            f.flush()
+
+    def _view(self):
+        """
+        Возвращает mmap сегмента, переотображая файл, если он вырос с прошлого чтения.
+        Старое отображение не закрывается явно: его может ещё читать другой поток,
+        оно освободится, когда на него не останется ссылок.
+        """
+        if self._mmap is None or self._mapped_records < self.count:
+            self._mmap = mmap.mmap(self._segment.fileno(), 0, access=mmap.ACCESS_READ)
+            self._mapped_records = self.count
+        return self._mmap
+
+    @staticmethod
+    def _scan_all(view, start, stop):
+        """
+        Перебирает записи с номерами от start до stop подряд: из mmap view читаются блоки по SCAN_CHUNK
+        записей и разбираются RECORD.iter_unpack — без отдельного вызова на каждую запись.
+        """
+        base = len(SEGMENT_MAGIC)
+        for chunk_start in range(start, stop, SCAN_CHUNK):
+            chunk_stop = min(stop, chunk_start + SCAN_CHUNK)
+            chunk = view[base + chunk_start * RECORD.size:base + chunk_stop * RECORD.size]
+            yield from enumerate(RECORD.iter_unpack(chunk), chunk_start)
+
+    def scan(self, month=None, after=None):
+        """
+        Перебирает записи в сыром виде — пары (номер, (имя, категория, сумма, день, месяц)),
+        где имя и категория — байты utf-8, дополненные нулями до ширины поля.
+        Для аналитики: записи не превращаются в словари и строки не декодируются.
+        month — номер месяца (1-12): читаются только записи из индекса месяца;
+        after — номер записи, после которой начинать перебор (для постраничной выдачи).
+        """
+        start = 0 if after is None else after + 1
+        with self._lock:
+            if self._closed:
+                raise ValueError("Хранилище закрыто")
+            count = self.count
+            if month is not None:
+                offsets = self.months.get(month, array(INDEX_TYPECODE))
+                numbers = offsets[bisect.bisect_left(offsets, start):]
+            view = self._view()
+            self._readers += 1
+        try:
+            if month is None:
+                yield from self._scan_all(view, start, count)
+                return
+            base = len(SEGMENT_MAGIC)
+            unpack = RECORD.unpack_from
+            for number in numbers:
+                yield number, unpack(view, base + number * RECORD.size)
+        finally:
+            with self._lock:
+                self._readers -= 1
+                if self._closed and not self._readers:
+                    self._unmap()
+
+    @staticmethod
+    def decode(number, record):
+        """Преобразует сырую запись в словарь того же вида, что и документ в MongoDB"""
+        name, category, amount, day, month = record
+        return {
+            "_id": number,
+            "name": name.rstrip(b'\0').decode('utf-8'),
+            "category": category.rstrip(b'\0').decode('utf-8'),
+            "amount": amount,
+            "date": f"{day:02d}.{month:02d}"
+        }
+
+    @staticmethod
+    def encode_text(value, size, field):
+        """Кодирует строку в utf-8 с проверкой, что она помещается в поле фиксированной ширины"""
+        data = value.encode('utf-8')
+        if len(data) > size:
+            raise ValueError(f"Поле '{field}' длиннее {size} байт в utf-8")
+        return data
+
+    def insert_one(self, document):
+        """
+        Дописывает трату в конец сегмента и обновляет индекс.
+        Принимает словарь вида Expense.as_dict() (см. FileExpenseTracker._insert).
+        Возвращает номер записи.
+        """
+        day, month = (int(part) for part in document["date"].split("."))
+        record = RECORD.pack(
+            self.encode_text(document["name"], NAME_SIZE, "name"),
+            self.encode_text(document["category"], CATEGORY_SIZE, "category"),
+            float(document["amount"]),
+            day,
+            month
+        )
+        with self._lock:
+            self._segment.write(record)
+            self._segment.flush()
+            if self.fsync:
+                os.fsync(self._segment.fileno())
+            number = self.count
+            index = self._index_file(month)
+            array(INDEX_TYPECODE, [number]).tofile(index)
+            index.flush()
+            self.months.setdefault(month, array(INDEX_TYPECODE)).append(number)
+            self.count += 1
+        return number
+
+    def iter_records(self, month=None, after=None):
+        """
+        Перебирает записи в виде словарей — все или только за указанный месяц (число 1-12).
+        Параметры — как у scan.
+        """
+        for number, record in self.scan(month, after):
+            yield self.decode(number, record)
+
+    def _unmap(self):
+        """Закрывает текущее отображение сегмента (вызывать под self._lock)"""
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def close(self):
+        """
+        Закрывает файлы хранилища. Если перебор записей ещё идёт в другом потоке,
+        отображение сегмента закроет последний завершившийся перебор.
+        """
+        with self._lock:
+            self._closed = True
+            if not self._readers:
+                self._unmap()
+            self._segment.close()
+            for f in self._index_files.values():
+                f.close()
+
+
+class FileExpenseTracker(BaseExpenseTracker):
+    """
+    Трекер трат, хранящий траты в локальном файле (FileStorage) вместо MongoDB.
+    Нужен на площадках, где MongoDB нет. Валидация при добавлении траты — та же, что в ExpenseTracker.
+    Ключи идемпотентности проверяются только по кэшу в памяти: уникального индекса в файле нет.
+    Владельцы трат (tenant) не поддерживаются: для каждого пользователя нужен отдельный файл.
+    Методы, которые есть только у ExpenseTracker (миграции, пересчёт скетчей), здесь не нужны:
+    скетчи не хранятся, а записи файла — одного формата.
+    """
+
+    def __init__(self, path, fsync=True, idempotency_cache_size=10000, idempotency_ttl=24 * 3600):
+        super().__init__(idempotency_cache_size, idempotency_ttl)
+        self.storage = FileStorage(path, fsync=fsync)
+
+    @staticmethod
+    def _check_tenant(tenant):
+        """В записи файла нет поля владельца, поэтому запросы с tenant отклоняются"""
+        if tenant is not None:
+            raise ValueError("Файловое хранилище не поддерживает разделение трат по пользователям")
+
+    @staticmethod
+    def validate_expense(name, category, amount, date):
+        """
+        Проверки ExpenseTracker и, кроме них, длина названия и категории:
+        в записи под них отведено NAME_SIZE и CATEGORY_SIZE байт utf-8 (кириллица — 2 байта на символ).
+        """
+        expense, error = BaseExpenseTracker.validate_expense(name, category, amount, date)
+        if error:
+            return None, error
+        if len(expense.name.encode('utf-8')) > NAME_SIZE:
+            return None, f"Ошибка: название длиннее {NAME_SIZE} байт в utf-8 (до {NAME_SIZE // 2} символов кириллицей)."
+        if len(expense.category.encode('utf-8')) > CATEGORY_SIZE:
+            return None, f"Ошибка: категория длиннее {CATEGORY_SIZE} байт в utf-8 (до {CATEGORY_SIZE // 2} символов кириллицей)."
+        return expense, None
+
+    def add_expense(self, name, category, amount, date, idempotency_key=None, tenant=None, expense_id=None):
+        """
+        Добавляет трату с той же валидацией, что и ExpenseTracker.add_expense.
+        Номер записи назначает файл, поэтому expense_id служит ключом идемпотентности в кэше в памяти,
+        если ключа клиента нет.
+        """
+        return super().add_expense(name, category, amount, date, idempotency_key or expense_id, tenant)
+
+    def _insert(self, expense, tenant, idempotency_key, expense_id):
+        """Дописывает трату в файл. Записи фиксированной ширины уже компактны, преобразование схемы не нужно"""
+        self._check_tenant(tenant)
+        self.storage.insert_one(expense.as_dict())
+        return self._success_message(expense)
+
+    def start_analytics_cache(self, maxsize=1024, ttl=300, mode='auto', consistent_reads=False):
+        """
+        Кэш аналитики не включается: файл пишет только этот процесс, а аналитика по месяцу
+        читает лишь записи месяца из индекса. Возвращает None (уведомлений об изменениях нет).
+        """
+        logger.info("Файловое хранилище: кэш аналитики не используется")
+        return None
+
+    def warm_up(self, month=None, timeout=10.0):
+        """
+        Прогрев перед приёмом запросов: читает записи месяца month (по умолчанию — текущего),
+        чтобы они оказались в страничном кэше ОС. timeout не используется (подключений нет).
+        """
+        month = month or datetime.date.today().month
+        self.get_top_category(str(month))
+
+    @staticmethod
+    def _month_number(month):
+        """Переводит месяц из строки ('5', '05') в число, для некорректного значения — 0 (такого месяца нет)"""
+        try:
+            return int(month)
+        except (TypeError, ValueError):
+            return 0
+
+    @staticmethod
+    def _category_field(category):
+        """
+        Категория в виде поля записи (байты utf-8, дополненные нулями) — для сравнения без декодирования.
+        Для категории, не помещающейся в поле, возвращает None: таких записей нет.
+        """
+        data = category.capitalize().encode('utf-8')
+        if len(data) > CATEGORY_SIZE:
+            return None
+        return data.ljust(CATEGORY_SIZE, b'\0')
+
+    @staticmethod
+    def _parse_cursor(after):
+        """Курсор страницы в файловом хранилище — номер записи"""
+        if not str(after).isdigit():
+            raise ValueError(f"Некорректный курсор страницы: '{after}'")
+        return int(after)
+
+    def get_full_records(self, after=None, limit=None, month=None, category=None, fields=None, tenant=None):
+        """
+        Возвращает список трат из файла с теми же параметрами, что и ExpenseTracker.get_full_records.
+        Курсор страницы — номер записи; для месяца записи выбираются по индексу месяцев.
+        """
+        self._check_tenant(tenant)
+        if fields:
+            self._check_fields(fields)
+        category_field = self._category_field(category) if category else None
+        after = self._parse_cursor(after) if after else None
+        if category and category_field is None:
+            return []
+        records = []
+        for number, record in self.storage.scan(self._month_number(month) if month else None, after):
+            if category_field is not None and record[1] != category_field:
+                continue
+            record = self.storage.decode(number, record)
+            if fields:
+                record = {"_id": record["_id"], **{field: record[field] for field in fields}}
+            records.append(record)
+            if limit and len(records) >= limit:
+                break
+        return records
+
+    def get_top_category(self, month, tenant=None):
+        """
+        Находит категорию с максимальной суммарной тратой за указанный месяц.
+        Суммы копятся по сырому полю категории, декодируется только результат.
+        """
+        self._check_tenant(tenant)
+        totals = {}
+        for _, (_, category, amount, _, _) in self.storage.scan(self._month_number(month)):
+            totals[category] = totals.get(category, 0) + amount
+        if not totals:
+            return None
+        return max(totals, key=totals.get).rstrip(b'\0').decode('utf-8')
+
+    def get_max_expense(self, month, category, tenant=None):
+        """Находит максимальную по сумме трату в указанном месяце и категории"""
+        self._check_tenant(tenant)
+        category_field = self._category_field(category)
+        best = None
+        for number, record in self.storage.scan(self._month_number(month)):
+            if record[1] == category_field and (best is None or record[2] > best[1][2]):
+                best = number, record
+        if best is None:
+            return None
+        best = self.storage.decode(*best)
+        del best["_id"]
+        return best
+
+    def get_percentiles(self, months=None, category=None, quantiles=DEFAULT_QUANTILES, tenant=None):
+        """
+        Возвращает приближённые процентили сумм трат, строя скетч по записям выбранных месяцев.
+        Записи других месяцев не читаются благодаря индексу по месяцам.
+        """
+        self._check_tenant(tenant)
+        month_numbers = [self._month_number(month) for month in months] if months else [None]
+        category_field = self._category_field(category) if category else None
+        if category and category_field is None:
+            return None
+        digest = TDigest()
+        for month in month_numbers:
+            for _, record in self.storage.scan(month):
+                if category_field is None or record[1] == category_field:
+                    digest.add(record[2])
+        if not digest.count:
+            return None
+        result = {f"p{round(q * 100)}": digest.quantile(q) for q in quantiles}
+        result["count"] = digest.count
+        return result
+
+    def search_expenses(self, query, month=None, category=None, limit=50, tenant=None):
+        """
+        Ищет траты по названию по тем же правилам, что и ExpenseTracker.search_expenses.
+        Отдельного индекса по словам нет: проверяются записи месяца (по индексу месяцев) или все записи.
+        """
+        self._check_tenant(tenant)
+        self._check_search_limit(limit)
+        words = search_tokens(query)
+        if not words:
+            return []
+        category_field = self._category_field(category) if category else None
+        if category and category_field is None:
+            return []
+        result = []
+        for number, record in self.storage.scan(self._month_number(month) if month else None):
+            if category_field is not None and record[1] != category_field:
+                continue
+            tokens = search_tokens(record[0].rstrip(b'\0').decode('utf-8'))
+            if all(word in tokens for word in words[:-1]) and any(t.startswith(words[-1]) for t in tokens):
+                record = self.storage.decode(number, record)
+                del record["_id"]
+                result.append(record)
+                if len(result) >= limit:
+                    break
+        return result
@@ -1,12 +1,12 @@
-import json
 import logging
+import threading
 
-# noinspection PyUnresolvedReferences
-from bson.json_util import dumps
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from urllib.parse import parse_qs, urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-from expenses import ExpenseTracker
+from admission import AdmissionController
+from resilience import CircuitBreaker, SnapshotStore, Spool
+from routes import Router, SyncBackend, encode_body, error, run_sync
+from server_config import make_tracker, parse_args
 
 # Инициализация логгера
 logging.basicConfig(
@@ -19,10 +19,54 @@ logging.basicConfig(
 )
 logger = logging.getLogger('HTTP Server')
 
-# Инициализация объекта ExpenseTracker, который хранит и обрабатывает данные о тратах
-tracker = ExpenseTracker()
+# Объект ExpenseTracker, который хранит и обрабатывает данные о тратах.
+# Создаётся при первом обращении (get_tracker), а не при импорте модуля: импорт не открывает соединений с MongoDB
+tracker = None
+_tracker_lock = threading.Lock()
+
+# Число разделов: если задано, пользователи распределяются по коллекциям expenses_0, expenses_1, ...
+# (partitioning.PartitionedExpenseTracker), и сервер работает в многопользовательском режиме
+partitions = None
+
+# Путь к файлу трат: если задан, траты хранятся в локальном файле (file_storage.FileExpenseTracker), а не в MongoDB
+storage_path = None
+
+# Параметры подключения к MongoDB для конструктора ExpenseTracker: адрес, клиент чтения, пулы, таймауты,
+# предпочтение чтения (см. server_config.MONGO_OPTIONS); по умолчанию — значения ExpenseTracker
+tracker_options = {}
+
+# Контроль допуска: лимиты одновременных запросов на чтение/запись и частоты запросов клиента
+admission = AdmissionController()
+
+# Многопользовательский режим: каждый запрос (кроме /metrics) обязан указать пользователя в X-Tenant-Id
+multi_tenant = False
+
+# Деградированный режим при недоступности MongoDB: автомат-размыкатель со сроком на каждый вызов tracker,
+# снимок последних успешных ответов аналитики и локальная очередь трат для последующей записи
+# Пул автомата вмещает все запросы, пропущенные контролем допуска: иначе они ждали бы потока в очереди
+breaker = CircuitBreaker(max_workers=admission.total_limit)
+snapshots = SnapshotStore('analytics_snapshot.json')
+spool = Spool('expenses.spool')
+
+def get_tracker():
+    """
+    Возвращает общий ExpenseTracker, создавая его при первом вызове.
+    Создание защищено блокировкой с двойной проверкой: одновременные первые запросы
+    из разных потоков получат один и тот же объект.
+    Вид трекера задают storage_path и partitions (см. server_config.make_tracker).
+    """
+    global tracker
+    if tracker is None:
+        with _tracker_lock:
+            if tracker is None:
+                tracker = make_tracker(partitions, storage_path, tracker_options)
+    return tracker
 
 class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
+    """
+    Класс обработчика HTTP-запросов, наследуется от BaseHTTPRequestHandler.
+    Разбирает запрос, передаёт его маршрутам (routes.Router) и отправляет их ответ.
+    """
 
     def log_message(self, format, *args):
         """Переопределение стандартного вывода логов запросов"""
@@ -32,192 +76,114 @@ class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
             format % args
         ))
 
-    """
-    Класс обработчика HTTP-запросов, наследуется от BaseHTTPRequestHandler.
-    Реализует методы do_GET и do_POST для обработки GET и POST запросов соответственно.
-    """
-    def _set_headers(self, code=200):
+    def _router(self):
+        """Маршруты поверх текущих объектов модуля (тесты подменяют их на время теста)"""
+        return Router(SyncBackend(get_tracker, breaker), admission, snapshots, spool, logger, multi_tenant or bool(partitions))
+
+    def _set_headers(self, code=200, headers=None):
         """
         Установка HTTP-заголовков для ответа.
         По умолчанию устанавливает код ответа 200 OK и Content-Type: application/json в кодировке utf-8.
+        headers — словарь дополнительных заголовков.
         """
         self.send_response(code)
         self.send_header('Content-type', 'application/json; charset=utf-8')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
         self.end_headers()
 
-    def _send_json_response(self, data, code=200):
-        """Отправка JSON-ответа"""
-        self._set_headers(code)
-        self.wfile.write(json.dumps(data, ensure_ascii=False).encode('utf-8'))
+    def _send(self, code, payload, headers):
+        """Отправка ответа маршрутов: код, тело (объект для JSON или готовая строка) и заголовки"""
+        self._set_headers(code, headers)
+        self.wfile.write(encode_body(payload))
 
-    def _handle_error(self, code, message):
-        """Обработчик ошибок с правильным Content-Type"""
-        self.send_response(code)
-        self.send_header('Content-type', 'application/json; charset=utf-8')
-        self.end_headers()
-        error_response = {
-            "error": self.responses[code][0],
-            "message": message
-        }
-        self.wfile.write(json.dumps(error_response).encode('utf-8'))
+    def _respond(self, method, body=b''):
+        """Выполняет запрос через маршруты и отправляет ответ"""
+        headers = {name.lower(): value for name, value in self.headers.items()}
+        self._send(*run_sync(self._router().dispatch(method, self.path, headers, body, self.client_address[0])))
 
-    def do_POST(self): # noqa: N802
-        """
-        Обработка POST-запросов.
-        В проекте поддерживается путь /expenses, который позволяет добавить новую трату.
-        """
-        try:
-            parsed_url = urlparse(self.path) # Выполняем парсинг пути
-            path = parsed_url.path # Получаем путь запроса
-            
-            if path == "/expenses":
-                # Получаем длину тела запроса из заголовков
-                content_length = int(self.headers.get('Content-Length', 0))
-                # Читаем тело запроса (байты), декодируем из utf-8 в строку
-                body = self.rfile.read(content_length).decode('utf-8')
-                try:
-                    # Парсим JSON из строки в словарь, если тело не пустое
-                    data = json.loads(body) if body else {}
-                except json.JSONDecodeError:
-                    self._send_json_response({
-                        "error": "Bad Request", 
-                        "message": "Неверный формат JSON"
-                    }, 400)
-                    return
-
-                # Записываем в дебаг лог
-                logger.debug(f"POST data received: {data}")
-
-                # Извлекаем необходимые параметры для добавления траты
-                name = data.get('name')
-                category = data.get('category')
-                amount = data.get('amount')
-                date = data.get('date')
-
-                # Проверяем, что все поля заполнены - если нет, возвращаем 400 Bad Request
-                if not name or not category or not amount or not date:
-                    # Отправляем JSON-ответ с сообщением об ошибке
-                    self._handle_error(400, "Недостаточно данных для добавления траты!")
-                    return
-
-                # Если все данные присутствуют, добавляем трату через tracker с проверкой на валидацию
-                msg = tracker.add_expense(name, category, amount, date)
-                logger.info(f"Expense added: {msg}")
-
-                if msg.startswith("Ошибка:"):
-                    # Валидация не прошла — отдаем 400 Bad Request
-                    self._send_json_response({
-                        "error": "Bad Request",
-                        "message": msg
-                    }, 400)
-                else:
-                    self._send_json_response({"message": msg}, 200)
-
-            else:
-                # Если POST-запрос на неизвестный путь, возвращаем 404 Not Found
-                self._send_json_response({
-                    "error": "Not Found",
-                    "message": f"Метод '{path}' не найден"
-                }, 404)
-
-        except Exception as e:
-            logger.exception("Unexpected error in POST handler")
-            self._send_json_response({
-                "error": "Internal Server Error",
-                "message": str(e)
-            }, 500)
-    
     def do_GET(self): # noqa: N802
+        """Обработка GET-запросов (класс запросов на чтение)"""
+        self._respond('GET')
+
+    def do_POST(self): # noqa: N802
         """
-        Обработка GET-запросов.
-        Поддерживаются следующие пути:
-         - /categories/top?month=<месяц с нулем или без> — возвращает категорию с максимальной тратой за месяц
-         - /expenses/largest?month=<месяц с нулем или без>&category=... — возвращает максимальную трату в категории за месяц
-         - /expenses/full_records — возвращает все записи о тратах. Добавлено для наглядности, не документированный функционал.
+        Обработка POST-запросов (класс запросов на запись).
+        Тело читается только по Content-Length; запрос с Transfer-Encoding отклоняется (501),
+        а соединение закрывается — как в async_server.read_request.
         """
-
-        try:
-
-            parsed_url = urlparse(self.path)
-            path = parsed_url.path
-            params = parse_qs(parsed_url.query) # Разбираем параметры запроса в словарь: ключ -> список значений
-            
-            # Записываем дебаг лог о плученном запросе
-            logger.debug(f"GET request: {path} with params {params}")
-
-            if path == "/categories/top":
-                # Получаем параметр month (если нет, пустая строка)
-                month = params.get("month", [""])[0]
-                # Получаем категорию с максимальной тратой в этом месяце
-                top = tracker.get_top_category(month)
-
-                if not top:
-                    self._handle_error(404, f"В месяце '{month}' не найдено категорий")
-                    return
-                
-                self._set_headers()
-                response = {f"Категория с максимальной тратой в месяце {month}": top}
-                self.wfile.write(json.dumps(response).encode('utf-8'))
-
-            elif path == "/expenses/largest":
-                # Получаем параметры month и category
-                month = params.get("month", [""])[0]
-                category = params.get("category", [""])[0]
-                # Получаем максимальную трату по данным параметрам
-                exp = tracker.get_max_expense(month, category)
-
-                if not exp:
-                    self._handle_error(404, f"В месяце '{month}' и категории '{category}' трат не найдено")
-                    return
-
-                self._set_headers()
-                response = {f"Максимальная трата в месяце '{month}' и категории '{category}'": exp['name']}
-                self.wfile.write(json.dumps(response).encode('utf-8'))
-
-            elif path == "/expenses/full_records":
-                # Получаем все записи о тратах
-                expenses = tracker.get_full_records()
-
-                # Если записей нет, то Not Found 404 с сообщением
-                if not expenses:
-                    self._handle_error(404, "Записей о тратах не найдено")
-                    return
-                
-                self._set_headers()
-                # Используем bson.json_util.dumps — сериализация, поддерживающая BSON-объекты из MongoDB
-                self.wfile.write(dumps(expenses).encode('utf-8'))
-                
-            else:
-                # Для всех других путей возвращаем 404 Not Found с сообщением
-                self._handle_error(404, f"Метод '{path}' не найден")
-
-        except Exception as e:
-            logger.exception("Unexpected error in GET handler")
-            self._handle_error(500, "Внутренняя ошибка сервера")
-
-
-def run(server_class=HTTPServer, handler_class=SimpleHTTPRequestHandler, port=8080):
+        if 'Transfer-Encoding' in self.headers:
+            self.close_connection = True
+            self._send(*error(501, "Transfer-Encoding не поддерживается, передайте Content-Length"))
+            return
+        # Получаем длину тела запроса из заголовков и читаем тело
+        content_length = self.headers.get('Content-Length', '0')
+        if not (content_length.isascii() and content_length.isdigit()):
+            self.close_connection = True
+            self._send(*error(400, "Неверный заголовок Content-Length"))
+            return
+        self._respond('POST', self.rfile.read(int(content_length)))
+
+
+def run(server_class=ThreadingHTTPServer, handler_class=SimpleHTTPRequestHandler, port=8080, warm_up=True):
     """
     Функция запуска HTTP-сервера на указанном порту (по умолчанию 8080).
     Создаёт экземпляр сервера, передавая ему обработчик запросов,
     и запускает обработку запросов в бесконечном цикле.
+    Каждый запрос обрабатывается в отдельном потоке, число одновременно
+    обрабатываемых запросов ограничивает контроль допуска (admission).
+
+    Если warm_up=True, до начала приёма соединений tracker прогревается (ExpenseTracker.warm_up):
+    сокет открывается только после прогрева, поэтому балансировщик не направит запросы
+    на ещё не готовый процесс. Ошибка прогрева не мешает запуску.
     """
-    server_address = ('', port) # '' - означает слушать на всех сетевых интерфейсах
-    httpd = server_class(server_address, handler_class)
-    logger.info(f"HTTP-сервер запущен на порту {port}")
-    httpd.serve_forever() # Запускает бесконечный цикл обработки входящих запросов
+    # Снимок аналитики прошлого запуска; дальше он сохраняется в файл фоновым потоком
+    try:
+        snapshots.restore()
+    except (OSError, ValueError):
+        logger.exception("Не удалось загрузить снимок аналитики")
+    snapshots.start()
+    instance = get_tracker()
+    # Траты, отложенные при недоступности базы (в том числе в прошлом запуске), записываются в фоне
+    spool.start(lambda **expense: breaker.call(instance.add_expense, **expense))
+    # Кэш аналитики включается, только если удалось запустить уведомления об изменениях
+    try:
+        instance.start_analytics_cache()
+    except Exception:
+        logger.exception("Не удалось запустить уведомления об изменениях, кэш аналитики отключён")
 
-if __name__ == '__main__':
-    client_module = tracker.client.__class__.__module__
-    if not client_module.startswith('mongomock'):
+    server_address = ('', port) # '' - означает слушать на всех сетевых интерфейсах
+    httpd = server_class(server_address, handler_class, bind_and_activate=False)
+    if warm_up:
         try:
-            tracker.client.admin.command('ping')
-            logger.info("Соединение с MongoDB установлено успешно.")
-        except Exception as e:
-            logger.exception("Не удалось подключиться к MongoDB!")
+            instance.warm_up()
+            logger.info("Трекер прогрет.")
+        except Exception:
+            logger.exception("Не удалось прогреть трекер, сервер запускается без прогрева!")
+    try:
+        httpd.server_bind()
+        httpd.server_activate()
+    except Exception:
+        httpd.server_close()
+        raise
+    logger.info(f"HTTP-сервер запущен на порту {port}")
+    try:
+        httpd.serve_forever() # Запускает бесконечный цикл обработки входящих запросов
+    finally:
+        spool.stop()
+        snapshots.stop() # Сохраняем снимок аналитики, чтобы он пережил перезапуск
 
-    else:
-        logger.info("Обнаружен mongomock — проверка подключения к MongoDB пропущена.")
+def main():
+    """
+    Запуск из командной строки: python http_server.py [--port 8080] [--partitions N | --storage-path PATH] [--multi-tenant] [--no-warm-up]
+    [--mongo-uri URI] [--reader-uri URI] [--read-preference MODE] ... (см. server_config.parse_args)
+    """
+    global partitions, multi_tenant, storage_path, tracker_options
+    args = parse_args("HTTP-сервер трекера расходов")
+    partitions, multi_tenant, storage_path = args.partitions, args.multi_tenant, args.storage_path
+    tracker_options = args.tracker_options
+    run(port=args.port, warm_up=not args.no_warm_up)
 
+if __name__ == '__main__':
     # Если скрипт запускается как основная программа, стартуем сервер
-    run()
+    main()
@@ -0,0 +1,76 @@
+import argparse
+import logging
+
+import schema
+from expenses import search_tokens
+
+logger = logging.getLogger('Migration')
+
+# Идентификатор миграции в коллекции состояния миграций
+MIGRATION_ID = f"schema_v{schema.SCHEMA_VERSION}"
+
+
+def with_tokens(document):
+    """Документ траты версии 1 с полем tokens: у трат, добавленных до появления поиска, его нет"""
+    if "tokens" in document or "name" not in document:
+        return document
+    return {**document, "tokens": search_tokens(document["name"])}
+
+def migrate_collection(collection, state_collection, batch_size=500):
+    """
+    Переводит документы трат версии 1 в компактную схему (schema.py) пачками по batch_size.
+
+    Миграцию можно прервать и запустить снова: после каждой пачки в state_collection
+    сохраняется _id последнего обработанного документа, и следующий запуск продолжает с него.
+    Каждый документ заменяется только если он всё ещё в версии 1, поэтому повторная обработка
+    и параллельная запись новых трат безопасны. Траты, добавленные до появления поиска (без tokens),
+    получают слова названия при переводе.
+
+    Возвращает число преобразованных документов.
+    """
+    from pymongo import ReplaceOne
+
+    state = state_collection.find_one({"_id": MIGRATION_ID}) or {}
+    last_id = state.get("last_id")
+    converted = 0
+    while True:
+        query = {"v": {"$exists": False}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        batch = list(collection.find(query).sort("_id", 1).limit(batch_size))
+        if not batch:
+            # Документы версии 1 с меньшим _id могли появиться после прохода
+            # (например, от серверов, ещё пишущих в старой схеме) — тогда проходим коллекцию заново
+            if last_id is not None and collection.find_one({"v": {"$exists": False}}, {"_id": 1}) is not None:
+                last_id = None
+                continue
+            break
+        result = collection.bulk_write([
+            ReplaceOne({"_id": doc["_id"], "v": {"$exists": False}}, schema.encode(with_tokens(doc)))
+            for doc in batch
+        ], ordered=False)
+        converted += result.modified_count
+        last_id = batch[-1]["_id"]
+        state_collection.update_one({"_id": MIGRATION_ID}, {"$set": {"last_id": last_id, "done": False}}, upsert=True)
+        logger.info(f"Преобразовано документов: {converted}, последний _id: {last_id}")
+
+    state_collection.update_one({"_id": MIGRATION_ID}, {"$set": {"done": True}}, upsert=True)
+    return converted
+
+def main():
+    """Запуск миграции из командной строки: python migrate.py --uri mongodb://... --batch-size 500"""
+    parser = argparse.ArgumentParser(description="Миграция трат в компактную схему документов")
+    parser.add_argument('--uri', default='mongodb://localhost:27017/', help="адрес MongoDB")
+    parser.add_argument('--batch-size', type=int, default=500, help="размер пачки документов")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    from pymongo import MongoClient
+
+    db = MongoClient(args.uri)['expenses_db']
+    converted = migrate_collection(db['expenses'], db['migrations'], args.batch_size)
+    logger.info(f"Миграция завершена, преобразовано документов: {converted}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import zlib
+
+from expenses import ExpenseTracker
+from sketches import DEFAULT_QUANTILES
+
+
+class PartitionedExpenseTracker:
+    """
+    Фасад над несколькими ExpenseTracker, между которыми пользователи (tenant) распределены по хешу.
+
+    Каждый пользователь всегда попадает в один и тот же раздел — коллекцию или базу данных,
+    поэтому его запросы затрагивают только данные своего раздела.
+    Методы повторяют методы ExpenseTracker, но параметр tenant обязателен.
+    """
+
+    def __init__(self, trackers):
+        """trackers — список ExpenseTracker, по одному на раздел. Порядок задаёт номера разделов"""
+        if not trackers:
+            raise ValueError("Нужен хотя бы один раздел")
+        self.trackers = list(trackers)
+
+    @staticmethod
+    def _partition_names(partitions, by):
+        """Имена коллекций или баз разделов — параметры конструктора ExpenseTracker для каждого раздела"""
+        if by == 'collection':
+            return [{"collection_name": f"expenses_{i}", "sketches_collection_name": f"sketches_{i}"} for i in range(partitions)]
+        if by == 'database':
+            return [{"db_name": f"expenses_db_{i}"} for i in range(partitions)]
+        raise ValueError(f"Неизвестный способ разделения: '{by}'")
+
+    @classmethod
+    def from_client(cls, client, partitions, by='collection', **tracker_options):
+        """
+        Создаёт фасад из partitions разделов на одном клиенте MongoDB.
+        by='collection' — разделы в коллекциях expenses_0, expenses_1, ... базы expenses_db,
+        by='database' — в базах expenses_db_0, expenses_db_1, ...
+        tracker_options передаются в конструктор каждого ExpenseTracker.
+        """
+        names = cls._partition_names(partitions, by)
+        return cls([ExpenseTracker(db_client=client, **options, **tracker_options) for options in names])
+
+    @classmethod
+    def from_uri(cls, partitions, mongo_uri='mongodb://localhost:27017/', by='collection', **tracker_options):
+        """
+        Создаёт фасад из partitions разделов, подключаясь к MongoDB по адресу mongo_uri (используется серверами).
+        Клиенты записи и чтения создаёт первый раздел, остальные разделы используют их же,
+        поэтому пулы соединений не умножаются на число разделов.
+        """
+        names = cls._partition_names(partitions, by)
+        first = ExpenseTracker(mongo_uri=mongo_uri, **names[0], **tracker_options)
+        tracker_options = {key: value for key, value in tracker_options.items() if key != 'reader_uri'}
+        return cls([first] + [
+            ExpenseTracker(db_client=first.client, reader_client=first.reader_client, **options, **tracker_options)
+            for options in names[1:]
+        ])
+
+    def partition(self, tenant):
+        """
+        Номер раздела пользователя. Используется crc32, а не hash(): он одинаков во всех процессах
+        и не меняется между запусками.
+        """
+        if tenant is None:
+            raise ValueError("Не указан пользователь (tenant)")
+        return zlib.crc32(tenant.encode('utf-8')) % len(self.trackers)
+
+    def tracker_for(self, tenant):
+        """ExpenseTracker раздела, в котором хранятся траты пользователя"""
+        return self.trackers[self.partition(tenant)]
+
+    def add_expense(self, name, category, amount, date, idempotency_key=None, tenant=None, expense_id=None):
+        return self.tracker_for(tenant).add_expense(name, category, amount, date, idempotency_key, tenant=tenant, expense_id=expense_id)
+
+    def get_full_records(self, after=None, limit=None, month=None, category=None, fields=None, tenant=None):
+        return self.tracker_for(tenant).get_full_records(after, limit, month, category, fields, tenant=tenant)
+
+    def search_expenses(self, query, month=None, category=None, limit=50, tenant=None):
+        return self.tracker_for(tenant).search_expenses(query, month, category, limit, tenant=tenant)
+
+    def get_top_category(self, month, tenant=None):
+        return self.tracker_for(tenant).get_top_category(month, tenant=tenant)
+
+    def get_max_expense(self, month, category, tenant=None):
+        return self.tracker_for(tenant).get_max_expense(month, category, tenant=tenant)
+
+    def get_percentiles(self, months=None, category=None, quantiles=DEFAULT_QUANTILES, tenant=None):
+        return self.tracker_for(tenant).get_percentiles(months, category, quantiles, tenant=tenant)
+
+    def start_analytics_cache(self, maxsize=1024, ttl=300, mode='auto', consistent_reads=False):
+        """
+        Включает кэш аналитики в каждом разделе (ExpenseTracker.start_analytics_cache):
+        уведомления об изменениях у каждого раздела свои, по его коллекции.
+        Возвращает список запущенных ChangeFeed.
+        """
+        return [tracker.start_analytics_cache(maxsize, ttl, mode, consistent_reads) for tracker in self.trackers]
+
+    def warm_up(self, *args, **kwargs):
+        """Прогревает каждый раздел (ExpenseTracker.warm_up) с теми же параметрами"""
+        for tracker in self.trackers:
+            tracker.warm_up(*args, **kwargs)
@@ -0,0 +1,377 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from cache import TTLCache
+
+logger = logging.getLogger('Resilience')
+
+# Признак отсутствия результата в снимке (None — допустимый сохранённый результат)
+_MISSING = object()
+
+# Заголовки ответа, собранного из снимка (SnapshotStore), а не из базы
+STALE_HEADERS = {'X-Stale': 'true', 'Warning': '110 - "Response is Stale"'}
+
+
+class CircuitOpenError(Exception):
+    """Вызов отклонён без обращения к базе: автомат размыкателя разомкнут"""
+
+    def __init__(self, retry_after):
+        super().__init__("База данных недоступна, автомат разомкнут")
+        self.retry_after = retry_after
+
+
+def unavailable_errors():
+    """
+    Исключения, означающие недоступность базы (а не ошибку в запросе):
+    превышение срока вызова и сетевые ошибки pymongo. Только они размыкают автомат.
+    """
+    from pymongo.errors import ConnectionFailure, ExecutionTimeout
+
+    return (TimeoutError, FutureTimeoutError, ConnectionFailure, ExecutionTimeout, CircuitOpenError)
+
+
+class CircuitBreaker:
+    """
+    Автомат-размыкатель (circuit breaker) вокруг вызовов ExpenseTracker.
+
+    Каждый вызов выполняется в ограниченном пуле потоков и ждёт результата не дольше call_timeout секунд
+    с начала выполнения. Ожидание свободного потока в очереди пула тоже ограничено call_timeout, но это перегрузка
+    самого сервера, а не отказ базы: такой вызов отменяется и в число неудач не входит.
+    Пул должен вмещать все вызовы, которые пропускает контроль допуска (см. admission.AdmissionController.total_limit).
+    После failure_threshold подряд неудачных вызовов (превышение срока или недоступность базы)
+    автомат размыкается: в течение reset_timeout секунд вызовы сразу отклоняются с CircuitOpenError,
+    не занимая потоки и соединения. Затем пропускается один пробный вызов: при успехе автомат замыкается,
+    при неудаче снова размыкается.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, call_timeout=2.0, max_workers=32, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.call_timeout = call_timeout
+        self._clock = clock
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='tracker-call')
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+
+    def retry_after(self):
+        """Через сколько секунд автомат пропустит пробный вызов"""
+        return max(1, round(self.reset_timeout - (self._clock() - self._opened_at)))
+
+    def _before_call(self):
+        """Решает, пропускать ли вызов, и переводит автомат в полуоткрытое состояние, когда пора"""
+        with self._lock:
+            if self.state == self.OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            if self.state == self.OPEN or (self.state == self.HALF_OPEN and self._trial_running):
+                raise CircuitOpenError(self.retry_after())
+            if self.state == self.HALF_OPEN:
+                self._trial_running = True
+
+    def _record(self, success):
+        """
+        Учитывает результат вызова и завершает пробный вызов.
+        success=None — исход неизвестен (вызов не дошёл до базы или отменён): состояние автомата не меняется.
+        """
+        with self._lock:
+            self._trial_running = False
+            if success is None:
+                return
+            if success:
+                self.state = self.CLOSED
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened_at = self._clock()
+
+    @staticmethod
+    def _queue_timeout_error(timeout):
+        return TimeoutError(f"Вызов не дождался свободного потока за {timeout} с (сервер перегружен)")
+
+    def call(self, fn, /, *args, deadline=None, **kwargs):
+        """
+        Вызывает fn(*args, **kwargs) со сроком deadline секунд (по умолчанию call_timeout).
+        Превышение срока выбрасывает TimeoutError. Вызов, не дождавшийся потока пула, отменяется;
+        уже начатый продолжает работать в пуле (поэтому в pymongo тоже стоит задавать таймауты операций)
+        и может успеть выполниться — повторять такие вызовы безопасно только с ключом идемпотентности.
+        Прочие исключения fn пробрасываются как есть; автомат размыкают только ошибки недоступности.
+        """
+        deadline = deadline or self.call_timeout
+        self._before_call()
+        started = threading.Event()
+
+        def run():
+            started.set()
+            return fn(*args, **kwargs)
+
+        # Исход вызова для автомата; None (очередь, KeyboardInterrupt) только завершает пробный вызов
+        success = None
+        try:
+            future = self._executor.submit(run)
+            if not started.wait(deadline) and future.cancel():
+                raise self._queue_timeout_error(deadline)
+            try:
+                result = future.result(timeout=deadline)
+            except FutureTimeoutError:
+                success = False
+                raise TimeoutError(f"Вызов не уложился в {deadline} с") from None
+            except unavailable_errors():
+                success = False
+                raise
+            except Exception:
+                # Ошибка в самом запросе — база отвечает, автомат не трогаем
+                success = True
+                raise
+            success = True
+            return result
+        finally:
+            self._record(success)
+
+    async def call_async(self, fn, /, *args, deadline=None, **kwargs):
+        """
+        То же, что call, для asyncio: fn выполняется в пуле автомата,
+        а сроки отсчитываются в цикле событий, не блокируя его.
+        """
+        deadline = deadline or self.call_timeout
+        self._before_call()
+        loop = asyncio.get_running_loop()
+        started = asyncio.Event()
+
+        def run():
+            loop.call_soon_threadsafe(started.set)
+            return fn(*args, **kwargs)
+
+        # Отмена ожидающей задачи (CancelledError) оставляет success=None: пробный вызов завершается,
+        # иначе в полуоткрытом состоянии автомат отклонял бы все вызовы навсегда
+        success = None
+        try:
+            concurrent_future = self._executor.submit(run)
+            future = asyncio.wrap_future(concurrent_future)
+            try:
+                await asyncio.wait_for(started.wait(), deadline)
+            except asyncio.TimeoutError:
+                if concurrent_future.cancel():
+                    raise self._queue_timeout_error(deadline) from None
+            try:
+                result = await asyncio.wait_for(future, deadline)
+            except asyncio.TimeoutError:
+                success = False
+                raise TimeoutError(f"Вызов не уложился в {deadline} с") from None
+            except unavailable_errors():
+                success = False
+                raise
+            except Exception:
+                success = True
+                raise
+            success = True
+            return result
+        finally:
+            self._record(success)
+
+
+class SnapshotStore:
+    """
+    Последние успешные результаты аналитических запросов для работы при недоступной базе.
+
+    Ключи приходят из параметров запросов, поэтому снимок ограничен: не больше maxsize результатов
+    (вытесняются давно не запрошенные) и не старше ttl секунд.
+    Если задан path, снимок переживает перезапуск сервера: restore загружает его из JSON-файла,
+    а фоновый поток (start/stop) записывает изменения не чаще раза в flush_interval секунд.
+    save и load работают только с памятью и не обращаются к диску.
+    """
+
+    def __init__(self, path=None, flush_interval=5.0, maxsize=10000, ttl=24 * 3600, clock=time.monotonic):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._data = TTLCache(maxsize=maxsize, ttl=ttl, clock=clock)
+        self._dirty = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _key(key):
+        """Ключ снимка — кортеж (маршрут, параметры...), в JSON хранится строкой"""
+        return json.dumps(key, ensure_ascii=False)
+
+    def save(self, key, value):
+        """Запоминает результат запроса"""
+        self._data.set(self._key(key), value)
+        self._dirty.set()
+
+    def load(self, key):
+        """Возвращает (найден ли снимок, значение)"""
+        value = self._data.get(self._key(key), _MISSING)
+        if value is _MISSING:
+            return False, None
+        return True, value
+
+    def restore(self):
+        """Загружает снимок из файла path, если он есть (вызывается при запуске сервера)"""
+        if not self.path or not os.path.exists(self.path):
+            return
+        with open(self.path, encoding='utf-8') as f:
+            data = json.load(f)
+        for key, value in data.items():
+            self._data.set(key, value)
+
+    def flush(self):
+        """Записывает снимок в файл атомарно (через временный файл)"""
+        if not self.path:
+            return
+        self._dirty.clear()
+        data = json.dumps(dict(self._data.items()), ensure_ascii=False)
+        tmp_path = f"{self.path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+    def start(self):
+        """Запускает фоновую запись снимка в файл"""
+        if not self.path or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._flush_loop, name='snapshot-flush', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Останавливает фоновую запись и сохраняет последние изменения"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._dirty.is_set():
+            self.flush()
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            if self._dirty.is_set():
+                try:
+                    self.flush()
+                except OSError:
+                    logger.exception("Не удалось сохранить снимок аналитики")
+
+
+class Spool:
+    """
+    Локальная очередь (JSON lines) трат, которые не удалось записать из-за недоступности базы.
+    Каждая трата несёт ключ идемпотентности или заранее назначенный _id (expense_id), поэтому повторное
+    воспроизведение (например, после сбоя посреди replay) не создаёт дублей.
+    """
+
+    def __init__(self, path, replay_interval=5.0):
+        self.path = path
+        self.replay_interval = replay_interval
+        self._lock = threading.Lock()
+        self._replaying = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def new_key():
+        """Новый ключ идемпотентности для траты, у которой нет ни ключа клиента, ни expense_id"""
+        return f"spool-{uuid.uuid4()}"
+
+    def append(self, expense):
+        """
+        Добавляет трату (словарь аргументов add_expense) в очередь.
+        Возвращает её идентификатор: ключ идемпотентности или, если его нет, expense_id.
+        Трате без обоих назначается новый ключ (new_key).
+        """
+        expense = dict(expense)
+        if not expense.get("idempotency_key") and not expense.get("expense_id"):
+            expense["idempotency_key"] = self.new_key()
+        line = json.dumps(expense, ensure_ascii=False) + "\n"
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        return expense.get("idempotency_key") or expense["expense_id"]
+
+    def pending(self):
+        """Есть ли в очереди траты"""
+        return os.path.exists(self.path) and os.path.getsize(self.path) > 0
+
+    def _read_lines(self):
+        """Строки очереди (вызывать под self._lock)"""
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, encoding='utf-8') as f:
+            return [line for line in f if line.strip()]
+
+    def replay(self, add_expense):
+        """
+        Передаёт траты из очереди в add_expense(**трата) по порядку.
+        Если очередной вызов завершился исключением, воспроизведение останавливается,
+        а эта и последующие траты остаются в очереди. Одновременно выполняется не более одного replay.
+
+        Воспроизведённые траты удаляются из файла только после вызовов; если процесс упадёт
+        посередине, они будут воспроизведены снова, и дубли отсечёт ключ идемпотентности.
+        Возвращает число воспроизведённых трат.
+        """
+        if not self._replaying.acquire(blocking=False):
+            return 0
+        try:
+            with self._lock:
+                lines = self._read_lines()
+            done = 0
+            try:
+                for line in lines:
+                    add_expense(**json.loads(line))
+                    done += 1
+            finally:
+                if done:
+                    # Новые траты за время replay дописаны в конец, первые done строк — воспроизведённые
+                    with self._lock:
+                        rest = self._read_lines()[done:]
+                        with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+                            f.writelines(rest)
+                        os.replace(self.path + '.tmp', self.path)
+            return done
+        finally:
+            self._replaying.release()
+
+    def start(self, add_expense):
+        """
+        Запускает фоновое воспроизведение очереди через add_expense: сразу (траты прошлого запуска)
+        и затем раз в replay_interval секунд, пока в очереди есть траты. Так очередь записывается
+        и без новых успешных POST-запросов — например, когда сервер получает только чтения.
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._replay_loop, args=(add_expense,), name='spool-replay', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Останавливает фоновое воспроизведение"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _replay_loop(self, add_expense):
+        while True:
+            if self.pending():
+                try:
+                    done = self.replay(add_expense)
+                    if done:
+                        logger.info(f"Из очереди записано трат: {done}")
+                except Exception as e:
+                    logger.warning(f"Не удалось записать траты из очереди, повтор через {self.replay_interval} с: {e}")
+            if self._stop.wait(self.replay_interval):
+                return
@@ -0,0 +1,340 @@
+import json
+import threading
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlparse
+
+from admission import READ, WRITE
+from expenses import MAX_SEARCH_LIMIT, ExpenseTracker
+from resilience import STALE_HEADERS, unavailable_errors
+
+# Срок вызова для /expenses/full_records без limit (все записи сразу): больше обычного срока автомата,
+# чтобы выдача большой коллекции не считалась отказом базы и не размыкала автомат для всех путей
+FULL_RECORDS_DEADLINE = 30.0
+
+
+def error(code, message, retry_after=None):
+    """
+    Ответ с ошибкой: (код, тело, заголовки).
+    Если передан retry_after, добавляется заголовок Retry-After (в секундах).
+    """
+    headers = {} if retry_after is None else {'Retry-After': str(retry_after)}
+    return code, {"error": HTTPStatus(code).phrase, "message": message}, headers
+
+def encode_body(payload):
+    """Тело ответа в байтах: payload — объект для JSON или уже готовое тело (str)"""
+    if isinstance(payload, str):
+        return payload.encode('utf-8')
+    return json.dumps(payload, ensure_ascii=False).encode('utf-8')
+
+def month_key(month):
+    """Месяц в ключе снимка: '6' и '06' — один и тот же ключ"""
+    return month.zfill(2) if month.isascii() and month.isdigit() else month
+
+def run_sync(coro):
+    """
+    Выполняет корутину маршрутов до конца без цикла событий (для http_server).
+    С SyncBackend корутины ничего не ждут и завершаются за один шаг.
+    """
+    try:
+        coro.send(None)
+    except StopIteration as stop:
+        return stop.value
+    coro.close()
+    raise RuntimeError("Корутина маршрутов ожидает цикл событий, а вызвана синхронно")
+
+
+class SyncBackend:
+    """
+    Доступ маршрутов к трекеру из потока запроса (http_server).
+    Вызовы идут через автомат-размыкатель breaker и блокируют поток до результата.
+
+    Тот же интерфейс реализует AsyncExpenseTracker (async_server):
+     - call(имя метода трекера, ..., deadline=None) — вызов метода трекера (deadline — свой срок вызова в секундах);
+     - offload(fn, ...) — блокирующая операция с файлами (запись в очередь);
+     - replay_spool(spool) — фоновая запись отложенных трат.
+    """
+
+    def __init__(self, get_tracker, breaker):
+        self.get_tracker = get_tracker
+        self.breaker = breaker
+
+    async def call(self, method, *args, deadline=None, **kwargs):
+        return self.breaker.call(getattr(self.get_tracker(), method), *args, deadline=deadline, **kwargs)
+
+    async def offload(self, fn, *args):
+        return fn(*args)
+
+    def replay_spool(self, spool):
+        """Если в очереди есть траты, записанные при недоступности базы, воспроизводит их в фоне"""
+        if spool.pending():
+            add_expense = lambda **e: self.breaker.call(self.get_tracker().add_expense, **e)  # noqa: E731
+            threading.Thread(target=spool.replay, args=(add_expense,), daemon=True).start()
+
+
+class Router:
+    """
+    Маршруты HTTP API, общие для синхронного (http_server) и асинхронного (async_server) серверов.
+
+    Не зависит от транспорта: получает разобранный запрос и возвращает (код, тело, заголовки),
+    а сервер сам отправляет ответ. Тело — объект для JSON или уже сериализованная строка.
+    Имена заголовков запроса — в нижнем регистре.
+    """
+
+    def __init__(self, backend, admission, snapshots, spool, logger, multi_tenant=False):
+        self.backend = backend
+        self.admission = admission
+        self.snapshots = snapshots
+        self.spool = spool
+        self.logger = logger
+        self.multi_tenant = multi_tenant
+
+    async def dispatch(self, method, target, headers, body, client):
+        """
+        Пропускает запрос через контроль допуска и направляет обработчику.
+        Клиент, превысивший лимит частоты, получает 429, а при исчерпании лимита
+        одновременных запросов класса (чтение или запись) — 503. Оба ответа содержат Retry-After
+        и отдаются сразу, не занимая место в очереди.
+        Путь /metrics — счётчики контроля допуска — обслуживается без ограничений,
+        чтобы состояние сервера было видно и во время перегрузки.
+        В многопользовательском режиме (multi_tenant) запрос без заголовка X-Tenant-Id получает 400:
+        иначе он читал бы траты всех пользователей или сохранял трату без владельца.
+        Путь, который не удаётся разобрать (например, '//[x/metrics'), получает 400.
+        """
+        try:
+            path = urlparse(target).path
+        except ValueError:
+            return error(400, "Неверный путь запроса")
+        if method == 'GET' and path == "/metrics":
+            return 200, self.admission.stats(), {}
+        if method not in ('GET', 'POST'):
+            return error(501, f"Метод {method} не поддерживается")
+        if self.multi_tenant and self._tenant(headers) is None:
+            return error(400, "Не задан пользователь (заголовок X-Tenant-Id)")
+        route_class = READ if method == 'GET' else WRITE
+        retry_after = self.admission.check_rate(client)
+        if retry_after is not None:
+            return error(429, "Превышен лимит частоты запросов", retry_after=retry_after)
+        if not self.admission.acquire(route_class):
+            return error(503, "Сервер перегружен, повторите запрос позже", retry_after=self.admission.retry_after)
+        try:
+            if method == 'GET':
+                return await self.get(target, headers)
+            return await self.post(target, headers, body)
+        finally:
+            self.admission.release(route_class)
+
+    @staticmethod
+    def _tenant(headers):
+        """
+        Пользователь (арендатор), от имени которого выполняется запрос, — из заголовка X-Tenant-Id.
+        Без заголовка (только в однопользовательском режиме) запросы выполняются по всем тратам.
+        """
+        return headers.get('x-tenant-id') or None
+
+    async def _analytics(self, key, method, *args, **kwargs):
+        """
+        Вызывает аналитический метод трекера. Возвращает (результат, дополнительные заголовки ответа).
+        Успешный непустой результат запоминается в снимке под ключом key; если база недоступна,
+        отдаётся последний запомненный результат с заголовками STALE_HEADERS.
+        Если снимка нет, исключение недоступности пробрасывается дальше.
+        """
+        try:
+            result = await self.backend.call(method, *args, **kwargs)
+        except unavailable_errors():
+            found, result = self.snapshots.load(key)
+            if not found:
+                raise
+            self.logger.warning(f"База данных недоступна, отдаём снимок для {key}")
+            return result, STALE_HEADERS
+        if result:
+            self.snapshots.save(key, result)
+        return result, {}
+
+    async def get(self, target, headers):
+        """
+        Обработка GET-запросов.
+        Поддерживаются следующие пути:
+         - /categories/top?month=<месяц с нулем или без> — возвращает категорию с максимальной тратой за месяц
+         - /expenses/largest?month=<месяц с нулем или без>&category=... — возвращает максимальную трату в категории за месяц
+         - /expenses/full_records — возвращает все записи о тратах. Добавлено для наглядности, не документированный функционал.
+           Необязательные параметры: limit и after — постраничная выдача (курсор следующей страницы
+           возвращается в заголовке X-Next-Cursor), month, category — фильтры,
+           fields — поля через запятую (например, fields=name,amount).
+         - /expenses/search?q=<строка>&month=...&category=...&limit=... — поиск трат по названию
+           (слова целиком, последнее слово — по префиксу; month, category и limit необязательны)
+         - /expenses/percentiles?month=<месяц или месяцы через запятую>&category=... — возвращает p50/p90/p99 сумм трат
+           (оба параметра необязательны: без month — за все месяцы, без category — по всем категориям)
+        """
+        try:
+            parsed_url = urlparse(target)
+            path = parsed_url.path
+            params = parse_qs(parsed_url.query) # Разбираем параметры запроса в словарь: ключ -> список значений
+            tenant = self._tenant(headers)
+
+            # Записываем дебаг лог о полученном запросе
+            self.logger.debug(f"GET request: {path} with params {params}")
+
+            if path == "/categories/top":
+                # Получаем параметр month (если нет, пустая строка)
+                month = params.get("month", [""])[0]
+                # Получаем категорию с максимальной тратой в этом месяце
+                top, extra = await self._analytics(("top", tenant, month_key(month)), "get_top_category", month, tenant=tenant)
+                if not top:
+                    return error(404, f"В месяце '{month}' не найдено категорий")
+                return 200, {f"Категория с максимальной тратой в месяце {month}": top}, extra
+
+            if path == "/expenses/largest":
+                # Получаем параметры month и category
+                month = params.get("month", [""])[0]
+                category = params.get("category", [""])[0]
+                # Получаем максимальную трату по данным параметрам
+                exp, extra = await self._analytics(
+                    ("largest", tenant, month_key(month), category.capitalize()), "get_max_expense", month, category, tenant=tenant
+                )
+                if not exp:
+                    return error(404, f"В месяце '{month}' и категории '{category}' трат не найдено")
+                return 200, {f"Максимальная трата в месяце '{month}' и категории '{category}'": exp['name']}, extra
+
+            if path == "/expenses/search":
+                query = params.get("q", [""])[0]
+                month = params.get("month", [""])[0]
+                category = params.get("category", [""])[0]
+                if not query.strip():
+                    return error(400, "Не задана строка поиска (параметр q)")
+                try:
+                    limit = int(params.get("limit", ["50"])[0])
+                except ValueError:
+                    limit = 0
+                if not 1 <= limit <= MAX_SEARCH_LIMIT:
+                    return error(400, f"Параметр limit должен быть числом от 1 до {MAX_SEARCH_LIMIT}")
+                found = await self.backend.call(
+                    "search_expenses", query, month or None, category or None, limit, tenant=tenant
+                )
+                if not found:
+                    return error(404, f"По запросу '{query}' трат не найдено")
+                return 200, found, {}
+
+            if path == "/expenses/percentiles":
+                # Месяцы можно перечислить через запятую — скетчи этих месяцев будут слиты
+                month = params.get("month", [""])[0]
+                category = params.get("category", [""])[0]
+                months = [m for m in month.split(",") if m]
+                key = ("percentiles", tenant, sorted({month_key(m) for m in months}), category.capitalize())
+                percentiles, extra = await self._analytics(
+                    key, "get_percentiles", months or None, category or None, tenant=tenant
+                )
+                if not percentiles:
+                    return error(404, f"В месяце '{month}' и категории '{category}' трат не найдено")
+                return 200, percentiles, extra
+
+            if path == "/expenses/full_records":
+                after = params.get("after", [""])[0]
+                month = params.get("month", [""])[0]
+                category = params.get("category", [""])[0]
+                fields = [f for f in params.get("fields", [""])[0].split(",") if f]
+                try:
+                    limit = int(params.get("limit", ["0"])[0])
+                    if limit < 0:
+                        raise ValueError
+                except ValueError:
+                    return error(400, "Параметр limit должен быть неотрицательным числом")
+                limit = min(limit, 1000)  # не больше 1000 записей на страницу
+
+                # Получаем записи о тратах (все или одну страницу)
+                try:
+                    expenses = await self.backend.call(
+                        "get_full_records", after or None, limit or None, month or None, category or None, fields or None,
+                        tenant=tenant, deadline=None if limit else FULL_RECORDS_DEADLINE
+                    )
+                except ValueError as e:
+                    return error(400, str(e))
+
+                # Если записей нет, то Not Found 404 с сообщением
+                # (для страницы после курсора пустой список — это конец выдачи)
+                if not expenses and not after:
+                    return error(404, "Записей о тратах не найдено")
+
+                # Если страница заполнена целиком, за ней могут быть ещё записи — отдаём курсор следующей
+                extra = {}
+                if limit and len(expenses) == limit:
+                    extra['X-Next-Cursor'] = str(expenses[-1]['_id'])
+                # bson импортируется только здесь: остальным путям (и старту сервера) он не нужен
+                from bson.json_util import dumps
+
+                # Используем bson.json_util.dumps — сериализация, поддерживающая BSON-объекты из MongoDB
+                return 200, dumps(expenses), extra
+
+            # Для всех других путей возвращаем 404 Not Found с сообщением
+            return error(404, f"Метод '{path}' не найден")
+
+        except unavailable_errors() as e:
+            self.logger.warning(f"База данных недоступна: {e}")
+            return error(503, "База данных недоступна, повторите запрос позже", retry_after=getattr(e, 'retry_after', 1))
+
+        except Exception:
+            self.logger.exception("Unexpected error in GET handler")
+            return error(500, "Внутренняя ошибка сервера")
+
+    async def post(self, target, headers, body):
+        """
+        Обработка POST-запросов.
+        В проекте поддерживается путь /expenses, который позволяет добавить новую трату.
+        Если база недоступна, корректная трата откладывается в очередь spool (ответ 202).
+        """
+        path = urlparse(target).path
+        if path != "/expenses":
+            # Если POST-запрос на неизвестный путь, возвращаем 404 Not Found
+            return error(404, f"Метод '{path}' не найден")
+        try:
+            # Парсим JSON из тела запроса в словарь, если тело не пустое
+            data = json.loads(body.decode('utf-8')) if body else {}
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return error(400, "Неверный формат JSON")
+        if not isinstance(data, dict):
+            return error(400, "Неверный формат JSON")
+
+        # Записываем в дебаг лог
+        self.logger.debug(f"POST data received: {data}")
+
+        # Извлекаем необходимые параметры для добавления траты
+        name = data.get('name')
+        category = data.get('category')
+        amount = data.get('amount')
+        date = data.get('date')
+
+        # Проверяем, что все поля заполнены - если нет, возвращаем 400 Bad Request
+        if not name or not category or not amount or not date:
+            return error(400, "Недостаточно данных для добавления траты!")
+
+        # Ключ идемпотентности: повтор запроса с тем же ключом вернёт исходный ответ без второй записи.
+        # Без ключа клиента до первой попытки назначается _id траты: вызов, не уложившийся в срок, мог записать её,
+        # и копию из очереди (с тем же _id) отклонит уникальный индекс _id — без лишнего поля и индекса
+        expense = {"name": name, "category": category, "amount": amount, "date": date, "tenant": self._tenant(headers)}
+        if headers.get('idempotency-key'):
+            expense["idempotency_key"] = headers['idempotency-key']
+        else:
+            from bson import ObjectId
+
+            expense["expense_id"] = str(ObjectId())
+        try:
+            msg = await self.backend.call("add_expense", **expense)
+        except unavailable_errors():
+            # База недоступна: корректную трату сохраняем в очередь и запишем позже
+            _, validation_error = ExpenseTracker.validate_expense(name, category, amount, date)
+            if validation_error:
+                return error(400, validation_error)
+            # Запись в очередь синхронизируется с диском (fsync)
+            key = await self.backend.offload(self.spool.append, expense)
+            self.logger.warning(f"База данных недоступна, трата отложена в очередь: {key}")
+            identifier = "idempotency_key" if "idempotency_key" in expense else "expense_id"
+            return 202, {"message": "Трата принята и будет записана позже", identifier: key}, {}
+        except Exception as e:
+            self.logger.exception("Unexpected error in POST handler")
+            return error(500, str(e))
+
+        self.logger.info(f"Expense added: {msg}")
+        self.backend.replay_spool(self.spool)
+        if msg.startswith("Ошибка:"):
+            # Валидация не прошла — отдаем 400 Bad Request
+            return error(400, msg)
+        return 200, {"message": msg}, {}
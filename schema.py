@@ -0,0 +1,114 @@
+import re
+from decimal import ROUND_HALF_UP, Decimal
+
+# Версия компактной схемы документа траты.
+#
+# Версия 1 (исходная, поле "v" отсутствует):
+#   {"name": str, "category": str, "amount": float, "date": "дд.мм", "tokens": [...], "idempotency_key": str, "tenant": str}
+# Версия 2 (компактная):
+#   {"v": 2, "n": str, "c": str, "a": int (сумма в копейках), "d": int (день), "m": int (месяц), "t": [...], "k": str, "u": str}
+#
+# Короткие имена полей уменьшают размер документов и индексов, целые копейки
+# не накапливают ошибку округления при суммировании в $group.
+SCHEMA_VERSION = 2
+
+# Соответствие полей версии 1 полям версии 2 (кроме даты, которая раскладывается на "d" и "m")
+FIELDS = {
+    "name": "n",
+    "category": "c",
+    "amount": "a",
+    "tokens": "t",
+    "idempotency_key": "k",
+    "tenant": "u"
+}
+
+# Допуск округления сумм версии 1 в агрегации: amount * 100 в double может оказаться чуть меньше
+# половины копейки (1.005 * 100 = 100.49999999999999), хотя to_minor_units округлит вверх
+ROUNDING_TOLERANCE = 1e-6
+
+# Выражения агрегации, дающие значение поля для документа любой версии.
+# Сумма версии 1 округляется до копеек половиной вверх, как в to_minor_units
+# ($round не подходит: он округляет половину к чётному)
+CATEGORY_EXPR = {"$ifNull": ["$c", "$category"]}
+AMOUNT_MINOR_EXPR = {"$ifNull": ["$a", {"$toLong": {"$floor": {
+    "$add": [{"$multiply": ["$amount", 100]}, 0.5 + ROUNDING_TOLERANCE]
+}}}]}
+
+
+def to_minor_units(amount):
+    """Переводит сумму в рублях (число) в целое число копеек с округлением до ближайшей копейки"""
+    return int((Decimal(str(amount)) * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def from_minor_units(minor):
+    """Переводит целое число копеек в сумму в рублях"""
+    return minor / 100
+
+def encode(document):
+    """
+    Преобразует документ траты версии 1 в документ компактной схемы (версия 2).
+    Поля, которых нет в схеме (например, _id), переносятся без изменений.
+    """
+    encoded = {"v": SCHEMA_VERSION}
+    for key, value in document.items():
+        if key == "date":
+            day, month = value.split(".")
+            encoded["d"] = int(day)
+            encoded["m"] = int(month)
+        elif key == "amount":
+            encoded["a"] = to_minor_units(value)
+        else:
+            encoded[FIELDS.get(key, key)] = value
+    return encoded
+
+def decode(document):
+    """
+    Возвращает документ траты в виде версии 1 (name, category, amount, date, ...) для документа любой версии.
+    Если часть полей не была запрошена (проекция), в результате будут только имеющиеся поля.
+    """
+    if document.get("v") != SCHEMA_VERSION:
+        return document
+    reverse = {short: long for long, short in FIELDS.items()}
+    decoded = {}
+    for key, value in document.items():
+        if key == "v":
+            continue
+        if key == "a":
+            decoded["amount"] = from_minor_units(value)
+        elif key in ("d", "m"):
+            if "d" in document and "m" in document:
+                decoded["date"] = f"{document['d']:02d}.{document['m']:02d}"
+        else:
+            decoded[reverse.get(key, key)] = value
+    return decoded
+
+def field_query(field, condition, legacy=True):
+    """
+    Условие запроса на поле field (имя версии 1) для документов обеих версий.
+    Если legacy=False (все документы уже в версии 2), условие строится только по короткому полю.
+    """
+    short = {FIELDS[field]: condition}
+    if not legacy:
+        return short
+    return {"$or": [short, {field: condition}]}
+
+def month_query(month, legacy=True):
+    """
+    Условие запроса на документы трат за месяц month (строка с ведущим нулём или без).
+    Для некорректного месяца условие не совпадает ни с одним документом.
+    """
+    short = {"m": int(month) if month.isdigit() else 0}
+    if not legacy:
+        return short
+    return {"$or": [short, {"date": {"$regex": r"^\d{1,2}\." + re.escape(month.zfill(2)) + r"$"}}]}
+
+def projection(fields):
+    """Проекция для полей версии 1 fields, включающая соответствующие поля обеих версий"""
+    result = {"v": 1}
+    for field in fields:
+        result[field] = 1
+        if field == "date":
+            result["d"] = 1
+            result["m"] = 1
+        else:
+            result[FIELDS[field]] = 1
+    return result
@@ -0,0 +1,61 @@
+import argparse
+
+from expenses import ExpenseTracker
+from partitioning import PartitionedExpenseTracker
+
+# Параметры командной строки, которые передаются в конструктор ExpenseTracker как есть
+MONGO_OPTIONS = (
+    'mongo_uri', 'reader_uri', 'max_pool_size', 'reader_max_pool_size', 'min_pool_size', 'reader_min_pool_size',
+    'timeout_ms', 'reader_timeout_ms', 'read_preference', 'max_staleness_seconds'
+)
+
+
+def make_tracker(partitions=None, storage_path=None, tracker_options=None):
+    """
+    Создаёт трекер по параметрам запуска сервера (общим для http_server и async_server):
+     - storage_path — FileExpenseTracker, траты в локальном файле (для площадок без MongoDB);
+     - partitions — PartitionedExpenseTracker, пользователи распределены по partitions коллекциям;
+     - иначе — ExpenseTracker.
+    tracker_options — параметры подключения к MongoDB (см. MONGO_OPTIONS и ExpenseTracker.__init__):
+    адрес, отдельный клиент чтения, размеры пулов, таймауты, предпочтение чтения.
+    """
+    tracker_options = tracker_options or {}
+    if storage_path:
+        from file_storage import FileExpenseTracker
+
+        return FileExpenseTracker(storage_path)
+    if partitions:
+        return PartitionedExpenseTracker.from_uri(partitions, **tracker_options)
+    return ExpenseTracker(**tracker_options)
+
+def parse_args(description, argv=None):
+    """
+    Разбирает параметры командной строки сервера:
+    [--port 8080] [--partitions N | --storage-path PATH] [--multi-tenant] [--no-warm-up]
+    и параметры подключения к MongoDB (--mongo-uri, --reader-uri, --read-preference, ...; см. MONGO_OPTIONS).
+    Заданные параметры подключения собираются в словарь args.tracker_options для make_tracker.
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--port', type=int, default=8080, help="порт сервера")
+    parser.add_argument('--partitions', type=int, default=None, help="число разделов пользователей (включает --multi-tenant)")
+    parser.add_argument('--multi-tenant', action='store_true', help="требовать заголовок X-Tenant-Id в каждом запросе")
+    parser.add_argument('--storage-path', default=None, help="хранить траты в локальном файле вместо MongoDB")
+    parser.add_argument('--no-warm-up', action='store_true', help="не прогревать трекер перед открытием порта")
+    mongo = parser.add_argument_group("подключение к MongoDB (параметры ExpenseTracker)")
+    mongo.add_argument('--mongo-uri', help="адрес MongoDB для записи (и для чтения, если не задан --reader-uri)")
+    mongo.add_argument('--reader-uri', help="отдельный адрес для аналитических запросов (например, реплики)")
+    mongo.add_argument('--max-pool-size', type=int, help="размер пула соединений клиента записи")
+    mongo.add_argument('--reader-max-pool-size', type=int, help="размер пула соединений клиента чтения")
+    mongo.add_argument('--min-pool-size', type=int, help="сколько соединений пул записи держит открытыми")
+    mongo.add_argument('--reader-min-pool-size', type=int, help="сколько соединений пул чтения держит открытыми")
+    mongo.add_argument('--timeout-ms', type=int, help="таймауты клиента записи (мс)")
+    mongo.add_argument('--reader-timeout-ms', type=int, help="таймауты клиента чтения (мс)")
+    mongo.add_argument('--read-preference', choices=['primary', 'primaryPreferred', 'secondary', 'secondaryPreferred', 'nearest'],
+                       help="предпочтение чтения для аналитики")
+    mongo.add_argument('--max-staleness-seconds', type=int, help="допустимое отставание реплики (не меньше 90 с)")
+    args = parser.parse_args(argv)
+    args.tracker_options = {name: getattr(args, name) for name in MONGO_OPTIONS if getattr(args, name) is not None}
+    if args.storage_path and (args.partitions or args.multi_tenant or args.tracker_options):
+        parser.error("файловое хранилище (--storage-path) не разделяет траты по пользователям и не подключается к MongoDB: "
+                     "его нельзя сочетать с --partitions, --multi-tenant и параметрами MongoDB")
+    return args
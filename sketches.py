@@ -0,0 +1,256 @@
+import math
+
+# Квантили, которые отдаются по умолчанию: медиана, 90-й и 99-й процентили
+DEFAULT_QUANTILES = (0.5, 0.9, 0.99)
+
+
+class TDigest:
+    """
+    Скетч распределения (t-digest) для приближённого вычисления квантилей.
+
+    Хранит отсортированный список центроидов [среднее, вес]. Центроиды у краёв распределения
+    маленькие, в середине — крупные, поэтому хвосты (p90, p99) считаются точнее медианы.
+    Скетчи можно сливать друг с другом: результат эквивалентен скетчу по объединённым данным.
+    """
+
+    def __init__(self, compression=100, centroids=None, min_value=None, max_value=None):
+        """
+        compression — параметр точности: число центроидов после сжатия порядка compression.
+        """
+        self.compression = compression
+        self.centroids = [list(c) for c in centroids] if centroids else []
+        self.min = min_value
+        self.max = max_value
+        self._buffer = []
+
+    @property
+    def count(self):
+        """Суммарный вес всех значений в скетче"""
+        return sum(w for _, w in self.centroids) + sum(w for _, w in self._buffer)
+
+    def add(self, value, weight=1):
+        """Добавляет значение в скетч. Сжатие выполняется, когда буфер новых значений заполнится"""
+        value = float(value)
+        self._buffer.append([value, weight])
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if len(self._buffer) >= self.compression * 5:
+            self.compress()
+
+    def merge(self, other):
+        """Сливает в этот скетч другой скетч и возвращает self"""
+        if other.min is None:
+            return self
+        self._buffer.extend(list(c) for c in other.centroids)
+        self._buffer.extend(list(c) for c in other._buffer)
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self.compress()
+        return self
+
+    def _k(self, q):
+        """Масштабирующая функция k1: ограничивает размер центроида в зависимости от квантиля q"""
+        return self.compression / (2 * math.pi) * math.asin(2 * min(max(q, 0.0), 1.0) - 1)
+
+    def compress(self):
+        """
+        Сжимает центроиды и буфер: проходит по значениям в порядке возрастания
+        и объединяет соседей, пока центроид укладывается в единицу шкалы k.
+        """
+        points = sorted(self.centroids + self._buffer)
+        self._buffer = []
+        if not points:
+            return
+        total = sum(w for _, w in points)
+        result = []
+        weight_before = 0
+        k_lower = self._k(0)
+        mean, weight = points[0]
+        for next_mean, next_weight in points[1:]:
+            if self._k((weight_before + weight + next_weight) / total) - k_lower <= 1:
+                weight += next_weight
+                mean += (next_mean - mean) * next_weight / weight
+            else:
+                result.append([mean, weight])
+                weight_before += weight
+                k_lower = self._k(weight_before / total)
+                mean, weight = next_mean, next_weight
+        result.append([mean, weight])
+        self.centroids = result
+
+    def quantile(self, q):
+        """
+        Возвращает приближённое значение квантиля q (от 0 до 1) или None для пустого скетча.
+        Между центрами соседних центроидов значение интерполируется линейно,
+        у краёв — между центроидом и точным минимумом/максимумом.
+        """
+        if self._buffer:
+            self.compress()
+        if not self.centroids:
+            return None
+        if len(self.centroids) == 1:
+            return self.centroids[0][0]
+        total = sum(w for _, w in self.centroids)
+        target = q * total
+        # Положение центра первого центроида по накопленному весу
+        first_mean, first_weight = self.centroids[0]
+        if target <= first_weight / 2:
+            return self.min + (first_mean - self.min) * target / (first_weight / 2)
+        cumulative = first_weight / 2
+        for (left_mean, left_weight), (right_mean, right_weight) in zip(self.centroids, self.centroids[1:], strict=False):
+            step = (left_weight + right_weight) / 2
+            if target <= cumulative + step:
+                return left_mean + (right_mean - left_mean) * (target - cumulative) / step
+            cumulative += step
+        last_mean, last_weight = self.centroids[-1]
+        return last_mean + (self.max - last_mean) * min(1.0, (target - cumulative) / (last_weight / 2))
+
+    def to_dict(self):
+        """Представление скетча для сохранения в MongoDB"""
+        self.compress()
+        return {"centroids": self.centroids, "min": self.min, "max": self.max}
+
+    @classmethod
+    def from_dict(cls, data, compression=100):
+        """Восстанавливает скетч из словаря, созданного to_dict"""
+        return cls(compression, data.get("centroids"), data.get("min"), data.get("max"))
+
+
+class SketchStore:
+    """
+    Хранение скетчей трат по парам (месяц, категория) — и по владельцу, если он задан — в коллекции MongoDB.
+
+    Добавление траты — одна атомарная операция: значение (с уникальным идентификатором) дописывается
+    в буфер документа скетча, поэтому несколько процессов-воркеров могут обновлять один скетч одновременно.
+    Когда буфер разрастается, его сливает с центроидами тот, кто первым это заметил: из буфера удаляются
+    только слитые значения, а добавленные за время слияния остаются. Одновременные слияния разделяет
+    проверка поля centroid_version (оптимистическая блокировка), которое меняет только слияние, —
+    поэтому непрерывные добавления не мешают слиянию, и буфер не растёт без ограничения.
+    """
+
+    def __init__(self, collection, compression=100, compact_every=200, read_collection=None):
+        """
+        collection — коллекция для записи скетчей,
+        read_collection — коллекция для запросов процентилей (по умолчанию та же).
+        """
+        self.collection = collection
+        self.read_collection = read_collection if read_collection is not None else collection
+        self.compression = compression
+        self.compact_every = compact_every
+
+    @staticmethod
+    def _key(month, category, tenant=None):
+        if tenant is None:
+            return f"{month}|{category}"
+        return f"{len(tenant)}:{tenant}|{month}|{category}"
+
+    @staticmethod
+    def _fields(month, category, tenant):
+        """Поля документа скетча, по которым выбираются скетчи для слияния"""
+        fields = {"month": month, "category": category}
+        if tenant is not None:
+            fields["tenant"] = tenant
+        return fields
+
+    def add(self, month, category, amount, tenant=None):
+        """
+        Добавляет сумму траты в скетч месяца month (строка 'mm') и категории category
+        (и владельца tenant, если он задан)
+        """
+        from bson import ObjectId
+        from pymongo import ReturnDocument
+
+        doc = self.collection.find_one_and_update(
+            {"_id": self._key(month, category, tenant)},
+            {
+                # Идентификатор отличает значение от равных ему: слияние удаляет из буфера именно его
+                "$push": {"buffer": {"i": ObjectId(), "v": float(amount)}},
+                "$inc": {"pending": 1},
+                "$setOnInsert": self._fields(month, category, tenant)
+            },
+            upsert=True,
+            projection={"pending": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if doc["pending"] >= self.compact_every:
+            self.compact(doc["_id"])
+
+    def _digest(self, doc):
+        """Собирает TDigest из документа скетча: центроиды плюс ещё не слитый буфер"""
+        digest = TDigest.from_dict(doc, self.compression)
+        for entry in doc.get("buffer", []):
+            # В скетчах, записанных до появления идентификаторов, буфер хранит сами суммы
+            digest.add(entry["v"] if isinstance(entry, dict) else entry)
+        return digest
+
+    def compact(self, key):
+        """
+        Сливает прочитанный буфер документа скетча с его центроидами и удаляет из буфера только слитые значения.
+        Если центроиды успело обновить другое слияние, ничего не делает: слияние повторит следующая запись.
+        """
+        doc = self.collection.find_one({"_id": key})
+        if not doc or not doc.get("buffer"):
+            return
+        consumed = doc["buffer"]
+        state = self._digest(doc).to_dict()
+        self.collection.update_one(
+            {"_id": key, "centroid_version": doc.get("centroid_version")},
+            {
+                "$set": state,
+                "$pull": {"buffer": {"$in": consumed}},
+                "$inc": {"pending": -len(consumed), "centroid_version": 1}
+            }
+        )
+
+    def merged(self, months=None, category=None, tenant=None):
+        """
+        Возвращает TDigest, слитый из скетчей указанных месяцев (список строк 'mm', None — все месяцы),
+        категории (None — все категории) и владельца (None — все владельцы).
+        """
+        query = {}
+        if tenant is not None:
+            query["tenant"] = tenant
+        if months:
+            query["month"] = {"$in": list(months)}
+        if category:
+            query["category"] = category
+        digest = TDigest(self.compression)
+        for doc in self.read_collection.find(query):
+            digest.merge(self._digest(doc))
+        return digest
+
+    def rebuild(self, expenses, added_since=None):
+        """
+        Пересчитывает все скетчи заново по итератору документов трат.
+        Нужен один раз для трат, добавленных до появления скетчей.
+
+        Новые скетчи строятся во временной коллекции и заменяют старые переименованием,
+        поэтому процентили доступны всё время пересчёта. Суммы, которые add записал в старые скетчи
+        за это время, пропали бы вместе с ними: added_since() вызывается прямо перед заменой
+        и возвращает траты, добавленные после начала пересчёта, — они досчитываются в новые скетчи.
+        Суммы, добавленные между вызовом added_since() и заменой, всё же теряются
+        (см. ограничения в ExpenseTracker.rebuild_sketches).
+        """
+        digests = {}
+        for expense in expenses:
+            key = (expense["date"].split(".")[1], expense["category"], expense.get("tenant"))
+            digests.setdefault(key, TDigest(self.compression)).add(expense["amount"])
+
+        temp = self.collection.database[f"{self.collection.name}_rebuild"]
+        temp.drop()
+        if digests:
+            temp.insert_many([{
+                "_id": self._key(month, category, tenant),
+                **self._fields(month, category, tenant),
+                **digest.to_dict(),
+                "buffer": [],
+                "pending": 0,
+                "centroid_version": 0
+            } for (month, category, tenant), digest in digests.items()])
+        added = list(added_since()) if added_since else []
+        if digests:
+            temp.rename(self.collection.name, dropTarget=True)
+        else:
+            self.collection.delete_many({})
+        for expense in added:
+            self.add(expense["date"].split(".")[1], expense["category"], expense["amount"], expense.get("tenant"))
@@ -0,0 +1,29 @@
+from admission import READ, WRITE, AdmissionController
+
+
+def test_token_bucket_refills_over_time(clock):
+    """
+    Проверяем, что после исчерпания burst запросы отклоняются с Retry-After,
+    а по мере пополнения ведра снова разрешаются. Клиенты не влияют друг на друга.
+    """
+    admission = AdmissionController(rate=1.0, burst=2, clock=clock)
+    assert admission.check_rate('1.1.1.1') is None
+    assert admission.check_rate('1.1.1.1') is None
+    assert admission.check_rate('1.1.1.1') == 1
+    assert admission.check_rate('2.2.2.2') is None
+    clock.now = 1.0
+    assert admission.check_rate('1.1.1.1') is None
+    assert admission.rate_limited == 1
+
+def test_in_flight_limits_per_route_class():
+    """
+    Проверяем, что лимиты одновременных запросов на чтение и запись независимы,
+    а освобождённый слот снова можно занять.
+    """
+    admission = AdmissionController(read_limit=1, write_limit=1)
+    assert admission.acquire(READ)
+    assert not admission.acquire(READ)
+    assert admission.acquire(WRITE)
+    admission.release(READ)
+    assert admission.acquire(READ)
+    assert admission.stats()[READ] == {"limit": 1, "in_flight": 1, "admitted": 2, "rejected": 1}
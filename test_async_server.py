@@ -0,0 +1,120 @@
+import asyncio
+import socket
+import threading
+import time
+
+import mongomock
+import pytest
+import requests
+
+import async_server
+from admission import AdmissionController
+from async_server import AsyncExpenseTracker
+from expenses import ExpenseTracker
+from resilience import SnapshotStore, Spool
+
+
+@pytest.fixture(scope='function')
+def mock_tracker(monkeypatch, tmp_path):
+    """
+    ExpenseTracker с базой в памяти (mongomock) за асинхронным фасадом;
+    свежие контроль допуска, снимок и очередь для каждого теста.
+    """
+    tracker = ExpenseTracker(db_client=mongomock.MongoClient())
+    monkeypatch.setattr(async_server, 'async_tracker', AsyncExpenseTracker(tracker))
+    monkeypatch.setattr(async_server, 'admission', AdmissionController())
+    monkeypatch.setattr(async_server, 'snapshots', SnapshotStore())
+    monkeypatch.setattr(async_server, 'spool', Spool(str(tmp_path / 'expenses.spool')))
+    return tracker
+
+@pytest.fixture(scope='function')
+def start_async_server(mock_tracker):
+    """Запускает цикл событий с сервером в отдельном потоке и останавливает его после теста"""
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(asyncio.start_server(async_server.handle_connection, 'localhost', 8082))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    yield 'http://localhost:8082'
+
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+    loop.close()
+
+def test_same_routes_as_sync_server(start_async_server):
+    """POST /expenses и аналитические пути отвечают так же, как синхронный сервер"""
+    url = start_async_server
+    with requests.Session() as session:
+        response = session.post(url + '/expenses', json={"name": "сыр", "category": "еда", "amount": 300, "date": "10.06"})
+        assert response.status_code == 200
+        assert "добавлена" in response.json()["message"]
+        assert session.post(url + '/expenses', json={"name": ""}).json() == {
+            "error": "Bad Request",
+            "message": "Недостаточно данных для добавления траты!"
+        }
+        assert list(session.get(f"{url}/categories/top?month=06").json().values()) == ["Еда"]
+        assert list(session.get(f"{url}/expenses/largest?month=06&category=еда").json().values()) == ["Сыр"]
+        assert session.get(f"{url}/expenses/percentiles?month=06").json()["count"] == 1
+        assert session.get(f"{url}/expenses/search?q=сы").json()[0]["name"] == "Сыр"
+        records = session.get(f"{url}/expenses/full_records?limit=1")
+        assert records.headers['X-Next-Cursor'] == records.json()[0]['_id']['$oid']
+        assert session.get(f"{url}/categories/top?month=07").status_code == 404
+        assert session.get(f"{url}/unknown").status_code == 404
+        assert session.get(f"{url}/metrics").json()["read"]["admitted"] == 7
+
+def test_keep_alive_serves_several_requests_on_one_connection(start_async_server):
+    """Несколько запросов подряд по одному соединению HTTP/1.1; Connection: close закрывает его"""
+    with socket.create_connection(('localhost', 8082)) as sock:
+        request = b"GET /categories/top?month=06 HTTP/1.1\r\nHost: localhost\r\n\r\n"
+        sock.sendall(request + request.replace(b"\r\n\r\n", b"\r\nConnection: close\r\n\r\n"))
+        data = b""
+        while chunk := sock.recv(65536):
+            data += chunk
+    assert data.count(b"HTTP/1.1 404 Not Found") == 2
+    assert b"Connection: keep-alive" in data
+    assert b"Connection: close" in data
+
+def test_malformed_request_gets_400(start_async_server):
+    """Неразборчивая строка запроса — 400 и закрытие соединения"""
+    with socket.create_connection(('localhost', 8082)) as sock:
+        sock.sendall(b"garbage\r\n\r\n")
+        assert sock.recv(65536).startswith(b"HTTP/1.1 400 Bad Request")
+    # Путь, который urlparse не разбирает, — тоже 400, а не обрыв соединения
+    with socket.create_connection(('localhost', 8082)) as sock:
+        sock.sendall(b"GET //[x/metrics HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+        assert sock.recv(65536).startswith(b"HTTP/1.1 400 Bad Request")
+
+def test_identical_analytics_queries_are_coalesced():
+    """Одинаковые одновременные запросы выполняются в базе один раз, разные — отдельно"""
+    calls = []
+
+    class SlowTracker:
+        def get_top_category(self, month, tenant=None):
+            calls.append(month)
+            time.sleep(0.1)
+            return "Еда"
+
+    facade = AsyncExpenseTracker(SlowTracker())
+
+    async def main():
+        return await asyncio.gather(*[facade.get_top_category("06") for _ in range(10)], facade.get_top_category("07"))
+
+    assert asyncio.run(main()) == ["Еда"] * 11
+    assert sorted(calls) == ["06", "07"]
+    assert facade._in_flight == {}
+
+def test_transfer_encoding_rejected_and_connection_closed(start_async_server):
+    """Запрос с Transfer-Encoding получает 501, а остаток потока не разбирается как следующий запрос"""
+    with socket.create_connection(('localhost', 8082)) as sock:
+        sock.sendall(
+            b"POST /expenses HTTP/1.1\r\nHost: localhost\r\nTransfer-Encoding: chunked\r\nContent-Length: 4\r\n\r\n"
+            b"0\r\n\r\nGET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n"
+        )
+        data = b""
+        while chunk := sock.recv(65536):
+            data += chunk
+    assert data.startswith(b"HTTP/1.1 501 Not Implemented")
+    assert data.count(b"HTTP/1.1") == 1
+    assert b"Connection: close" in data
@@ -0,0 +1,38 @@
+from cache import TTLCache
+
+
+def test_ttl_cache_expires_entries(clock):
+    """
+    Проверяем, что запись доступна до истечения ttl и пропадает после.
+    """
+    cache = TTLCache(maxsize=10, ttl=5, clock=clock)
+    cache.set('a', 1)
+    clock.now = 4.9
+    assert cache.get('a') == 1
+    clock.now = 5.0
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+def test_ttl_cache_evicts_least_recently_used():
+    """
+    Проверяем, что при переполнении вытесняется запись, к которой дольше всего не обращались.
+    """
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+def test_ttl_cache_items_skip_expired(clock):
+    """
+    Проверяем, что items возвращает только неустаревшие записи.
+    """
+    cache = TTLCache(maxsize=10, ttl=5, clock=clock)
+    cache.set('a', 1)
+    clock.now = 3
+    cache.set('b', 2)
+    clock.now = 5
+    assert cache.items() == [('b', 2)]
@@ -0,0 +1,107 @@
+import mongomock
+
+from change_feed import ChangeFeed
+from expenses import ExpenseTracker
+
+
+def make_process(client):
+    """Трекер с кэшем аналитики и уведомлениями через опрос — как в отдельном процессе сервера"""
+    tracker = ExpenseTracker(db_client=client)
+    feed = ChangeFeed(tracker.collection, tracker.db['cache_versions'], mode='poll')
+    tracker.enable_analytics_cache(feed)
+    feed.poll()
+    return tracker, feed
+
+def test_other_process_write_evicts_only_affected_keys():
+    """Трата, добавленная другим процессом, вытесняет только ключи её месяца и категории"""
+    client = mongomock.MongoClient()
+    reader, reader_feed = make_process(client)
+    writer, _ = make_process(client)
+    writer.add_expense("сыр", "еда", 300, "10.06")
+    writer.add_expense("вино", "напитки", 500, "10.07")
+    # Два прохода: повторно уведомляет о прошлом окне только первый
+    reader_feed.poll()
+    reader_feed.poll()
+    assert reader.get_top_category("6") == "Еда"
+    assert reader.get_max_expense("06", "еда")["name"] == "Сыр"
+    assert reader.get_top_category("07") == "Напитки"
+
+    writer.add_expense("кола", "напитки", 1000, "11.06")
+    # Пока уведомление не получено, отдаётся закэшированный результат
+    assert reader.get_top_category("06") == "Еда"
+    assert reader_feed.poll() == 1
+    assert reader.get_top_category("06") == "Напитки"
+    assert reader.get_max_expense("06", "еда")["name"] == "Сыр"
+    assert reader.analytics_cache.get(("top", None, "07")) == "Напитки"
+
+def test_own_write_evicts_immediately_and_tenant_keys():
+    """Своя запись вытесняет кэш сразу — и для владельца, и для запросов по всем владельцам"""
+    tracker, _ = make_process(mongomock.MongoClient())
+    tracker.add_expense("сыр", "еда", 300, "10.06", tenant="alice")
+    assert tracker.get_max_expense("06", "еда", tenant="alice")["amount"] == 300
+    assert tracker.get_max_expense("06", "еда")["amount"] == 300
+    tracker.add_expense("хамон", "еда", 900, "12.06", tenant="alice")
+    assert tracker.get_max_expense("06", "еда", tenant="alice")["amount"] == 900
+    assert tracker.get_max_expense("06", "еда")["amount"] == 900
+
+def test_poll_overlap_reports_late_writes():
+    """Изменение, записанное после прохода опроса с большим номером, не теряется"""
+    client = mongomock.MongoClient()
+    tracker, feed = make_process(client)
+    versions = tracker.db['cache_versions']
+    seen = []
+    feed.subscribe(lambda tenant, month, category: seen.append((month, category)))
+    # Номер 1 выделен, но документ ключа ещё не записан; номер 2 записан сразу
+    versions.insert_one({"_id": "seq", "seq": 2})
+    versions.insert_one({"_id": "07|Напитки", "seq": 2, "tenant": None, "month": "07", "category": "Напитки"})
+    feed.poll()
+    versions.insert_one({"_id": "06|Еда", "seq": 1, "tenant": None, "month": "06", "category": "Еда"})
+    feed.poll()
+    assert ("06", "Еда") in seen
+
+def test_auto_mode_falls_back_to_polling_on_mongomock():
+    """mongomock не поддерживает change streams — режим auto переходит на опрос"""
+    tracker = ExpenseTracker(db_client=mongomock.MongoClient())
+    feed = ChangeFeed(tracker.collection, tracker.db['cache_versions'], poll_interval=0.01)
+    feed.start()
+    try:
+        assert feed.mode == 'poll'
+    finally:
+        feed.stop()
+
+def test_eviction_during_compute_discards_only_that_key():
+    """
+    Результат, посчитанный во время вытеснения своего ключа, не кэшируется;
+    вытеснение другого ключа на него не влияет.
+    """
+    tracker, _ = make_process(mongomock.MongoClient())
+    tracker.add_expense("сыр", "еда", 300, "10.06")
+
+    def compute_with_eviction(month, category):
+        def compute():
+            tracker.evict_analytics(None, month, category)
+            return "Еда"
+        return compute
+
+    assert tracker._cached(("top", None, "06"), compute_with_eviction("07", "Еда")) == "Еда"
+    assert tracker.analytics_cache.get(("top", None, "06")) == "Еда"
+    assert tracker._cached(("top", None, "08"), compute_with_eviction("08", "Еда")) == "Еда"
+    assert tracker.analytics_cache.get(("top", None, "08")) is None
+    assert tracker._computing == {}
+
+def test_cached_analytics_read_from_reader_by_default():
+    """
+    С включённым кэшем аналитика по умолчанию по-прежнему идёт через клиента чтения,
+    а с consistent_reads=True кэшируемые запросы читают основной сервер (клиент записи).
+    """
+    writer, reader = mongomock.MongoClient(), mongomock.MongoClient()
+    tracker = ExpenseTracker(db_client=writer, reader_client=reader)
+    tracker.enable_analytics_cache(ChangeFeed(tracker.collection, tracker.db['cache_versions'], mode='poll'))
+    tracker.add_expense("сыр", "еда", 300, "10.06")
+    assert reader['expenses_db']['expenses'].count_documents({}) == 0
+    assert tracker.get_top_category("06") is None
+
+    tracker = ExpenseTracker(db_client=writer, reader_client=reader)
+    tracker.enable_analytics_cache(ChangeFeed(tracker.collection, tracker.db['cache_versions'], mode='poll'), consistent_reads=True)
+    assert tracker.get_top_category("06") == "Еда"
+    assert tracker.get_max_expense("06", "еда")["name"] == "Сыр"
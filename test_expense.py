@@ -1,5 +1,11 @@
+import threading
+import time
+
 import mongomock
-from expenses import Expense, ExpenseTracker
+import pytest
+from bson import ObjectId
+from change_feed import ChangeFeed
+from expenses import Expense, ExpenseTracker, _connection_counter
 
 # ----- Тесты класса Expense ------
 
@@ -55,11 +61,12 @@ def test_add_expense_success():
     assert "Трата 'Молоко' добавлена" in msg
     # Проверяем, что запись действительно добавлена в коллекцию
     assert mock_client['expenses_db']['expenses'].count_documents({}) == 1
-    # Извлекаем и проверяем сам документ
-    expense = mock_client['expenses_db']['expenses'].find_one({'name': 'Молоко'})
-    assert expense['category'] == 'Еда'
-    assert expense['amount'] == 100
-    assert expense['date'] == '02.05'
+    # Извлекаем и проверяем сам документ (компактная схема версии 2: сумма в копейках, дата — числами)
+    expense = mock_client['expenses_db']['expenses'].find_one({'n': 'Молоко'})
+    assert expense['v'] == 2
+    assert expense['c'] == 'Еда'
+    assert expense['a'] == 10000
+    assert (expense['d'], expense['m']) == (2, 5)
 
 def test_add_expense_missing_field_name():
     """
@@ -268,3 +275,287 @@ def test_get_full_records():
     # Можно проверить, что все вставленные траты есть в результатах
     names = {record['name'] for record in records}
     assert {'Апельсин', 'Банан', 'Ананас', 'Автомобиль'}.issubset(names)
+
+def test_add_expense_idempotency_key_no_duplicate():
+    """
+    Проверяем, что повтор add_expense с тем же ключом идемпотентности
+    возвращает исходное сообщение и не создаёт вторую запись.
+    """
+    tracker, mock_client = make_tracker()
+    first = tracker.add_expense('молоко', 'еда', 100, '02.05', idempotency_key='key-1')
+    second = tracker.add_expense('молоко', 'еда', 100, '02.05', idempotency_key='key-1')
+    assert first == second
+    assert mock_client['expenses_db']['expenses'].count_documents({}) == 1
+    # Другой ключ — другая трата
+    tracker.add_expense('молоко', 'еда', 100, '02.05', idempotency_key='key-2')
+    assert mock_client['expenses_db']['expenses'].count_documents({}) == 2
+
+def test_add_expense_idempotency_key_across_trackers():
+    """
+    Проверяем дедупликацию через уникальный индекс в MongoDB:
+    второй трекер (другой процесс) с пустым кэшем получает ответ по исходной записи.
+    """
+    tracker, mock_client = make_tracker()
+    other = ExpenseTracker(db_client=mock_client)
+    first = tracker.add_expense('молоко', 'еда', 100, '02.05', idempotency_key='key-1')
+    retry = other.add_expense('молоко', 'еда', 999, '03.05', idempotency_key='key-1')
+    assert retry == first
+    assert mock_client['expenses_db']['expenses'].count_documents({}) == 1
+    assert tracker.get_top_category('05') == 'Еда'
+
+def test_add_expense_expense_id_no_duplicate():
+    """
+    Проверяем, что повтор с тем же expense_id (трата из очереди сервера) отклоняется индексом _id:
+    ответ — по исходной записи, второй записи и поля ключа идемпотентности нет, кэш ключей не пополняется.
+    """
+    tracker, mock_client = make_tracker()
+    expense_id = str(ObjectId())
+    first = tracker.add_expense('молоко', 'еда', 100, '02.05', expense_id=expense_id)
+    retry = ExpenseTracker(db_client=mock_client).add_expense('молоко', 'еда', 100, '02.05', expense_id=expense_id)
+    assert retry == first
+    documents = list(mock_client['expenses_db']['expenses'].find())
+    assert [doc["_id"] for doc in documents] == [ObjectId(expense_id)]
+    assert "k" not in documents[0]
+    assert len(tracker.idempotency_cache._data) == 0
+
+def test_add_expense_expense_id_with_other_key():
+    """
+    Проверяем, что повтор с тем же expense_id, но другим ключом идемпотентности
+    получает ответ по исходной записи, а не ошибку.
+    """
+    tracker, mock_client = make_tracker()
+    expense_id = str(ObjectId())
+    first = tracker.add_expense('молоко', 'еда', 100, '02.05', 'key-1', expense_id=expense_id)
+    retry = ExpenseTracker(db_client=mock_client).add_expense('молоко', 'еда', 100, '02.05', 'key-2', expense_id=expense_id)
+    assert retry == first
+    assert mock_client['expenses_db']['expenses'].count_documents({}) == 1
+
+def test_write_v1_requires_legacy_reads():
+    """Проверяем, что трекер, который пишет в версии 1, но не читает её, не создаётся"""
+    with pytest.raises(ValueError):
+        ExpenseTracker(db_client=mongomock.MongoClient(), schema_version=1, legacy_reads=False)
+
+def test_get_percentiles_by_month_and_category():
+    """
+    Проверяем процентили по скетчам: за месяц и категорию, по всем категориям месяца,
+    по нескольким месяцам сразу, а также None при отсутствии трат.
+    """
+    tracker, _ = make_tracker()
+    for amount in range(1, 101):
+        tracker.add_expense('обед', 'еда', amount, '10.05')
+    tracker.add_expense('шины', 'авто', 5000, '11.05')
+    tracker.add_expense('бензин', 'авто', 1000, '11.06')
+
+    food = tracker.get_percentiles(['5'], 'ЕДА')
+    assert food['count'] == 100
+    assert abs(food['p50'] - 50) <= 2
+    assert abs(food['p90'] - 90) <= 2
+    assert tracker.get_percentiles(['05'])['count'] == 101
+    assert tracker.get_percentiles(['05', '06'], 'авто')['count'] == 2
+    assert tracker.get_percentiles(['07']) is None
+
+def test_rebuild_sketches():
+    """
+    Проверяем, что скетчи пересчитываются по тратам, добавленным в обход add_expense.
+    """
+    tracker, mock_client = make_tracker()
+    mock_client['expenses_db']['expenses'].insert_one({"name": "Сыр", "category": "Еда", "amount": 300.0, "date": "10.06"})
+    assert tracker.get_percentiles(['06']) is None
+    tracker.rebuild_sketches()
+    assert tracker.get_percentiles(['06'])['p50'] == 300.0
+
+def test_rebuild_sketches_keeps_concurrent_adds():
+    """
+    Траты, добавленные во время пересчёта скетчей, не теряются при замене коллекции скетчей.
+    """
+    tracker, mock_client = make_tracker()
+    mock_client['expenses_db']['expenses'].insert_one({"name": "Сыр", "category": "Еда", "amount": 300.0, "date": "10.06"})
+    rebuild = tracker.sketches.rebuild
+
+    def rebuild_with_concurrent_add(expenses, added_since=None):
+        tracker.add_expense('кола', 'еда', 100, '11.06')  # попадает в старые скетчи
+        rebuild(expenses, added_since)
+
+    tracker.sketches.rebuild = rebuild_with_concurrent_add
+    tracker.rebuild_sketches()
+    assert tracker.get_percentiles(['06'])['count'] == 2
+    assert 'sketches_rebuild' not in mock_client['expenses_db'].list_collection_names()
+
+def test_sketch_failure_does_not_fail_saved_expense():
+    """
+    Если трата сохранена, а скетч обновить не удалось, add_expense всё равно сообщает об успехе.
+    """
+    tracker, _ = make_tracker()
+
+    def broken_add(*args, **kwargs):
+        raise RuntimeError("скетчи недоступны")
+
+    tracker.sketches.add = broken_add
+    assert "добавлена" in tracker.add_expense('сыр', 'еда', 300, '10.06')
+    assert tracker.collection.count_documents({}) == 1
+
+def test_search_expenses_prefix_and_tokens():
+    """
+    Проверяем поиск по названию: префикс последнего слова, совпадение слов целиком,
+    без учёта регистра, с фильтрами по месяцу и категории.
+    """
+    tracker, _ = make_tracker()
+    tracker.add_expense('молоко пастеризованное', 'еда', 100, '10.05')
+    tracker.add_expense('молочный коктейль', 'еда', 150, '11.05')
+    tracker.add_expense('молоток', 'инструменты', 500, '12.06')
+
+    assert [e['name'] for e in tracker.search_expenses('мол')] == ['Молоко пастеризованное', 'Молочный коктейль', 'Молоток']
+    assert [e['name'] for e in tracker.search_expenses('МОЛОКО паст')] == ['Молоко пастеризованное']
+    assert tracker.search_expenses('мол', month='6') == [{"name": "Молоток", "category": "Инструменты", "amount": 500.0, "date": "12.06"}]
+    assert [e['name'] for e in tracker.search_expenses('мол', category='ЕДА', limit=1)] == ['Молоко пастеризованное']
+    assert tracker.search_expenses('кефир') == []
+    assert tracker.search_expenses('  ') == []
+    for limit in (0, -1, 501):
+        with pytest.raises(ValueError):
+            tracker.search_expenses('мол', limit=limit)
+
+def test_backfill_search_tokens():
+    """
+    Проверяем, что траты, сохранённые без поля tokens, после заполнения находятся поиском.
+    """
+    tracker, mock_client = make_tracker()
+    collection = mock_client['expenses_db']['expenses']
+    collection.insert_many([
+        {"name": "Сыр", "category": "Еда", "amount": 300.0, "date": "10.06"},
+        {"name": "Сырок", "category": "Еда", "amount": 50.0, "date": "11.06"}
+    ])
+    assert tracker.search_expenses('сыр') == []
+    assert tracker.backfill_search_tokens(batch_size=1) == 2
+    assert len(tracker.search_expenses('сыр')) == 2
+    assert tracker.backfill_search_tokens() == 0
+
+def test_get_full_records_keyset_pagination():
+    """
+    Проверяем постраничную выдачу get_full_records: страницы по limit записей
+    следуют друг за другом по курсору (_id последней записи) без пропусков и повторов.
+    """
+    tracker, _ = make_tracker()
+    for day in range(1, 6):
+        tracker.add_expense(f'трата {day}', 'еда', 100, f'{day}.05')
+    first = tracker.get_full_records(limit=2)
+    second = tracker.get_full_records(after=str(first[-1]['_id']), limit=2)
+    third = tracker.get_full_records(after=str(second[-1]['_id']), limit=2)
+    names = [r['name'] for r in first + second + third]
+    assert names == ['Трата 1', 'Трата 2', 'Трата 3', 'Трата 4', 'Трата 5']
+    assert tracker.get_full_records(after=str(third[-1]['_id']), limit=2) == []
+
+def test_get_full_records_filters_and_fields():
+    """
+    Проверяем фильтры по месяцу и категории и проекцию полей в get_full_records,
+    а также ошибки на некорректный курсор и неизвестное поле.
+    """
+    tracker, _ = make_tracker()
+    tracker.add_expense('сыр', 'еда', 300, '10.06')
+    tracker.add_expense('шины', 'авто', 900, '11.06')
+    tracker.add_expense('кола', 'еда', 100, '10.07')
+    records = tracker.get_full_records(month='6', category='ЕДА', fields=['name', 'amount'])
+    assert len(records) == 1
+    assert set(records[0]) == {'_id', 'name', 'amount'}
+    assert records[0]['name'] == 'Сыр'
+    # Служебные поля по умолчанию не возвращаются
+    assert 'tokens' not in tracker.get_full_records()[0]
+    with pytest.raises(ValueError):
+        tracker.get_full_records(after='not-a-cursor')
+    with pytest.raises(ValueError):
+        tracker.get_full_records(fields=['password'])
+
+def test_read_write_client_routing():
+    """
+    Проверяем маршрутизацию по двум mongomock-клиентам: add_expense пишет только в клиента записи,
+    а аналитика (get_top_category, get_max_expense, get_full_records, поиск, процентили) читает из клиента чтения.
+    """
+    writer, reader = mongomock.MongoClient(), mongomock.MongoClient()
+    tracker = ExpenseTracker(db_client=writer, reader_client=reader)
+    tracker.add_expense('молоко', 'еда', 100, '02.05')
+    assert writer['expenses_db']['expenses'].count_documents({}) == 1
+    assert reader['expenses_db']['expenses'].count_documents({}) == 0
+    # Реплика ещё не получила запись — аналитика её не видит
+    assert tracker.get_top_category('05') is None
+    assert tracker.get_full_records() == []
+    assert tracker.get_percentiles(['05']) is None
+
+    # "Репликация": документы появляются у клиента чтения
+    for name in ('expenses', 'sketches'):
+        reader['expenses_db'][name].insert_many(list(writer['expenses_db'][name].find({})))
+    assert tracker.get_top_category('05') == 'Еда'
+    assert tracker.get_max_expense('05', 'еда')['name'] == 'Молоко'
+    assert len(tracker.get_full_records()) == 1
+    assert tracker.search_expenses('мол')[0]['name'] == 'Молоко'
+    assert tracker.get_percentiles(['05'])['count'] == 1
+
+def test_reader_read_preference_and_staleness():
+    """
+    Проверяем, что коллекция чтения получает заданное предпочтение чтения и допустимое отставание,
+    а неизвестное предпочтение отклоняется.
+    """
+    client = mongomock.MongoClient()
+    tracker = ExpenseTracker(db_client=client, read_preference='secondary', max_staleness_seconds=120)
+    assert tracker.read_collection.read_preference.mongos_mode == 'secondary'
+    assert tracker.read_collection.read_preference.max_staleness == 120
+    assert ExpenseTracker(db_client=client, read_preference='primary').read_collection.read_preference.mongos_mode == 'primary'
+    with pytest.raises(ValueError):
+        ExpenseTracker(db_client=client, read_preference='fastest')
+
+def test_warm_up_prefills_analytics_cache():
+    """
+    Прогрев проверяет соединение и заранее выполняет аналитику за месяц:
+    с включённым кэшем её результаты отдаются без запросов к базе.
+    """
+    tracker = ExpenseTracker(db_client=mongomock.MongoClient())
+    tracker.enable_analytics_cache(ChangeFeed(tracker.collection, tracker.db['cache_versions'], mode='poll'))
+    tracker.add_expense('сыр', 'еда', 300, '10.06')
+    tracker.add_expense('кола', 'напитки', 100, '11.06')
+    tracker.warm_up(month='06')
+    assert tracker.analytics_cache.get(("top", None, "06")) == 'Еда'
+    assert tracker.analytics_cache.get(("max", None, "06", "Напитки"))['name'] == 'Кола'
+
+def test_warm_up_waits_for_min_pool():
+    """
+    Прогрев дожидается, пока пул откроет min_pool_size соединений, а к сроку
+    незаполненный пул не мешает запуску.
+    """
+    tracker = ExpenseTracker(db_client=mongomock.MongoClient())
+    counter = _connection_counter()
+    tracker._pools.append((tracker.client, counter, 2))
+
+    def open_connections():
+        time.sleep(0.1)
+        counter.connection_created(None)
+        counter.connection_created(None)
+
+    thread = threading.Thread(target=open_connections)
+    thread.start()
+    tracker.warm_up(month='06')
+    thread.join()
+    assert counter.open_connections == 2
+
+    counter.connection_closed(None)
+    started = time.monotonic()
+    tracker.warm_up(month='06', timeout=0.1)
+    assert time.monotonic() - started < 1
+
+def test_make_client_sets_min_pool_size():
+    """ Клиенты, создаваемые трекером, держат min_pool_size соединений и считают открытые соединения """
+    tracker = ExpenseTracker(mongo_uri='mongodb://localhost:27017/', reader_uri='mongodb://localhost:27018/',
+                             min_pool_size=3, reader_min_pool_size=1)
+    try:
+        assert tracker.client.options.pool_options.min_pool_size == 3
+        assert tracker.reader_client.options.pool_options.min_pool_size == 1
+        assert [pool[2] for pool in tracker._pools] == [3, 1]
+        assert tracker._pools[0][1] in tracker.client.options.event_listeners
+    finally:
+        tracker.client.close()
+        tracker.reader_client.close()
+
+def test_reader_defaults_to_primary():
+    """
+    По умолчанию аналитика читает с основного сервера — чтение сразу после записи видит новую трату.
+    """
+    tracker = ExpenseTracker(db_client=mongomock.MongoClient())
+    assert tracker.read_collection.read_preference.mongos_mode == 'primary'
+    assert tracker.sketches.read_collection.read_preference.mongos_mode == 'primary'
@@ -0,0 +1,176 @@
+import os
+
+import pytest
+
+from file_storage import INDEX_MAGIC, RECORD, FileExpenseTracker, FileStorage
+
+
+def make_file_tracker(tmp_path):
+    """
+    Утилита для создания FileExpenseTracker во временной папке теста.
+    fsync отключён, чтобы тесты не тормозили на сбросе на диск.
+    """
+    return FileExpenseTracker(str(tmp_path / 'expenses.seg'), fsync=False)
+
+def test_file_add_expense_and_full_records(tmp_path):
+    """
+    Проверяем, что add_expense с той же валидацией сохраняет трату в файл,
+    а get_full_records возвращает её в том же виде, что и документ MongoDB.
+    """
+    tracker = make_file_tracker(tmp_path)
+    msg = tracker.add_expense('молоко', 'еда', 100, '2.5')
+    assert "Трата 'Молоко' добавлена" in msg
+    assert tracker.get_full_records() == [
+        {"_id": 0, "name": "Молоко", "category": "Еда", "amount": 100.0, "date": "02.05"}
+    ]
+    # Ошибка валидации — в файл ничего не пишется
+    assert tracker.add_expense('молоко', 'еда', -1, '02.05').startswith("Ошибка:")
+    assert len(tracker.get_full_records()) == 1
+
+def test_file_analytics(tmp_path):
+    """
+    Проверяем get_top_category и get_max_expense на файловом хранилище,
+    в том числе месяц без ведущего нуля и отсутствие данных.
+    """
+    tracker = make_file_tracker(tmp_path)
+    tracker.add_expense('молоко', 'еда', 100, '10.05')
+    tracker.add_expense('бензин', 'авто', 200, '21.05')
+    tracker.add_expense('соки', 'еда', 150, '15.05')
+    tracker.add_expense('шины', 'авто', 900, '15.06')
+    assert tracker.get_top_category('5') == 'Еда'
+    assert tracker.get_top_category('06') == 'Авто'
+    assert tracker.get_top_category('08') is None
+    assert tracker.get_max_expense('05', 'ЕДА') == {"name": "Соки", "category": "Еда", "amount": 150.0, "date": "15.05"}
+    assert tracker.get_max_expense('05', 'техника') is None
+
+def test_file_storage_reopen_uses_index(tmp_path):
+    """
+    Проверяем, что после повторного открытия данные и индекс по месяцам восстанавливаются.
+    """
+    path = str(tmp_path / 'expenses.seg')
+    tracker = FileExpenseTracker(path, fsync=False)
+    tracker.add_expense('молоко', 'еда', 100, '10.05')
+    tracker.add_expense('шины', 'авто', 900, '15.06')
+    tracker.storage.close()
+
+    reopened = FileStorage(path, fsync=False)
+    assert list(reopened.months[5]) == [0]
+    assert list(reopened.months[6]) == [1]
+    assert [r["name"] for r in reopened.iter_records(6)] == ['Шины']
+
+def test_file_storage_recovers_after_crash(tmp_path):
+    """
+    Имитируем сбой: индекс отстал от сегмента, а последняя запись сегмента записана не полностью.
+    Хвост сегмента должен дочитаться в индекс, а неполная запись — отброситься.
+    """
+    path = str(tmp_path / 'expenses.seg')
+    storage = FileStorage(path, fsync=False)
+    storage.insert_one({"name": "Молоко", "category": "Еда", "amount": 100, "date": "10.05"})
+    storage.insert_one({"name": "Шины", "category": "Авто", "amount": 900, "date": "15.06"})
+    storage.close()
+
+    # Индекс "потерял" последнюю запись, в сегмент дописан обрывок записи
+    with open(path + '.06.idx', 'r+b') as f:
+        f.truncate(len(INDEX_MAGIC))
+    with open(path, 'ab') as f:
+        f.write(b'\x01' * (RECORD.size // 2))
+
+    reopened = FileStorage(path, fsync=False)
+    assert reopened.count == 2
+    assert list(reopened.months[6]) == [1]
+    reopened.insert_one({"name": "Соки", "category": "Еда", "amount": 50, "date": "01.05"})
+    assert [r["name"] for r in reopened.iter_records(5)] == ['Молоко', 'Соки']
+
+def test_file_storage_rebuilds_index_with_gap(tmp_path):
+    """
+    Если в индексе не хватает записи в середине (индекс месяца потерян целиком),
+    индекс строится заново по всему сегменту.
+    """
+    path = str(tmp_path / 'expenses.seg')
+    storage = FileStorage(path, fsync=False)
+    for date in ('10.05', '15.06', '20.05'):
+        storage.insert_one({"name": "Трата", "category": "Еда", "amount": 1, "date": date})
+    storage.close()
+    os.remove(path + '.06.idx')
+
+    reopened = FileStorage(path, fsync=False)
+    assert list(reopened.months[5]) == [0, 2]
+    assert list(reopened.months[6]) == [1]
+    assert [number for number, _ in reopened.scan(6)] == [1]
+
+def test_file_storage_rejects_too_long_name(tmp_path):
+    """
+    Проверяем, что имя, не помещающееся в запись фиксированной ширины, не обрезается молча.
+    """
+    storage = FileStorage(str(tmp_path / 'expenses.seg'), fsync=False)
+    with pytest.raises(ValueError, match="name"):
+        storage.insert_one({"name": "я" * 40, "category": "Еда", "amount": 1, "date": "01.05"})
+    assert storage.count == 0
+
+def test_file_add_expense_too_long_name_returns_error(tmp_path):
+    """
+    Проверяем, что add_expense не выбрасывает исключение для названия или категории длиннее поля записи,
+    а возвращает сообщение об ошибке, как при других ошибках валидации.
+    """
+    tracker = make_file_tracker(tmp_path)
+    assert tracker.add_expense('я' * 33, 'еда', 100, '02.05').startswith("Ошибка: название")
+    assert tracker.add_expense('молоко', 'я' * 17, 100, '02.05').startswith("Ошибка: категория")
+    assert "добавлена" in tracker.add_expense('я' * 32, 'я' * 16, 100, '02.05')
+    assert tracker.storage.count == 1
+
+def test_file_percentiles(tmp_path):
+    """
+    Проверяем процентили на файловом хранилище: только по записям выбранных месяцев и категории.
+    """
+    tracker = make_file_tracker(tmp_path)
+    for amount in range(1, 11):
+        tracker.add_expense('обед', 'еда', amount, '10.05')
+    tracker.add_expense('шины', 'авто', 5000, '11.05')
+    result = tracker.get_percentiles(['5'], 'еда')
+    assert result['count'] == 10
+    assert 4 <= result['p50'] <= 6
+    assert tracker.get_percentiles(['06']) is None
+
+def test_file_search_expenses(tmp_path):
+    """
+    Проверяем поиск по названию на файловом хранилище.
+    """
+    tracker = make_file_tracker(tmp_path)
+    tracker.add_expense('молоко', 'еда', 100, '10.05')
+    tracker.add_expense('молоток', 'инструменты', 500, '12.06')
+    assert [e['name'] for e in tracker.search_expenses('мол')] == ['Молоко', 'Молоток']
+    assert [e['name'] for e in tracker.search_expenses('мол', month='06')] == ['Молоток']
+    assert tracker.search_expenses('кефир') == []
+    with pytest.raises(ValueError):
+        tracker.search_expenses('мол', limit=0)
+    # Категория длиннее поля записи не совпадает ни с одной тратой (а не снимает фильтр)
+    assert tracker.search_expenses('мол', category='к' * 40) == []
+    assert tracker.get_full_records(category='к' * 40) == []
+    assert tracker.get_percentiles(category='к' * 40) is None
+
+def test_file_full_records_pagination(tmp_path):
+    """
+    Проверяем постраничную выдачу и фильтры get_full_records на файловом хранилище.
+    """
+    tracker = make_file_tracker(tmp_path)
+    for day in range(1, 4):
+        tracker.add_expense(f'трата {day}', 'еда', 100, f'{day}.05')
+    tracker.add_expense('шины', 'авто', 900, '11.06')
+    page = tracker.get_full_records(limit=2, month='05')
+    assert [r['_id'] for r in page] == [0, 1]
+    page = tracker.get_full_records(after=str(page[-1]['_id']), limit=2, month='05', fields=['name'])
+    assert page == [{'_id': 2, 'name': 'Трата 3'}]
+    assert tracker.get_full_records(category='авто')[0]['name'] == 'Шины'
+
+def test_file_storage_close_during_scan(tmp_path):
+    """close во время перебора не обрывает его: отображение закрывается после последнего читателя"""
+    storage = FileStorage(str(tmp_path / 'expenses.seg'), fsync=False)
+    for day in range(1, 4):
+        storage.insert_one({"name": "Трата", "category": "Еда", "amount": day, "date": f"{day:02d}.05"})
+    records = storage.iter_records(5)
+    assert next(records)["amount"] == 1
+    storage.close()
+    assert [r["amount"] for r in records] == [2, 3]
+    assert storage._mmap is None
+    with pytest.raises(ValueError):
+        list(storage.scan())
@@ -0,0 +1,103 @@
+import mongomock
+
+import schema
+from expenses import ExpenseTracker
+from migrate import MIGRATION_ID, migrate_collection
+
+
+def make_legacy_db():
+    """
+    Утилита: база mongomock с тратами в исходной схеме (версия 1) и трекер поверх неё.
+    """
+    client = mongomock.MongoClient()
+    db = client['expenses_db']
+    db['expenses'].insert_many([
+        {"name": "Молоко", "category": "Еда", "amount": 100.1, "date": "02.05", "tokens": ["молоко"]},
+        {"name": "Соки", "category": "Еда", "amount": 110.0, "date": "05.05"},
+        {"name": "Бензин", "category": "Авто", "amount": 200.0, "date": "21.05", "idempotency_key": "key-1"}
+    ])
+    return db, ExpenseTracker(db_client=client)
+
+def test_schema_encode_decode_roundtrip():
+    """
+    Проверяем перевод документа в компактную схему и обратно: сумма в целых копейках,
+    дата раскладывается на день и месяц, лишние поля (_id) сохраняются.
+    """
+    document = {"_id": 1, "name": "Молоко", "category": "Еда", "amount": 0.145 * 100, "date": "02.05", "idempotency_key": "k"}
+    encoded = schema.encode(document)
+    assert encoded == {"v": 2, "_id": 1, "n": "Молоко", "c": "Еда", "a": 1450, "d": 2, "m": 5, "k": "k"}
+    assert schema.decode(encoded) == {**document, "amount": 14.5}
+    assert schema.to_minor_units(19.99) == 1999
+
+def test_amount_expression_rounds_like_to_minor_units():
+    """
+    Проверяем, что агрегация переводит суммы версии 1 в копейки так же, как to_minor_units,
+    в том числе когда amount * 100 в double оказывается чуть меньше половины копейки.
+    """
+    amounts = [1.005, 2.675, 19.99, 0.145 * 100, 100.1]
+    collection = mongomock.MongoClient()['expenses_db']['expenses']
+    collection.insert_many([{"amount": amount} for amount in amounts])
+    result = collection.aggregate([{"$sort": {"_id": 1}}, {"$project": {"_id": 0, "a": schema.AMOUNT_MINOR_EXPR}}])
+    assert [doc["a"] for doc in result] == [schema.to_minor_units(amount) for amount in amounts]
+
+def test_readers_handle_mixed_schema_versions():
+    """
+    Проверяем, что аналитика учитывает документы обеих версий схемы одновременно.
+    """
+    _, tracker = make_legacy_db()
+    tracker.add_expense('шины', 'авто', 900, '15.05')
+    assert tracker.get_top_category('5') == 'Авто'  # 200 (v1) + 900 (v2) > 210.1
+    assert tracker.get_max_expense('05', 'еда') == {"name": "Соки", "category": "Еда", "amount": 110.0, "date": "05.05"}
+    assert tracker.get_max_expense('05', 'авто')['name'] == 'Шины'
+    assert [r['name'] for r in tracker.get_full_records(month='05', category='авто')] == ['Бензин', 'Шины']
+    assert tracker.search_expenses('мол')[0]['name'] == 'Молоко'
+    # Ключ идемпотентности, сохранённый в документе версии 1, тоже учитывается
+    assert "Бензин" in tracker.add_expense('другое', 'авто', 1, '01.05', idempotency_key='key-1')
+
+def test_migrate_collection_resumable():
+    """
+    Проверяем миграцию пачками: прерванная миграция продолжается с сохранённого места,
+    все документы переходят в версию 2, а результаты аналитики не меняются.
+    """
+    db, tracker = make_legacy_db()
+    top_before = tracker.get_top_category('05')
+    # "Прерываем" миграцию после первой пачки из одного документа
+    first = db['expenses'].find_one(sort=[("_id", 1)])
+    db['expenses'].replace_one({"_id": first["_id"]}, schema.encode(first))
+    db['migrations'].insert_one({"_id": MIGRATION_ID, "last_id": first["_id"]})
+
+    assert migrate_collection(db['expenses'], db['migrations'], batch_size=1) == 2
+    assert db['expenses'].count_documents({"v": {"$exists": False}}) == 0
+    assert db['migrations'].find_one({"_id": MIGRATION_ID})["done"]
+    assert migrate_collection(db['expenses'], db['migrations']) == 0
+
+    migrated = ExpenseTracker(db_client=tracker.client, legacy_reads=False)
+    assert migrated.get_top_category('05') == top_before
+    assert migrated.get_max_expense('05', 'еда')['amount'] == 110.0
+    assert db['expenses'].find_one({"n": "Бензин"})["k"] == "key-1"
+
+def test_migrate_collection_rescans_older_legacy_documents():
+    """
+    Проверяем, что документы версии 1 с _id меньше сохранённого курсора тоже будут преобразованы.
+    """
+    db, _ = make_legacy_db()
+    last = db['expenses'].find_one(sort=[("_id", -1)])["_id"]
+    db['migrations'].insert_one({"_id": MIGRATION_ID, "last_id": last})
+    assert migrate_collection(db['expenses'], db['migrations']) == 3
+    assert db['expenses'].count_documents({"v": 2}) == 3
+
+def test_migrate_collection_fills_search_tokens():
+    """
+    Проверяем, что траты, добавленные до появления поиска (без tokens), после миграции находятся поиском,
+    а документы версии 2 без слов названия дополняет backfill_search_tokens.
+    """
+    db, tracker = make_legacy_db()
+    migrate_collection(db['expenses'], db['migrations'])
+    migrated = ExpenseTracker(db_client=tracker.client, legacy_reads=False)
+    assert db['expenses'].find_one({"n": "Соки"})["t"] == ["соки"]
+    assert [r['name'] for r in migrated.search_expenses('сок')] == ['Соки']
+
+    db['expenses'].insert_one(schema.encode({"name": "Сыр плавленый", "category": "Еда", "amount": 90.0, "date": "07.05"}))
+    assert migrated.search_expenses('сыр') == []
+    assert migrated.backfill_search_tokens() == 1
+    assert migrated.search_expenses('сыр')[0]['name'] == 'Сыр плавленый'
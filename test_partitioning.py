@@ -0,0 +1,92 @@
+import mongomock
+import pytest
+
+from expenses import ExpenseTracker
+from partitioning import PartitionedExpenseTracker
+
+
+def test_tenant_scoped_analytics():
+    """
+    Проверяем, что траты одного пользователя не влияют на аналитику другого,
+    а без tenant запросы выполняются по всем тратам.
+    """
+    tracker = ExpenseTracker(db_client=mongomock.MongoClient())
+    tracker.add_expense('сыр', 'еда', 300, '10.06', tenant='alice')
+    tracker.add_expense('шины', 'авто', 900, '11.06', tenant='bob')
+    tracker.add_expense('кола', 'еда', 100, '12.06', tenant='bob')
+
+    assert tracker.get_top_category('06', tenant='alice') == 'Еда'
+    assert tracker.get_top_category('06', tenant='bob') == 'Авто'
+    assert tracker.get_top_category('06') == 'Авто'
+    assert tracker.get_max_expense('06', 'еда', tenant='bob')['name'] == 'Кола'
+    assert [r['name'] for r in tracker.get_full_records(tenant='alice')] == ['Сыр']
+    assert tracker.search_expenses('ко', tenant='alice') == []
+    assert tracker.get_percentiles(['06'], 'еда', tenant='alice')['count'] == 1
+    assert tracker.get_percentiles(['06'], 'еда')['count'] == 2
+
+def test_idempotency_key_scoped_by_tenant():
+    """
+    Проверяем, что одинаковые ключи идемпотентности разных пользователей не конфликтуют.
+    """
+    client = mongomock.MongoClient()
+    tracker = ExpenseTracker(db_client=client)
+    tracker.add_expense('сыр', 'еда', 300, '10.06', idempotency_key='k', tenant='alice')
+    tracker.add_expense('шины', 'авто', 900, '11.06', idempotency_key='k', tenant='bob')
+    tracker.add_expense('шины', 'авто', 900, '11.06', idempotency_key='k', tenant='bob')
+    assert client['expenses_db']['expenses'].count_documents({}) == 2
+
+def test_tenant_leading_indexes():
+    """
+    Проверяем, что после первой записи созданы индексы, начинающиеся с поля владельца.
+    """
+    client = mongomock.MongoClient()
+    ExpenseTracker(db_client=client).add_expense('сыр', 'еда', 300, '10.06', tenant='alice')
+    keys = [list(index['key']) for index in client['expenses_db']['expenses'].index_information().values()]
+    assert [('u', 1), ('m', 1), ('c', 1), ('a', -1)] in keys
+    assert [('u', 1), ('t', 1)] in keys
+
+@pytest.mark.parametrize('by', ['collection', 'database'])
+def test_partitioned_tracker_routes_tenants(by):
+    """
+    Проверяем, что фасад распределяет пользователей по разделам стабильно,
+    данные пользователя лежат только в его разделе, а запрос без пользователя отклоняется.
+    """
+    client = mongomock.MongoClient()
+    facade = PartitionedExpenseTracker.from_client(client, 4, by=by)
+    tenants = [f'user-{i}' for i in range(20)]
+    for tenant in tenants:
+        facade.add_expense('сыр', 'еда', 100, '10.06', tenant=tenant)
+    assert len({facade.partition(tenant) for tenant in tenants}) > 1
+    for tenant in tenants:
+        own = facade.tracker_for(tenant)
+        assert own.collection.count_documents({"u": tenant}) == 1
+        assert facade.get_top_category('06', tenant=tenant) == 'Еда'
+        assert len(facade.get_full_records(tenant=tenant)) == 1
+    total = sum(t.collection.count_documents({}) for t in facade.trackers)
+    assert total == len(tenants)
+    with pytest.raises(ValueError):
+        facade.get_top_category('06')
+
+def test_partitioned_tracker_cache_and_warm_up():
+    """
+    Проверяем, что фасад включает кэш аналитики и прогрев в каждом разделе,
+    а from_uri создаёт разделы на общих клиентах MongoDB.
+    """
+    facade = PartitionedExpenseTracker.from_client(mongomock.MongoClient(), 2)
+    feeds = facade.start_analytics_cache(mode='poll')
+    try:
+        assert [feed.mode for feed in feeds] == ['poll', 'poll']
+        facade.add_expense('сыр', 'еда', 300, '10.06', tenant='alice')
+        facade.warm_up(month='06')
+        assert facade.get_top_category('06', tenant='alice') == 'Еда'
+        assert ('top', 'alice', '06') in facade.tracker_for('alice').analytics_cache._data
+    finally:
+        for feed in feeds:
+            feed.stop()
+
+    facade = PartitionedExpenseTracker.from_uri(3, 'mongodb://localhost:27017/', by='database')
+    try:
+        assert [t.db.name for t in facade.trackers] == ['expenses_db_0', 'expenses_db_1', 'expenses_db_2']
+        assert all(t.client is facade.trackers[0].client for t in facade.trackers)
+    finally:
+        facade.trackers[0].client.close()
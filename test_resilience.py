@@ -0,0 +1,192 @@
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+from resilience import CircuitBreaker, CircuitOpenError, SnapshotStore, Spool
+
+
+def fail():
+    raise TimeoutError("нет ответа")
+
+def test_breaker_opens_after_failures_and_recovers(clock):
+    """После failure_threshold неудач вызовы отклоняются сразу, после reset_timeout — пробный вызов"""
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=clock)
+    for _ in range(2):
+        with pytest.raises(TimeoutError):
+            breaker.call(fail)
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.call(lambda: 1)
+    assert error.value.retry_after == 10
+
+    clock.now = 10
+    assert breaker.call(lambda: 1) == 1
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.failures == 0
+
+def test_breaker_failed_trial_reopens(clock):
+    """Неудачный пробный вызов снова размыкает автомат"""
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=5, clock=clock)
+    with pytest.raises(TimeoutError):
+        breaker.call(fail)
+    clock.now = 5
+    with pytest.raises(TimeoutError):
+        breaker.call(fail)
+    assert breaker.state == CircuitBreaker.OPEN
+
+def test_breaker_call_deadline():
+    """Зависший вызов прерывается по сроку, ошибки в самом запросе автомат не размыкают"""
+    breaker = CircuitBreaker(failure_threshold=1, call_timeout=0.05)
+    release = threading.Event()
+    with pytest.raises(TimeoutError):
+        breaker.call(release.wait, 5)
+    release.set()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    breaker = CircuitBreaker(failure_threshold=1)
+    with pytest.raises(ValueError):
+        breaker.call(int, "не число")
+    assert breaker.state == CircuitBreaker.CLOSED
+
+def test_snapshot_store_survives_restart(tmp_path):
+    """
+    Снимок не читает и не пишет файл сам по себе: он загружается restore,
+    а изменения сохраняются фоновым потоком и при остановке.
+    """
+    path = str(tmp_path / "snapshot.json")
+    store = SnapshotStore(path, flush_interval=0.01)
+    store.start()
+    store.save(("top", None, "06"), "Еда")
+    assert store.load(("top", None, "06")) == (True, "Еда")
+    assert store.load(("top", None, "07")) == (False, None)
+    for _ in range(100):
+        if os.path.exists(path):
+            break
+        time.sleep(0.01)
+    store.save(("top", None, "07"), "Авто")
+    store.stop()
+
+    restarted = SnapshotStore(path)
+    assert restarted.load(("top", None, "06")) == (False, None)
+    restarted.restore()
+    assert restarted.load(("top", None, "06")) == (True, "Еда")
+    assert restarted.load(("top", None, "07")) == (True, "Авто")
+
+def test_snapshot_store_is_bounded(clock):
+    """Снимок хранит не больше maxsize результатов и не дольше ttl"""
+    store = SnapshotStore(maxsize=2, ttl=10, clock=clock)
+    for month in ("05", "06", "07"):
+        store.save(("top", None, month), "Еда")
+    assert store.load(("top", None, "05")) == (False, None)
+    assert store.load(("top", None, "07")) == (True, "Еда")
+    clock.now = 10
+    assert store.load(("top", None, "07")) == (False, None)
+
+def test_spool_replay_keeps_failed_tail(tmp_path):
+    """Воспроизведение останавливается на первой ошибке, невоспроизведённые траты остаются в очереди"""
+    spool = Spool(str(tmp_path / "expenses.spool"))
+    first = spool.append({"name": "сыр", "category": "еда", "amount": 300, "date": "10.06"})
+    spool.append({"name": "кола", "category": "напитки", "amount": 100, "date": "11.06"})
+    replayed = []
+
+    def add_expense(**expense):
+        if expense["name"] == "кола":
+            raise TimeoutError("нет ответа")
+        replayed.append(expense)
+
+    with pytest.raises(TimeoutError):
+        spool.replay(add_expense)
+    assert [e["idempotency_key"] for e in replayed] == [first]
+    assert spool.pending()
+    assert spool.replay(lambda **expense: None) == 1
+    assert not spool.pending()
+
+def test_breaker_call_async_deadline():
+    """Асинхронный вызов ограничен тем же сроком и так же размыкает автомат"""
+    breaker = CircuitBreaker(failure_threshold=1, call_timeout=0.05)
+    release = threading.Event()
+
+    async def main():
+        assert await breaker.call_async(lambda x: x * 2, 21) == 42
+        with pytest.raises(TimeoutError):
+            await breaker.call_async(release.wait, 5)
+        with pytest.raises(CircuitOpenError):
+            await breaker.call_async(lambda: 1)
+
+    asyncio.run(main())
+    release.set()
+    assert breaker.state == CircuitBreaker.OPEN
+
+def test_breaker_cancelled_trial_released(clock):
+    """Отменённый пробный вызов (клиент отключился) не оставляет автомат закрытым для всех следующих вызовов"""
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=5, call_timeout=5, clock=clock)
+    with pytest.raises(TimeoutError):
+        breaker.call(fail)
+    clock.now = 5
+    release = threading.Event()
+
+    async def main():
+        trial = asyncio.ensure_future(breaker.call_async(release.wait, 5))
+        await asyncio.sleep(0.05)
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+        release.set()
+        assert await breaker.call_async(lambda: 1) == 1
+
+    asyncio.run(main())
+    assert breaker.state == CircuitBreaker.CLOSED
+
+def test_breaker_queue_wait_not_counted_as_failure():
+    """
+    Вызов, не дождавшийся свободного потока пула, отменяется и не размыкает автомат;
+    отдельный срок deadline позволяет долгому вызову уложиться
+    """
+    breaker = CircuitBreaker(failure_threshold=1, call_timeout=0.05, max_workers=1)
+    release = threading.Event()
+    busy = threading.Thread(target=breaker.call, args=(release.wait,), kwargs={"deadline": 5})
+    busy.start()
+    time.sleep(0.02)
+    with pytest.raises(TimeoutError, match="свободного потока"):
+        breaker.call(lambda: 1)
+
+    async def main():
+        with pytest.raises(TimeoutError, match="свободного потока"):
+            await breaker.call_async(lambda: 1)
+
+    asyncio.run(main())
+    release.set()
+    busy.join()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.failures == 0
+    assert breaker.call(time.sleep, 0.1, deadline=1) is None
+    assert breaker.state == CircuitBreaker.CLOSED
+
+def test_spool_background_replay(tmp_path):
+    """Фоновое воспроизведение записывает траты прошлого запуска и повторяет попытки, пока база недоступна"""
+    spool = Spool(str(tmp_path / "expenses.spool"), replay_interval=0.05)
+    spool.append({"name": "сыр", "category": "еда", "amount": 300, "date": "10.06"})
+    replayed = []
+    available = threading.Event()
+
+    def add_expense(**expense):
+        if not available.is_set():
+            raise TimeoutError("нет ответа")
+        replayed.append(expense["name"])
+
+    spool.start(add_expense)
+    try:
+        time.sleep(0.1)
+        assert spool.pending()
+        available.set()
+        for _ in range(50):
+            if not spool.pending():
+                break
+            time.sleep(0.02)
+    finally:
+        spool.stop()
+    assert replayed == ["сыр"]
+    assert not spool.pending()
@@ -1,3 +1,7 @@
+import os
+import socket
+import subprocess
+import sys
 import threading
 import time
 import requests
@@ -7,9 +11,15 @@ from http.server import HTTPServer
 import logging
 from io import StringIO
 import json
+from bson import ObjectId
 
 import http_server
+from admission import READ, AdmissionController
 from expenses import ExpenseTracker
+from file_storage import FileExpenseTracker
+from partitioning import PartitionedExpenseTracker
+from resilience import CircuitBreaker, SnapshotStore, Spool
+from server_config import make_tracker, parse_args
 
 @pytest.fixture(scope='function')
 def test_logger():
@@ -27,7 +37,7 @@ def test_logger():
     logger.removeHandler(handler)  # Только добавленный handler
 
 @pytest.fixture(scope='function')
-def mock_tracker(monkeypatch):
+def mock_tracker(monkeypatch, tmp_path):
     """
     Фикстура создаёт моковую версию ExpenseTracker с базой данных в памяти (mongomock),
     и подменяет глобальный объект tracker в модуле http_server на моковый.
@@ -37,6 +47,12 @@ def mock_tracker(monkeypatch):
     client = mongomock.MongoClient()
     tracker = ExpenseTracker(db_client=client)
     monkeypatch.setattr(http_server, 'tracker', tracker)
+    # Свежие счётчики и вёдра токенов контроля допуска для каждого теста
+    monkeypatch.setattr(http_server, 'admission', AdmissionController())
+    # Замкнутый автомат, пустой снимок в памяти и очередь во временном каталоге
+    monkeypatch.setattr(http_server, 'breaker', CircuitBreaker())
+    monkeypatch.setattr(http_server, 'snapshots', SnapshotStore())
+    monkeypatch.setattr(http_server, 'spool', Spool(str(tmp_path / 'expenses.spool')))
     return tracker
 
 @pytest.fixture(scope='function')
@@ -62,6 +78,7 @@ def start_test_server(mock_tracker, test_logger):
 
     httpd.shutdown()
     thread.join()
+    httpd.server_close()
     http_server.logger = original_logger
 
 def test_add_expense_api_success(start_test_server):
@@ -267,3 +284,298 @@ def test_full_records_api_success(start_test_server, mock_tracker):
     assert isinstance(data, list)
     assert any("Пицца" in str(entry.values()) for entry in data)
 
+
+def test_add_expense_api_idempotency_key(start_test_server, mock_tracker):
+    """
+    Повтор POST /expenses с тем же заголовком Idempotency-Key
+    возвращает тот же ответ и не создаёт вторую запись.
+    """
+    url, _ = start_test_server
+    payload = {"name": "сыр", "category": "еда", "amount": 300, "date": "10.06"}
+    headers = {'Idempotency-Key': 'retry-1'}
+    first = requests.post(url + '/expenses', json=payload, headers=headers)
+    second = requests.post(url + '/expenses', json=payload, headers=headers)
+    assert first.status_code == second.status_code == 200
+    assert first.json() == second.json()
+    assert mock_tracker.collection.count_documents({}) == 1
+
+def test_rate_limited_client_gets_429(start_test_server, monkeypatch):
+    """
+    Клиент, исчерпавший ведро токенов, получает 429 с заголовком Retry-After,
+    а отказ учитывается в счётчиках /metrics.
+    """
+    monkeypatch.setattr(http_server, 'admission', AdmissionController(rate=0.5, burst=1))
+    url, _ = start_test_server
+    assert requests.get(f"{url}/categories/top?month=06").status_code == 404
+    response = requests.get(f"{url}/categories/top?month=06")
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '2'
+    assert requests.get(f"{url}/metrics").json()["rate_limited"] == 1
+
+def test_overloaded_route_class_gets_503(start_test_server, monkeypatch):
+    """
+    Когда все слоты на чтение заняты, GET сразу получает 503 с Retry-After,
+    а запись (отдельный лимит) продолжает обслуживаться.
+    """
+    admission = AdmissionController(read_limit=1)
+    monkeypatch.setattr(http_server, 'admission', admission)
+    assert admission.acquire(READ)  # слот занят "зависшим" запросом
+    url, _ = start_test_server
+    response = requests.get(f"{url}/categories/top?month=06")
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    response = requests.post(url + '/expenses', json={"name": "сыр", "category": "еда", "amount": 300, "date": "10.06"})
+    assert response.status_code == 200
+    stats = requests.get(f"{url}/metrics").json()
+    assert stats["read"] == {"limit": 1, "in_flight": 1, "admitted": 1, "rejected": 1}
+    assert stats["write"]["in_flight"] == 0
+    assert stats["write"]["admitted"] == 1
+
+def test_percentiles_api(start_test_server, mock_tracker):
+    """ GET /expenses/percentiles: процентили за несколько месяцев и 404 без данных """
+    mock_tracker.add_expense("сыр", "еда", 300, "10.06")
+    mock_tracker.add_expense("кола", "еда", 100, "10.07")
+    url, _ = start_test_server
+    response = requests.get(f"{url}/expenses/percentiles?month=06,07&category=еда")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["count"] == 2
+    assert set(data) == {"p50", "p90", "p99", "count"}
+    response = requests.get(f"{url}/expenses/percentiles?month=08")
+    assert response.status_code == 404
+
+def test_search_api(start_test_server, mock_tracker):
+    """ GET /expenses/search: поиск по префиксу, 404 без результатов и 400 без строки поиска """
+    mock_tracker.add_expense("сырок глазированный", "еда", 50, "10.06")
+    mock_tracker.add_expense("сыр", "еда", 300, "10.07")
+    url, _ = start_test_server
+    response = requests.get(f"{url}/expenses/search?q=сыр&month=06")
+    assert response.status_code == 200
+    assert [e["name"] for e in response.json()] == ["Сырок глазированный"]
+    assert requests.get(f"{url}/expenses/search?q=кефир").status_code == 404
+    assert requests.get(f"{url}/expenses/search?q=").status_code == 400
+    # limit вне диапазона 1..500 отклоняется, а не снимает ограничение
+    for limit in ("0", "-1", "501", "много"):
+        assert requests.get(f"{url}/expenses/search?q=сыр&limit={limit}").status_code == 400
+
+def test_full_records_api_pagination(start_test_server, mock_tracker):
+    """ GET /expenses/full_records постранично: курсор в X-Next-Cursor, проекция полей, 400 на плохой курсор """
+    for day in range(1, 4):
+        mock_tracker.add_expense(f"пицца {day}", "еда", 500, f"{day}.06")
+    url, _ = start_test_server
+    response = requests.get(f"{url}/expenses/full_records?limit=2&fields=name")
+    assert response.status_code == 200
+    assert [set(r) for r in response.json()] == [{"_id", "name"}] * 2
+    cursor = response.headers['X-Next-Cursor']
+    response = requests.get(f"{url}/expenses/full_records?limit=2&after={cursor}")
+    assert [r["name"] for r in response.json()] == ["Пицца 3"]
+    assert 'X-Next-Cursor' not in response.headers
+    assert requests.get(f"{url}/expenses/full_records?after=bad").status_code == 400
+
+def test_tenant_header_scopes_requests(start_test_server, mock_tracker):
+    """ Заголовок X-Tenant-Id: траты сохраняются за пользователем, аналитика считается по его тратам """
+    url, _ = start_test_server
+    requests.post(url + '/expenses', json={"name": "сыр", "category": "еда", "amount": 300, "date": "10.06"},
+                  headers={'X-Tenant-Id': 'alice'})
+    requests.post(url + '/expenses', json={"name": "шины", "category": "авто", "amount": 900, "date": "10.06"},
+                  headers={'X-Tenant-Id': 'bob'})
+    response = requests.get(f"{url}/categories/top?month=06", headers={'X-Tenant-Id': 'alice'})
+    assert "Еда" in list(response.json().values())[0]
+    response = requests.get(f"{url}/expenses/largest?month=06&category=авто", headers={'X-Tenant-Id': 'alice'})
+    assert response.status_code == 404
+    assert mock_tracker.collection.count_documents({"u": "bob"}) == 1
+
+def test_multi_tenant_mode_requires_tenant(start_test_server, mock_tracker, monkeypatch):
+    """
+    В многопользовательском режиме запрос без X-Tenant-Id получает 400 (кроме /metrics),
+    а список трат не раскрывает владельца.
+    """
+    monkeypatch.setattr(http_server, 'multi_tenant', True)
+    url, _ = start_test_server
+    expense = {"name": "сыр", "category": "еда", "amount": 300, "date": "10.06"}
+    assert requests.post(url + '/expenses', json=expense).status_code == 400
+    assert requests.get(f"{url}/categories/top?month=06").status_code == 400
+    assert requests.get(f"{url}/expenses/full_records").status_code == 400
+    assert requests.get(f"{url}/metrics").status_code == 200
+
+    headers = {'X-Tenant-Id': 'alice'}
+    assert requests.post(url + '/expenses', json=expense, headers=headers).status_code == 200
+    records = requests.get(f"{url}/expenses/full_records", headers=headers).json()
+    assert [set(r) for r in records] == [{"_id", "name", "category", "amount", "date"}]
+
+def test_partitions_route_tenants_and_require_them(start_test_server, monkeypatch):
+    """ С разделами сервер работает через PartitionedExpenseTracker и требует X-Tenant-Id """
+    facade = PartitionedExpenseTracker.from_client(mongomock.MongoClient(), 2)
+    monkeypatch.setattr(http_server, 'tracker', facade)
+    monkeypatch.setattr(http_server, 'partitions', 2)
+    url, _ = start_test_server
+    expense = {"name": "сыр", "category": "еда", "amount": 300, "date": "10.06"}
+    assert requests.post(url + '/expenses', json=expense).status_code == 400
+    assert requests.post(url + '/expenses', json=expense, headers={'X-Tenant-Id': 'alice'}).status_code == 200
+    assert facade.tracker_for('alice').collection.count_documents({"u": "alice"}) == 1
+
+def test_stale_snapshot_when_database_unavailable(start_test_server, mock_tracker, monkeypatch):
+    """
+    Когда база не отвечает, аналитика отдаётся из снимка последнего успешного ответа
+    с заголовком X-Stale, а без снимка — 503 с Retry-After.
+    """
+    mock_tracker.add_expense("сыр", "еда", 300, "10.06")
+    url, _ = start_test_server
+    fresh = requests.get(f"{url}/categories/top?month=06")
+    assert fresh.status_code == 200
+    assert 'X-Stale' not in fresh.headers
+    assert requests.get(f"{url}/categories/top?month=07").status_code == 404
+
+    def unavailable(*args, **kwargs):
+        raise TimeoutError("Mongo не отвечает")
+
+    monkeypatch.setattr(mock_tracker, 'get_top_category', unavailable)
+    stale = requests.get(f"{url}/categories/top?month=06")
+    assert stale.status_code == 200
+    assert stale.headers['X-Stale'] == 'true'
+    assert stale.json() == fresh.json()
+
+    # Месяц с ведущим нулём и без — один и тот же ключ снимка
+    assert requests.get(f"{url}/categories/top?month=6").status_code == 200
+
+    # Пустые результаты (404) в снимок не попадают
+    response = requests.get(f"{url}/categories/top?month=07")
+    assert response.status_code == 503
+    assert 'Retry-After' in response.headers
+
+def test_post_spooled_when_database_unavailable(start_test_server, mock_tracker, monkeypatch):
+    """
+    При недоступной базе корректная трата принимается в очередь (202), некорректная — 400,
+    а после восстановления базы очередь воспроизводится следующей успешной записью.
+    """
+    add_expense = mock_tracker.add_expense
+
+    def unavailable(*args, **kwargs):
+        raise TimeoutError("Mongo не отвечает")
+
+    monkeypatch.setattr(mock_tracker, 'add_expense', unavailable)
+    url, _ = start_test_server
+    response = requests.post(url + '/expenses', json={"name": "сыр", "category": "еда", "amount": 300, "date": "10.06"})
+    assert response.status_code == 202
+    assert ObjectId.is_valid(response.json()["expense_id"])
+    response = requests.post(url + '/expenses', json={"name": "сыр", "category": "еда", "amount": 300, "date": "40.06"})
+    assert response.status_code == 400
+    assert http_server.spool.pending()
+
+    monkeypatch.setattr(mock_tracker, 'add_expense', add_expense)
+    response = requests.post(url + '/expenses', json={"name": "кола", "category": "напитки", "amount": 100, "date": "11.06"})
+    assert response.status_code == 200
+    for _ in range(50):
+        if not http_server.spool.pending():
+            break
+        time.sleep(0.05)
+    assert not http_server.spool.pending()
+    assert mock_tracker.collection.count_documents({}) == 2
+
+def test_timed_out_post_not_written_twice(start_test_server, mock_tracker, monkeypatch):
+    """
+    Запись, не уложившаяся в срок, всё же завершается в пуле; трата уходит и в очередь,
+    но с тем же _id, поэтому воспроизведение очереди не создаёт дубль.
+    """
+    monkeypatch.setattr(http_server, 'breaker', CircuitBreaker(call_timeout=0.1))
+    add_expense = mock_tracker.add_expense
+
+    def slow_add_expense(*args, **kwargs):
+        time.sleep(0.3)
+        return add_expense(*args, **kwargs)
+
+    monkeypatch.setattr(mock_tracker, 'add_expense', slow_add_expense)
+    url, _ = start_test_server
+    response = requests.post(url + '/expenses', json={"name": "сыр", "category": "еда", "amount": 300, "date": "10.06"})
+    assert response.status_code == 202
+    time.sleep(0.5)
+    assert mock_tracker.collection.count_documents({}) == 1
+    assert http_server.spool.replay(add_expense) == 1
+    assert mock_tracker.collection.count_documents({}) == 1
+    # Без ключа клиента дубль отсекает назначенный заранее _id, ключ идемпотентности в документе не хранится
+    assert "k" not in mock_tracker.collection.find_one()
+
+def test_post_with_transfer_encoding_rejected(start_test_server, mock_tracker):
+    """ Тело с Transfer-Encoding: chunked не читается по Content-Length — 501 без записи траты """
+    url, _ = start_test_server
+    body = iter([b'{"name": "cheese", "category": "food", "amount": 1, "date": "10.06"}'])
+    response = requests.post(url + '/expenses', data=body)
+    assert response.status_code == 501
+    assert mock_tracker.collection.count_documents({}) == 0
+
+def test_unparsable_path_gets_400(start_test_server):
+    """ Путь, который не удаётся разобрать, получает 400, а не обрыв соединения """
+    with socket.create_connection(('localhost', 8081)) as sock:
+        sock.sendall(b"GET http://[x/metrics HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+        assert sock.recv(65536).startswith(b"HTTP/1.0 400 Bad Request")
+
+def test_import_does_not_connect_or_load_bson():
+    """Импорт модуля сервера не создаёт tracker и не загружает pymongo/bson"""
+    code = (
+        "import sys, http_server; "
+        "assert http_server.tracker is None; "
+        "assert not [m for m in sys.modules if m.startswith(('pymongo', 'bson'))]"
+    )
+    subprocess.run([sys.executable, "-c", code], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+def test_get_tracker_created_once(monkeypatch):
+    """Одновременные первые обращения из разных потоков создают один ExpenseTracker"""
+    created = []
+
+    def make_tracker(*args):
+        time.sleep(0.05)  # создание "долгое" — потоки успевают встретиться
+        created.append(ExpenseTracker(db_client=mongomock.MongoClient()))
+        return created[-1]
+
+    monkeypatch.setattr(http_server, 'tracker', None)
+    monkeypatch.setattr(http_server, 'make_tracker', make_tracker)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(http_server.get_tracker())) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(created) == 1
+    assert all(result is created[0] for result in results)
+
+def test_storage_path_runs_server_on_file_tracker(tmp_path, monkeypatch):
+    """
+    С --storage-path сервер создаёт FileExpenseTracker, который готовится к работе без MongoDB,
+    а сочетание с разделами пользователей отклоняется при разборе параметров
+    """
+    monkeypatch.setattr(http_server, 'tracker', None)
+    monkeypatch.setattr(http_server, 'storage_path', str(tmp_path / 'expenses.seg'))
+    instance = http_server.get_tracker()
+    assert isinstance(instance, FileExpenseTracker)
+    assert instance.start_analytics_cache() is None
+    instance.warm_up()
+    instance.storage.close()
+
+    assert parse_args("", ['--storage-path', 'expenses.seg']).storage_path == 'expenses.seg'
+    with pytest.raises(SystemExit):
+        parse_args("", ['--storage-path', 'expenses.seg', '--partitions', '2'])
+
+def test_mongo_options_reach_tracker():
+    """
+    Параметры подключения из командной строки передаются в ExpenseTracker и в разделы PartitionedExpenseTracker:
+    отдельный клиент чтения, его предпочтение чтения и размеры пулов
+    """
+    args = parse_args("", [
+        '--reader-uri', 'mongodb://localhost:27018/', '--read-preference', 'secondaryPreferred',
+        '--max-staleness-seconds', '120', '--max-pool-size', '10', '--min-pool-size', '0'
+    ])
+    assert args.tracker_options == {
+        'reader_uri': 'mongodb://localhost:27018/', 'read_preference': 'secondaryPreferred',
+        'max_staleness_seconds': 120, 'max_pool_size': 10, 'min_pool_size': 0
+    }
+    for partitions in (None, 2):
+        instance = make_tracker(partitions, tracker_options=args.tracker_options)
+        tracker = instance.trackers[-1] if partitions else instance
+        try:
+            assert tracker.reader_client is not tracker.client
+            assert tracker.client.options.pool_options.max_pool_size == 10
+            assert tracker.read_collection.read_preference.mongos_mode == 'secondaryPreferred'
+            assert tracker.read_collection.read_preference.max_staleness == 120
+        finally:
+            tracker.client.close()
+            tracker.reader_client.close()
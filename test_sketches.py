@@ -0,0 +1,91 @@
+import random
+
+import mongomock
+
+from sketches import SketchStore, TDigest
+
+
+def test_tdigest_quantiles_close_to_exact():
+    """
+    Проверяем, что квантили t-digest на равномерном распределении близки к точным,
+    а минимум и максимум сохраняются точно.
+    """
+    rng = random.Random(1)
+    values = [rng.uniform(0, 1000) for _ in range(20000)]
+    digest = TDigest()
+    for value in values:
+        digest.add(value)
+    values.sort()
+    for q in (0.5, 0.9, 0.99):
+        exact = values[int(q * len(values))]
+        assert abs(digest.quantile(q) - exact) < 10
+    assert digest.quantile(0) == values[0]
+    assert digest.quantile(1) == values[-1]
+    assert len(digest.centroids) < 200
+
+def test_tdigest_merge_equals_combined():
+    """
+    Проверяем, что слияние двух скетчей даёт те же квантили, что и скетч по всем данным.
+    """
+    left, right, combined = TDigest(), TDigest(), TDigest()
+    for value in range(1, 1001):
+        (left if value % 2 else right).add(value)
+        combined.add(value)
+    merged = left.merge(right)
+    assert merged.count == 1000
+    for q in (0.5, 0.9, 0.99):
+        assert abs(merged.quantile(q) - combined.quantile(q)) < 5
+
+def test_tdigest_roundtrip_dict():
+    """
+    Проверяем сохранение скетча в словарь и восстановление из него.
+    """
+    digest = TDigest()
+    for value in (10, 20, 30):
+        digest.add(value)
+    restored = TDigest.from_dict(digest.to_dict())
+    assert restored.count == 3
+    assert restored.quantile(0.5) == digest.quantile(0.5)
+
+def test_sketch_store_compacts_buffer():
+    """
+    Проверяем, что буфер документа скетча сливается с центроидами после compact_every добавлений,
+    а скетчи разных процессов (разные SketchStore на одной коллекции) видят общие данные.
+    """
+    collection = mongomock.MongoClient()['expenses_db']['sketches']
+    first = SketchStore(collection, compact_every=10)
+    second = SketchStore(collection, compact_every=10)
+    for value in range(1, 16):
+        (first if value % 2 else second).add('05', 'Еда', value)
+    doc = collection.find_one({"_id": "05|Еда"})
+    assert doc["pending"] == 5
+    assert len(doc["buffer"]) == 5
+    digest = first.merged(['05'], 'Еда')
+    assert digest.count == 15
+    assert digest.min == 1 and digest.max == 15
+
+def test_sketch_compaction_keeps_concurrent_adds(monkeypatch):
+    """
+    Проверяем, что добавление между чтением буфера и записью слияния не мешает слиянию
+    и не теряется: из буфера удаляются только слитые значения.
+    """
+    collection = mongomock.MongoClient()['expenses_db']['sketches']
+    store = SketchStore(collection, compact_every=1000)
+    for value in range(1, 6):
+        store.add('05', 'Еда', value)
+    find_one = collection.find_one
+
+    def find_one_then_add(*args, **kwargs):
+        doc = find_one(*args, **kwargs)
+        monkeypatch.setattr(collection, 'find_one', find_one)
+        SketchStore(collection, compact_every=1000).add('05', 'Еда', 100)
+        return doc
+
+    monkeypatch.setattr(collection, 'find_one', find_one_then_add)
+    store.compact("05|Еда")
+    doc = collection.find_one({"_id": "05|Еда"})
+    assert [entry["v"] for entry in doc["buffer"]] == [100.0]
+    assert doc["pending"] == 1
+    digest = store.merged(['05'], 'Еда')
+    assert digest.count == 6
+    assert digest.max == 100